@@ -0,0 +1,139 @@
+################################################################################
+#
+# Inverse-probability-of-censoring weights for the per-protocol analysis
+#
+# Chunked equivalent of analysis/seq_trials/functions/add_ipacw.R: reads the
+# expanded trials, fits the artificial censoring model (control arm starting
+# treatment, one model per trial) and, where the trials have out_date_dereg, a
+# deregistration model, and streams the trial rows back with the cumulative
+# weights (see analysis/engine/censoring_weights.py). Rows of the control arm
+# after treatment started are censored, i.e. dropped, as in add_ipacw.R. The
+# artificial censoring model has the natural spline ns(covid_test_positive_date, 3)
+# of add_ipacw.R (knots from all trials together, not per trial). As add_ipacw()
+# does, only trials 0 to treatment window - 1 are kept: the last of them (trial
+# 4 with the default treatment window), in which the control arm cannot start
+# treatment, keeps all its rows with w = 1, and later trials (5 and 6 of the 7
+# trials of prepare_data.R) are dropped. Unlike add_ipacw.R, whose weights are
+# 1 / P_denom, the artificial censoring weights are stabilised by an
+# intercept-only numerator per trial.
+#
+# The output of this script is:
+# - ./output/data/data_seq_trials_monthly_ipcw.arrow (trial rows with w_* and w)
+# - ./output/seq_trials/pp/ipcw_coefficients.csv
+#
+# usage: python analysis/add_censoring_weights.py
+#        [--input output/data/data_seq_trials_monthly.feather]
+#        [--treatment-window 5] [--truncate 1 99] [--chunk-rows 1000000]
+################################################################################
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.censoring_weights import CensoringModel, CensoringWeights, coefficient_table, group_starts, read_covars
+from engine.dataset_io import iter_frames, to_arrow
+from engine.streaming import append_arrow
+
+GROUP_COLUMNS = ["patient_id", "trial"]
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", default="output/data/data_seq_trials_monthly.feather")
+parser.add_argument("--output", default="output/data/data_seq_trials_monthly_ipcw.arrow")
+parser.add_argument("--treatment-window", type=int, default=5)
+parser.add_argument("--truncate", type=float, nargs=2, default=None, metavar=("LOWER", "UPPER"),
+                    help="truncate the weights at these percentiles")
+parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+args = parser.parse_args()
+
+output_dir = Path("output/seq_trials/pp")
+output_dir.mkdir(parents=True, exist_ok=True)
+
+columns = pa.ipc.open_file(pa.memory_map(args.input)).schema.names
+covars = read_covars(columns)
+splines = (("covid_test_positive_date", 3),) if "covid_test_positive_date" in columns else ()
+
+
+################################################################################
+# 1 Censoring indicators per interval
+################################################################################
+def as_int(values: pd.Series) -> pd.Series:
+    # arm, trial and period are R factors, read back as categoricals of labels
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        levels = pd.to_numeric(pd.Series(values.cat.categories.astype(str))).to_numpy(dtype="int64")
+        return pd.Series(levels[values.cat.codes.to_numpy()], index=values.index)
+    return values.astype("int64")
+
+
+def prepare(frame: pd.DataFrame) -> pd.DataFrame:
+    # trials after the last one add_ipacw() binds are dropped
+    frame = frame[as_int(frame["trial"]) < args.treatment_window].reset_index(drop=True)
+    starts = group_starts(frame, GROUP_COLUMNS)
+    last = np.roll(starts, -1)  # rows followed by a group start (the last row wraps to the first)
+    lead = frame["treatment_seq"].shift(-1).where(~last)
+    arm = as_int(frame["arm"])
+    tend_max = args.treatment_window - as_int(frame["trial"]) - 1
+    frame["last_trial"] = tend_max == 0
+    frame["censoring_at_risk"] = (arm == 0) & (frame["treatment_seq"] != 1) & (frame["tend"] <= tend_max) & lead.notna()
+    frame["uncensored"] = (lead == arm).astype("int64")
+    if {"out_date_dereg", "baseline_date"} <= set(frame.columns):
+        day = (frame["out_date_dereg"] - frame["baseline_date"]).dt.days - as_int(frame["trial"])
+        frame["dereg_at_risk"] = ~frame["last_trial"]
+        frame["not_deregistered"] = (~((day > frame["tstart"]) & (day <= frame["tend"]))).astype("int64")
+    return frame[~((arm == 0) & (frame["treatment_seq"] == 1) & ~frame["last_trial"])].reset_index(drop=True)
+
+
+def unit_weights(frame: pd.DataFrame) -> pd.DataFrame:
+    # w = 1 in the last trial, also when truncation bounds exclude 1
+    frame.loc[frame["last_trial"].to_numpy(), [f"w_{model.name}" for model in models] + ["w"]] = 1.0
+    return frame.drop(columns="last_trial")
+
+
+def frames():
+    return (prepare(frame) for frame in iter_frames(args.input, args.chunk_rows, GROUP_COLUMNS))
+
+
+models = [
+    CensoringModel(
+        name="artificial",
+        outcome="uncensored",
+        at_risk="censoring_at_risk",
+        terms=("tend", *(term for term, _ in splines), "period", *covars),
+        categorical=("tend", "period"),
+        strata="trial",
+        splines=splines,
+    )
+]
+if {"out_date_dereg", "baseline_date"} <= set(columns):
+    models.append(
+        CensoringModel(
+            name="dereg",
+            outcome="not_deregistered",
+            at_risk="dereg_at_risk",
+            terms=("tend", "period", *covars),
+            numerator_terms=("tend",),
+            categorical=("tend", "period"),
+        )
+    )
+
+################################################################################
+# 2 Fit models and stream weights
+################################################################################
+weights = CensoringWeights(models, GROUP_COLUMNS).fit(frames)
+if args.truncate:
+    lower, upper = weights.truncation_bounds(frames, args.truncate)
+    print(f"weights truncated to [{lower:.4g}, {upper:.4g}]")
+n_rows = append_arrow((to_arrow(unit_weights(frame)) for frame in weights.stream(frames)), args.output)
+print(f"{n_rows} trial rows with weights written to {args.output}")
+
+################################################################################
+# 3 Save coefficients
+################################################################################
+coefficient_table(weights).to_csv(output_dir / "ipcw_coefficients.csv", index=False)
@@ -0,0 +1,48 @@
+################################################################################
+#
+# Apply the diabetes algorithm directly after extraction
+#
+# This script can be run via an action in project.yaml
+#
+# Vectorised version of diabetes_algo() (analysis/data_import/functions/
+# diabetes_algorithm.R), see analysis/engine/diabetes_algorithm.py. It adds
+# cov_cat_diabetes and cov_bin_t2dm, redefines the cov_date_*dm columns and
+# drops its tmp_ inputs, so process_data.R skips the algorithm (run
+# analysis/data_process.R with dataset_diabetes.arrow as its argument).
+#
+# The output of this script is:
+# - ./output/dataset_diabetes.arrow
+#
+# usage: python analysis/apply_diabetes_algorithm.py [--keep-tmp]
+################################################################################
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.dataset_io import read_dataset, write_dataset
+from engine.diabetes_algorithm import apply_diabetes_algorithm, drop_tmp_columns
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", default="output/dataset.arrow")
+parser.add_argument("--output", default="output/dataset_diabetes.arrow")
+parser.add_argument("--keep-tmp", action="store_true", help="keep the tmp_ inputs of the algorithm in the output")
+args = parser.parse_args()
+
+################################################################################
+# 1 Import data and apply the algorithm
+################################################################################
+data_extracted = read_dataset(args.input)
+data_diabetes = apply_diabetes_algorithm(data_extracted)
+if not args.keep_tmp:
+    data_diabetes = drop_tmp_columns(data_diabetes)
+
+################################################################################
+# 2 Save data
+################################################################################
+write_dataset(data_diabetes, args.output)
+print(data_diabetes["cov_cat_diabetes"].value_counts().to_string())
@@ -0,0 +1,61 @@
+################################################################################
+#
+# Build or update the appointment and vaccination count cubes
+#
+# Daily counts of appointments by status and of vaccinations by target disease,
+# kept as per-patient cumulative counts (see analysis/engine/count_cube.py), so
+# that consultation rates and vaccine counts over any window are read off
+# without scanning the events. Months already in the store are not read again.
+# With --dataset, cov_num_consultation_rate, cov_count_covid_vaccines and
+# cov_date_recent_covid_vaccines of the dataset definition are read off the
+# cubes for the patients (and baseline dates) of the extracted dataset.
+#
+# The output of this script is:
+# - ./output/count_cube/manifest.json, population.npy, <table>__<category>.npz
+# - ./output/count_cube/cube_covariates.arrow (with --dataset)
+#
+# usage: python analysis/build_count_cube.py [--tables example-data]
+#        [--store output/count_cube] [--dataset output/dataset.arrow]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.count_cube import CubeStore, cube_covariates
+from engine.dataset_io import read_dataset, write_dataset
+from engine.sampling import add_sample_arguments, sample_from_args
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables")
+parser.add_argument("--store", default="output/count_cube")
+parser.add_argument("--dataset", default=None, help="extracted dataset (patient_id, baseline_date) to add the covariates for")
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+################################################################################
+# 1 Update the store
+################################################################################
+store = CubeStore(args.store)
+added = store.update(args.tables)
+for table, months in added.items():
+    print(f"{table}: {len(months)} months added ({months[0]} to {months[-1]})")
+if not added:
+    print("no new months")
+
+################################################################################
+# 2 Covariates of the extracted patients
+################################################################################
+if args.dataset:
+    study_dates = json.loads(Path("analysis/design/study-dates.json").read_text())
+    baseline = read_dataset(args.dataset, columns=["patient_id", "baseline_date"])
+    covariates = cube_covariates(store, baseline["patient_id"], baseline["baseline_date"], study_dates["studystart_date"])
+    write_dataset(covariates, Path(args.store) / "cube_covariates.arrow")
+    print(f"covariates of {len(covariates)} patients written to {Path(args.store) / 'cube_covariates.arrow'}")
@@ -0,0 +1,74 @@
+################################################################################
+#
+# Metformin exposure episodes for the per-protocol analysis
+#
+# Joins the metformin prescriptions (metformin_codes) of the medications table
+# into continuous episodes with an assumed supply and a permissible gap, and
+# flags discontinuation and switching to a non-metformin antidiabetic drug
+# (non_metformin_dmd), see analysis/engine/exposure_episodes.py.
+#
+# The output of this script is:
+# - ./output/data/exposure_episodes.arrow (one row per episode)
+#
+# usage: python analysis/build_exposure_episodes.py [--tables example-data]
+#        [--supply-days 28] [--grace-days 30]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.codelist_registry import load_codes, parse_codelists
+from engine.dataset_io import write_dataset
+from engine.event_store import EventStore
+from engine.exposure_episodes import GRACE_DAYS, SUPPLY_DAYS, build_episodes
+from engine.sampling import add_sample_arguments, sample_from_args
+from engine.tables import read_table
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables")
+parser.add_argument("--supply-days", type=int, default=SUPPLY_DAYS, help="days covered by one prescription")
+parser.add_argument("--grace-days", type=int, default=GRACE_DAYS, help="permissible gap between supplies")
+parser.add_argument("--output", default="output/data/exposure_episodes.arrow")
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+study_dates = json.loads(Path("analysis/design/study-dates.json").read_text())
+
+################################################################################
+# 1 Build episodes
+################################################################################
+start = time.perf_counter()
+registry = parse_codelists()
+medications = read_table("medications", args.tables)
+medications["dmd_code"] = medications["dmd_code"].astype("string").str.strip()
+population = np.unique(medications["patient_id"].to_numpy(dtype="int64"))
+store = EventStore.from_frame(medications, population)
+episodes = build_episodes(
+    store.matching("dmd_code", load_codes(registry["metformin_codes"])),
+    store.matching("dmd_code", load_codes(registry["non_metformin_dmd"])),
+    followup_end=study_dates["followupend_date"],
+    supply_days=args.supply_days,
+    grace_days=args.grace_days,
+)
+print(
+    f"{len(episodes)} episodes of {episodes['patient_id'].nunique()} patients "
+    f"({int(episodes['discontinued'].sum())} discontinued, {int(episodes['switched'].sum())} switched) "
+    f"built in {time.perf_counter() - start:.2f}s"
+)
+
+################################################################################
+# 2 Save output
+################################################################################
+Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+write_dataset(episodes, args.output)
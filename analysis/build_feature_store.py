@@ -0,0 +1,46 @@
+################################################################################
+#
+# Build or update the patient x codelist feature store
+#
+# Matches of every codelist of analysis/codelists.py in the source tables, kept
+# as per-patient CSR arrays (see analysis/engine/feature_store.py). Only new
+# codelists and codelists whose sha changed are rebuilt, unless the source
+# tables changed. Event tables that no column of the dataset definition reads
+# are not scanned (see analysis/engine/dependencies.py).
+#
+# The output of this script is:
+# - ./output/feature_store/manifest.json, population.npy, <codelist>.npz
+#
+# usage: python analysis/build_feature_store.py [--tables example-data]
+#        [--store output/feature_store] [--definition analysis/dataset_definition.py]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.codelist_registry import parse_codelists
+from engine.dependencies import DependencyGraph
+from engine.feature_store import FeatureStore
+from engine.sampling import add_sample_arguments, sample_from_args
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables")
+parser.add_argument("--store", default="output/feature_store")
+parser.add_argument("--definition", default="analysis/dataset_definition.py")
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+################################################################################
+# 1 Update the store
+################################################################################
+registry = parse_codelists()
+store = FeatureStore(args.store)
+changes = store.update(registry, args.tables, DependencyGraph(args.definition, registry))
+print(f"{len(changes['built'])} codelists built, {len(changes['removed'])} removed")
@@ -0,0 +1,63 @@
+################################################################################
+#
+# Exclusion counts for the cohort flowchart
+#
+# Bitmap version of calc_n_excluded.R and quality_assurance.R (see
+# analysis/engine/bitmaps.py): marginal and sequential counts of the quality
+# assurance and eligibility criteria, optionally for a reviewer's choice of
+# criteria and for every ordering of them. The counts follow the filters data_process.R
+# applies: the stricter qa_bin_was_alive (not dead by baseline_date) and no QA rule 4,
+# which excludes nobody there (see the criteria in analysis/engine/bitmaps.py).
+#
+# The output of this script is:
+# - ./output/data_properties/n_excluded_marginal.csv
+# - ./output/data_properties/n_excluded_sequential.csv
+# - ./output/data_properties/n_excluded_only.csv
+# - ./output/data_properties/n_excluded_orderings.csv (with --all-orderings)
+#
+# usage: python analysis/calc_n_excluded.py [--input output/dataset_diabetes.arrow]
+#        [--criteria qa_bin_was_adult cov_bin_t2dm ...] [--all-orderings]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.bitmaps import ELIGIBILITY_CRITERIA, QA_CRITERIA, Flowchart
+from engine.dataset_io import read_dataset
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", default="output/dataset_diabetes.arrow")
+parser.add_argument("--criteria", nargs="*", default=None, help="criteria to apply, in this order (default: QA, then eligibility)")
+parser.add_argument("--all-orderings", action="store_true", help="sequential counts for every ordering of the criteria")
+parser.add_argument("--output", default="output/data_properties")
+args = parser.parse_args()
+
+output_dir = Path(args.output)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Pack criteria into bitmaps
+################################################################################
+data = read_dataset(args.input)
+start = time.perf_counter()
+# criteria without their columns in the input (e.g. the flowchart dataset) are left out
+flowchart = Flowchart.from_frame(data, QA_CRITERIA + ELIGIBILITY_CRITERIA, skip_missing=True)
+print(f"{len(flowchart.names)} criteria packed for {flowchart.n} patients in {time.perf_counter() - start:.3f}s")
+names = flowchart.names if args.criteria is None else args.criteria
+
+################################################################################
+# 2 Count exclusions
+################################################################################
+start = time.perf_counter()
+flowchart.marginal(names).to_csv(output_dir / "n_excluded_marginal.csv", index=False)
+flowchart.sequential(names).to_csv(output_dir / "n_excluded_sequential.csv", index=False)
+flowchart.excluded_only_by(names).to_csv(output_dir / "n_excluded_only.csv", index=False)
+if args.all_orderings:
+    flowchart.all_orderings(names).to_csv(output_dir / "n_excluded_orderings.csv", index=False)
+print(f"counts in {time.perf_counter() - start:.3f}s")
@@ -0,0 +1,115 @@
+################################################################################
+#
+# Clone-censor-weight emulation of the metformin-within-grace-period trial
+#
+# Every eligible patient is cloned into the treated arm (metformin within the
+# grace period, baseline_date + 6 days) and the untreated arm, each clone is
+# censored when it deviates from its arm, and the artificial censoring is
+# undone by inverse-probability-of-censoring weights (see
+# analysis/engine/clones.py and analysis/engine/censoring_weights.py). The
+# clones are ids over the patient rows of the memory-mapped dataset; their
+# person-day rows are built chunk by chunk of patients for every pass of the
+# censoring models, and streamed to the output with the weights.
+#
+# The output of this script is:
+# - ./output/data/data_clones_ipcw.arrow (person-day rows of the clones, w_* and w)
+# - ./output/clones/clones_summary.csv (clones, deviations and events per arm)
+# - ./output/clones/ipcw_coefficients.csv
+#
+# usage: python analysis/clone_censor_weight.py [--input output/dataset_diabetes.arrow]
+#        [--grace-days 6] [--truncate 1 99] [--chunk-patients 100000]
+################################################################################
+import argparse
+import sys
+from pathlib import Path
+
+import numpy as np
+import pyarrow as pa
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.bitmaps import ELIGIBILITY_CRITERIA, QA_CRITERIA, Flowchart
+from engine.censoring_weights import CensoringModel, CensoringWeights, coefficient_table, read_covars
+from engine.clones import Clones
+from engine.dataset_io import to_arrow
+from engine.streaming import append_arrow
+from engine.survival import PRIMARY_COLUMNS, primary_follow_up
+
+STUDY_WINDOW_DAYS = 28
+TREAT_WINDOW_DAYS = 6  # grace period 7 days (baseline_date + 6)
+GROUP_COLUMNS = ["patient_id", "arm"]
+OUTPUT_COLUMNS = GROUP_COLUMNS + ["day", "status", "deviated"]
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", default="output/dataset_diabetes.arrow")
+parser.add_argument("--output", default="output/data/data_clones_ipcw.arrow")
+parser.add_argument("--grace-days", type=int, default=TREAT_WINDOW_DAYS, help="last day of the grace period")
+parser.add_argument("--truncate", type=float, nargs=2, default=None, metavar=("LOWER", "UPPER"),
+                    help="truncate the weights at these percentiles")
+parser.add_argument("--chunk-patients", type=int, default=100_000)
+args = parser.parse_args()
+
+output_dir = Path("output/clones")
+output_dir.mkdir(parents=True, exist_ok=True)
+Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Trial patients and their clones
+################################################################################
+table = pa.ipc.open_file(pa.memory_map(args.input)).read_all()
+criteria = QA_CRITERIA + ELIGIBILITY_CRITERIA
+needed = {column for criterion in criteria for column in criterion.columns}
+needed |= {"patient_id", "exp_date_first_metfin", *PRIMARY_COLUMNS}
+data = table.select([name for name in table.column_names if name in needed]).to_pandas(date_as_object=False)
+flowchart = Flowchart.from_frame(data, criteria, skip_missing=True)
+rows = np.flatnonzero(flowchart.meeting(flowchart.names).to_bool())
+data = data.iloc[rows].reset_index(drop=True)
+
+fu_time, status = primary_follow_up(data, STUDY_WINDOW_DAYS)
+clones = Clones.from_frame(table, data, fu_time, status, args.grace_days, rows)
+summary = clones.summary()
+print(summary.to_string(index=False))
+
+covars = read_covars(table.column_names)
+
+
+def frames():
+    return clones.chunks(covars, args.chunk_patients)
+
+
+################################################################################
+# 2 Fit censoring models and stream weights
+################################################################################
+models = [
+    CensoringModel(
+        name="untreated",
+        outcome="uncensored",
+        at_risk="at_risk_untreated",
+        terms=("day", *covars),
+        categorical=("day",),
+    ),
+    CensoringModel(
+        name="treated",
+        outcome="uncensored",
+        at_risk="at_risk_treated",
+        terms=tuple(covars),
+    ),
+]
+weights = CensoringWeights(models, GROUP_COLUMNS).fit(frames)
+if args.truncate:
+    lower, upper = weights.truncation_bounds(frames, args.truncate)
+    print(f"weights truncated to [{lower:.4g}, {upper:.4g}]")
+weight_columns = [f"w_{model.name}" for model in models] + ["w"]
+n_rows = append_arrow(
+    (to_arrow(frame[OUTPUT_COLUMNS + weight_columns]) for frame in weights.stream(frames)), args.output
+)
+print(f"{n_rows} clone-day rows with weights written to {args.output}")
+
+################################################################################
+# 3 Save summary and coefficients
+################################################################################
+summary.to_csv(output_dir / "clones_summary.csv", index=False)
+coefficient_table(weights).to_csv(output_dir / "ipcw_coefficients.csv", index=False)
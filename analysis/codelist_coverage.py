@@ -0,0 +1,80 @@
+################################################################################
+#
+# Code frequencies and codelist coverage
+#
+# This script can be run via an action in project.yaml
+#
+# Streams clinical_events, medications and hospital_admissions once, in chunks,
+# and reports for every codelist of analysis/codelists.py which of its codes
+# occur (events and distinct patients) in the code columns the dataset
+# definition matches it against, see analysis/engine/code_frequencies.py.
+# Codes in no codelist are summarised as an approximate top-k per code column.
+# All counts are redacted (analysis/engine/disclosure.py) before they are
+# written: counts of 1 to the redaction threshold are suppressed, with the
+# next smallest code of the codelist where needed, and all others rounded.
+#
+# The output of this script is:
+# - ./output/codelist_coverage/codelist_coverage.csv (one row per codelist)
+# - ./output/codelist_coverage/code_counts.csv (one row per codelist code)
+# - ./output/codelist_coverage/top_other_codes.csv
+# - ./output/codelist_coverage/redaction_log.csv
+#
+# usage: python analysis/codelist_coverage.py [--tables example-data]
+#        [--chunk-rows 1000000] [--top-k 100]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.code_frequencies import code_columns, stream_code_frequencies
+from engine.codelist_registry import load_codelists, parse_codelists
+from engine.dependencies import DependencyGraph
+from engine.disclosure import read_thresholds, redact_release
+from engine.sampling import add_sample_arguments, sample_from_args
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables")
+parser.add_argument("--definition", default="analysis/dataset_definition.py")
+parser.add_argument("--chunk-rows", type=int, default=1_000_000)
+parser.add_argument("--top-k", type=int, default=100, help="codes in no codelist reported per code column")
+parser.add_argument("--output", default="output/codelist_coverage")
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+output_dir = Path(args.output)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Count codes
+################################################################################
+registry = parse_codelists()
+codelists = load_codelists(registry)
+columns = code_columns(DependencyGraph(args.definition, registry), codelists)
+unmatched = [name for name, matched in columns.items() if not matched]
+if unmatched:
+    print(f"not matched against an event table by the definition: {', '.join(unmatched)}")
+frequencies = stream_code_frequencies(
+    codelists, args.tables, chunk_rows=args.chunk_rows, top_k_capacity=10 * args.top_k, columns=columns
+)
+
+################################################################################
+# 2 Redact and save output
+################################################################################
+tables = {
+    "codelist_coverage.csv": frequencies.coverage(),
+    "code_counts.csv": frequencies.code_counts(),
+    "top_other_codes.csv": frequencies.top_other_codes(args.top_k),
+}
+redacted, log, refused = redact_release(tables, **read_thresholds())
+if refused:
+    raise ValueError(f"tables that cannot be published: {refused}")
+for file, table in redacted.items():
+    table.to_csv(output_dir / file, index=False)
+log.to_csv(output_dir / "redaction_log.csv", index=False)
@@ -182,7 +182,7 @@ def has_prior_prescription_date(codelist, where=True):
     )
 
 ## 2y BEFORE BASELINE DATE 
-# Most recent value (clinical_events table)
+# Maximum value (clinical_events table); NB: not the most recent value, see last_value in engine/lab_values.py
 recent_value_2y = clinical_events.where(clinical_events.date.is_on_or_between(baseline_date - days(2*366), baseline_date)) # Calculated from 1 year = 365.25 days, taking into account leap years. 
 def recent_value_2y_snomed(codelist, where=True): # snomed codelist
     return (
@@ -0,0 +1,84 @@
+#######################################################################################
+# Dataset definition, loaded from a precompiled snapshot
+#######################################################################################
+# Drop-in for analysis/dataset_definition.py when iterating on dummy data:
+#   ehrql generate-dataset analysis/dataset_definition_snapshot.py [-- <definition args>]
+# The first run executes dataset_definition.py (numpy, codelists, study dates, the
+# whole query graph) and pickles the built `dataset` into output/snapshot/; later runs
+# load the pickle instead, as long as the snapshot key still matches. The key hashes
+# the definition, its helper modules, study-dates.json, the codelist manifest, the
+# codelist CSVs read by codelist_from_csv(), the ehrQL version and the user
+# arguments. Startup time is reported in both modes. `--rebuild-snapshot` forces
+# a rebuild.
+import hashlib
+import pickle
+import sys
+import time
+from pathlib import Path
+
+start = time.perf_counter()
+
+## files the built dataset depends on
+SNAPSHOT_SOURCES = [
+    "analysis/dataset_definition.py",
+    "analysis/codelists.py",
+    "analysis/study_definition_helper_functions.py",
+    "analysis/design/study-dates.json",
+    "codelists/codelists.json",
+    *sorted(str(path) for path in Path("codelists").glob("*.csv")),
+]
+SNAPSHOT_DIR = Path("output/snapshot")
+
+rebuild = "--rebuild-snapshot" in sys.argv
+user_args = sorted(arg for arg in sys.argv[1:] if arg != "--rebuild-snapshot")
+
+
+def ehrql_version() -> str:
+    # a pickled Dataset is only valid for the ehrQL version that built it
+    try:
+        import ehrql
+    except ImportError:
+        return "none"
+    version = getattr(ehrql, "__version__", None)
+    if version is None:
+        from importlib import metadata
+
+        try:
+            version = metadata.version("ehrql")
+        except metadata.PackageNotFoundError:
+            version = "unknown"
+    return str(version)
+
+
+def snapshot_key(sources=SNAPSHOT_SOURCES, args=()) -> str:
+    digest = hashlib.sha256(f"ehrql {ehrql_version()}".encode())
+    for source in sources:
+        digest.update(source.encode())
+        digest.update(Path(source).read_bytes() if Path(source).exists() else b"")
+    digest.update("\0".join(args).encode())
+    return digest.hexdigest()
+
+
+snapshot = SNAPSHOT_DIR / f"dataset_definition-{snapshot_key(args=user_args)[:16]}.pickle"
+
+if snapshot.exists() and not rebuild:
+    dataset = pickle.loads(snapshot.read_bytes())
+    mode = f"loaded from snapshot {snapshot}"
+else:
+    import dataset_definition
+
+    dataset = dataset_definition.dataset
+    mode = "built from analysis/dataset_definition.py"
+    # deep query graphs recurse further than the default limit while pickling
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 20_000))
+    try:
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        snapshot.write_bytes(pickle.dumps(dataset, protocol=pickle.HIGHEST_PROTOCOL))
+        mode += f", snapshot written to {snapshot}"
+    except (OSError, pickle.PicklingError, TypeError, AttributeError) as error:
+        mode += f", no snapshot written ({error})"
+    finally:
+        sys.setrecursionlimit(limit)
+
+print(f"dataset definition {mode} in {time.perf_counter() - start:.2f}s", file=sys.stderr)
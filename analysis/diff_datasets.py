@@ -0,0 +1,52 @@
+################################################################################
+#
+# Which patients and columns changed between two dataset extractions
+#
+# Streaming sort-merge of two dataset.arrow files on patient_id (see
+# analysis/engine/dataset_diff.py): per column the number of changed values
+# and sample patient_ids, per _cat_ / _bin_ column the transitions between
+# old and new values, and the patients in only one of the two files.
+#
+# The output of this script is:
+# - ./output/diff/diff_columns.csv (one row per column)
+# - ./output/diff/diff_transitions.csv (column, old, new, n)
+#
+# usage: python analysis/diff_datasets.py --old output/dataset_old.arrow
+#        [--new output/dataset.arrow] [--samples 10]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.dataset_diff import diff_datasets
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--old", required=True, help="earlier extraction")
+parser.add_argument("--new", default="output/dataset.arrow")
+parser.add_argument("--samples", type=int, default=10, help="patient_ids to list per changed column")
+parser.add_argument("--output", default="output/diff")
+args = parser.parse_args()
+
+output_dir = Path(args.output)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Diff
+################################################################################
+start = time.perf_counter()
+diff = diff_datasets(args.old, args.new, n_samples=args.samples)
+summary = diff.summary()
+changed = summary[summary["status"] != "same"]
+print(f"{len(changed)} of {len(summary)} columns differ ({time.perf_counter() - start:.2f}s)")
+
+################################################################################
+# 2 Save output
+################################################################################
+summary.to_csv(output_dir / "diff_columns.csv", index=False)
+diff.transition_table().to_csv(output_dir / "diff_transitions.csv", index=False)
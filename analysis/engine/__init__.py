@@ -0,0 +1,8 @@
+"""
+local Python engine for the source tables used by analysis/dataset_definition.py
+
+The ehrQL backend evaluates the dataset definition in production. The modules
+in this package work on the same source tables (e.g. the dummy tables in
+example-data/) for fast local iterations and for the per-patient stages that
+follow the extraction.
+"""
@@ -0,0 +1,336 @@
+#######################################################################################
+# Bitmaps over patient positions and the cohort flowchart engine
+#######################################################################################
+# Each criterion (completeness, inclusion, exclusion, quality assurance) is packed once
+# into a plain bitmap of 64-bit words over patient positions. Sequential and marginal
+# exclusion counts are then AND / ANDNOT / popcount over ~n/64 words instead of
+# repeated filtering of the data frame (calc_n_excluded.R, quality_assurance.R), and
+# the number remaining after a set of criteria does not depend on the order they are
+# applied in, so counts are cached per subset and any ordering is a lookup.
+from dataclasses import dataclass
+from datetime import date
+from itertools import permutations
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+
+WORD_BITS = 64
+
+# set bits of every byte value, for popcounts on numpy < 2.0 (no np.bitwise_count)
+BYTE_COUNTS = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype("int64")
+
+
+def popcount(words) -> int:
+    if hasattr(np, "bitwise_count"):
+        return int(np.bitwise_count(words).sum(dtype="int64"))
+    return int(BYTE_COUNTS[np.ascontiguousarray(words).view(np.uint8)].sum())
+
+
+class Bitmap:
+    """
+    fixed-length bitmap over patient positions 0..n-1, bits beyond n are zero
+    """
+
+    __slots__ = ("words", "n")
+
+    def __init__(self, words, n):
+        self.words = words
+        self.n = n
+
+    @classmethod
+    def from_bool(cls, values):
+        values = np.asarray(values, dtype=bool)
+        n = len(values)
+        padded = np.zeros(-(-n // WORD_BITS) * WORD_BITS, dtype=bool)
+        padded[:n] = values
+        words = np.packbits(padded, bitorder="little").view("<u8")
+        return cls(words, n)
+
+    @classmethod
+    def ones(cls, n):
+        return ~cls(np.zeros(-(-n // WORD_BITS), dtype="<u8"), n)
+
+    def to_bool(self):
+        bits = np.unpackbits(self.words.view(np.uint8), bitorder="little")
+        return bits[: self.n].astype(bool)
+
+    def positions(self):
+        return np.flatnonzero(self.to_bool())
+
+    def count(self) -> int:
+        return popcount(self.words)
+
+    def andnot(self, other):
+        return Bitmap(self.words & ~other.words, self.n)
+
+    def __and__(self, other):
+        return Bitmap(self.words & other.words, self.n)
+
+    def __or__(self, other):
+        return Bitmap(self.words | other.words, self.n)
+
+    def __invert__(self):
+        words = ~self.words
+        tail = self.n % WORD_BITS
+        if tail:
+            words[-1] &= np.uint64((1 << tail) - 1)
+        return Bitmap(words, self.n)
+
+    def __len__(self):
+        return self.n
+
+
+#######################################################################################
+# Criteria as in the R scripts
+#######################################################################################
+@dataclass(frozen=True)
+class Criterion:
+    """
+    a criterion patients have to meet to stay in the cohort; `met` maps the data
+    frame to a boolean array (R's filter() semantics: NA is not met)
+    """
+
+    name: str
+    columns: tuple
+    met: Callable
+
+
+def is_true(column):
+    return Criterion(column, (column,), lambda frame: frame[column].eq(True).fillna(False).to_numpy(dtype=bool))
+
+
+def is_false(column):
+    # exclusion criteria are coded positively, FALSE includes missing in an ehrQL logical
+    return Criterion(column, (column,), lambda frame: frame[column].eq(False).fillna(False).to_numpy(dtype=bool))
+
+
+def not_null(column, name=None):
+    return Criterion(name or column, (column,), lambda frame: frame[column].notna().to_numpy(dtype=bool))
+
+
+def _was_alive(frame):
+    # additional condition since qa_bin_was_alive may not cover all (e.g. pos test came out after death)
+    death = pd.to_datetime(frame["qa_date_of_death"])
+    alive_at_baseline = (death > pd.to_datetime(frame["baseline_date"])) | death.isna()
+    return (frame["qa_bin_was_alive"].eq(True) & alive_at_baseline).fillna(False).to_numpy(dtype=bool)
+
+
+# eligibility criteria in the order applied in data_process.R. qa_bin_was_alive takes
+# the stricter form of its filter there (and of n_is_alive in calc_n_excluded.R):
+# alive and not dead on or before baseline_date. calc_n_excluded.R counts its
+# n_after_exclusion_processing with qa_bin_was_alive == TRUE only, so that count can
+# be larger than the population data_process.R keeps and the sequential counts here
+ELIGIBILITY_CRITERIA = [
+    # completeness criteria
+    Criterion("qa_bin_was_alive", ("qa_bin_was_alive", "qa_date_of_death", "baseline_date"), _was_alive),
+    is_true("qa_bin_is_female_or_male"),
+    is_true("qa_bin_known_imd"),
+    not_null("cov_cat_region", "cov_bin_has_region"),
+    is_true("qa_bin_was_registered"),
+    # inclusion criteria
+    is_true("qa_bin_was_adult"),
+    is_true("cov_bin_t2dm"),
+    not_null("baseline_date", "cov_bin_has_covid_infection"),
+    # exclusion criteria
+    is_false("cov_bin_hosp_baseline"),
+    is_false("cov_bin_metfin_before_baseline"),
+    is_false("cov_bin_metfin_allergy"),
+    is_false("cov_bin_ckd_45"),
+    is_false("cov_bin_liver_cirrhosis"),
+    is_false("cov_bin_metfin_interaction"),
+    is_false("cov_bin_long_covid"),
+]
+
+
+def _birth_year(frame):
+    birth = frame["qa_num_birth_year"]
+    if pd.api.types.is_numeric_dtype(birth):
+        return birth.astype("float64")
+    return pd.to_datetime(birth).dt.year.astype("float64")
+
+
+def _sex(frame, value):
+    return frame["cov_cat_sex"].astype("string").str.lower().eq(value)
+
+
+def _qa_rule(name, columns, met):
+    return Criterion(name, columns, lambda frame: pd.Series(met(frame)).fillna(False).to_numpy(dtype=bool))
+
+
+# quality assurance rules of quality_assurance.R, as kept in data_process.R. Rule 4
+# (date of death on or before 1900-01-01 or after today) is left out: its filter
+# there, death after 1900-01-01 or before today or missing, holds for every date,
+# so it excludes nobody (its marginal count n_dob_invalid is not reproduced)
+QA_CRITERIA = [
+    _qa_rule("qa_yob_known", ("qa_num_birth_year",), lambda f: _birth_year(f).notna()),
+    _qa_rule(
+        "qa_yob_before_yod",
+        ("qa_num_birth_year", "qa_date_of_death"),
+        lambda f: f["qa_date_of_death"].isna() | (_birth_year(f) <= pd.to_datetime(f["qa_date_of_death"]).dt.year),
+    ),
+    _qa_rule(
+        "qa_yob_valid",
+        ("qa_num_birth_year",),
+        lambda f: (_birth_year(f) >= 1793) & (_birth_year(f) <= date.today().year),
+    ),
+    _qa_rule(
+        "qa_no_preg_men",
+        ("cov_cat_sex", "qa_bin_pregnancy"),
+        lambda f: ~_sex(f, "male").fillna(False) | f["qa_bin_pregnancy"].eq(False),
+    ),
+    _qa_rule(
+        "qa_no_hrt_men",
+        ("cov_cat_sex", "qa_bin_hrt", "qa_bin_cocp"),
+        lambda f: ~_sex(f, "male").fillna(False) | f["qa_bin_hrt"].eq(False) | f["qa_bin_cocp"].eq(False),
+    ),
+    _qa_rule(
+        "qa_no_prost_women",
+        ("cov_cat_sex", "qa_bin_prostate_cancer"),
+        lambda f: ~_sex(f, "female").fillna(False) | f["qa_bin_prostate_cancer"].eq(False),
+    ),
+]
+
+
+#######################################################################################
+# Flowchart
+#######################################################################################
+class Flowchart:
+    """
+    criterion bitmaps of one cohort; counts for any subset or ordering of criteria
+    """
+
+    # subsets of up to this many criteria are enumerated by all_orderings()
+    MAX_ORDERING_CRITERIA = 8
+
+    def __init__(self, bitmaps: dict, n: int):
+        self.bitmaps = bitmaps
+        self.n = n
+        self._remaining = {frozenset(): n}
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, criteria=None, skip_missing=False):
+        """
+        pack each criterion met into a bitmap; criteria whose columns are not in
+        the frame raise, or are left out with skip_missing
+        """
+        criteria = ELIGIBILITY_CRITERIA if criteria is None else criteria
+        bitmaps = {}
+        for criterion in criteria:
+            missing = [c for c in criterion.columns if c not in frame.columns]
+            if missing:
+                if skip_missing:
+                    continue
+                raise KeyError(f"criterion {criterion.name} needs missing columns {missing}")
+            bitmaps[criterion.name] = Bitmap.from_bool(criterion.met(frame))
+        return cls(bitmaps, len(frame))
+
+    @property
+    def names(self):
+        return list(self.bitmaps)
+
+    def meeting(self, names) -> Bitmap:
+        """
+        patients meeting all the criteria in `names`
+        """
+        out = Bitmap.ones(self.n)
+        for name in names:
+            out = out & self.bitmaps[name]
+        return out
+
+    def n_remaining(self, names) -> int:
+        key = frozenset(names)
+        if key not in self._remaining:
+            self._remaining[key] = self.meeting(key).count()
+        return self._remaining[key]
+
+    def marginal(self, names=None) -> pd.DataFrame:
+        names = self.names if names is None else list(names)
+        n_met = [self.n_remaining([name]) for name in names]
+        return pd.DataFrame({"criterion": names, "n_met": n_met, "n_not_met": [self.n - n for n in n_met]})
+
+    def sequential(self, names=None) -> pd.DataFrame:
+        """
+        criteria applied in the given order: patients meeting each criterion
+        (marginal), excluded at each step and remaining after it
+        """
+        names = self.names if names is None else list(names)
+        rows = []
+        remaining = Bitmap.ones(self.n)
+        n_before = self.n
+        for i, name in enumerate(names):
+            key = frozenset(names[: i + 1])
+            if key in self._remaining:
+                n_after = self._remaining[key]
+                remaining = None
+            else:
+                if remaining is None:
+                    remaining = self.meeting(names[:i])
+                remaining = remaining & self.bitmaps[name]
+                n_after = self._remaining[key] = remaining.count()
+            rows.append(
+                {
+                    "criterion": name,
+                    "n_met": self.n_remaining([name]),
+                    "n_excluded": n_before - n_after,
+                    "n_remaining": n_after,
+                }
+            )
+            n_before = n_after
+        return pd.DataFrame(rows, columns=["criterion", "n_met", "n_excluded", "n_remaining"])
+
+    def excluded_only_by(self, names=None) -> pd.DataFrame:
+        """
+        patients excluded by this criterion alone (meeting all the others)
+        """
+        names = self.names if names is None else list(names)
+        rows = []
+        for name in names:
+            others = self.meeting([other for other in names if other != name])
+            rows.append({"criterion": name, "n_excluded_only": others.andnot(self.bitmaps[name]).count()})
+        return pd.DataFrame(rows, columns=["criterion", "n_excluded_only"])
+
+    def overlaps(self, names=None) -> pd.DataFrame:
+        """
+        patients not meeting both criteria, for each pair
+        """
+        names = self.names if names is None else list(names)
+        not_met = {name: ~self.bitmaps[name] for name in names}
+        counts = [[(not_met[a] & not_met[b]).count() for b in names] for a in names]
+        return pd.DataFrame(counts, index=names, columns=names)
+
+    def subset_counts(self, names=None) -> dict:
+        """
+        patients remaining after every subset of the criteria, by depth-first
+        enumeration (2^k ANDs, one bitmap per level held at a time)
+        """
+        names = self.names if names is None else list(names)
+
+        def visit(start, chosen, bitmap):
+            for i in range(start, len(names)):
+                subset = chosen | {names[i]}
+                narrowed = bitmap & self.bitmaps[names[i]]
+                self._remaining[subset] = narrowed.count()
+                visit(i + 1, subset, narrowed)
+
+        visit(0, frozenset(), Bitmap.ones(self.n))
+        return {subset: self._remaining[subset] for subset in self._remaining if subset <= set(names)}
+
+    def all_orderings(self, names=None) -> pd.DataFrame:
+        """
+        sequential exclusion counts for every ordering of the criteria, long format
+        """
+        names = self.names if names is None else list(names)
+        if len(names) > self.MAX_ORDERING_CRITERIA:
+            raise ValueError(f"{len(names)} criteria give too many orderings, select at most {self.MAX_ORDERING_CRITERIA}")
+        remaining = self.subset_counts(names)
+        n_met = {name: remaining[frozenset([name])] for name in names}
+        rows = []
+        for i, order in enumerate(permutations(names)):
+            n_before, applied = self.n, frozenset()
+            for step, name in enumerate(order, start=1):
+                applied = applied | {name}
+                n_after = remaining[applied]
+                rows.append((i, step, name, n_met[name], n_before - n_after, n_after))
+                n_before = n_after
+        return pd.DataFrame(rows, columns=["ordering", "step", "criterion", "n_met", "n_excluded", "n_remaining"])
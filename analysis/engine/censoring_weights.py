@@ -0,0 +1,392 @@
+#######################################################################################
+# Inverse-probability-of-censoring weights on expanded person-interval data
+#######################################################################################
+# The expanded trials (one row per patient, trial and interval) are read in chunks
+# that never split a (patient, trial) group, so no pass holds the whole table. The
+# logistic censoring models are fitted by iteratively reweighted least squares with
+# the normal equations (X'WX, X'(y - p)) summed over the chunks: one pass over the
+# file per iteration, memory set by the chunk size and the number of model columns.
+# The weight of an interval is the product, over the previous intervals of its
+# group, of P_num(uncensored) / P_denom(uncensored) (stabilised; P_num = 1 gives the
+# unstabilised weights of add_ipacw.R): a grouped cumulative product over the
+# contiguous rows of each group. Truncation at percentiles takes its bounds from a
+# log-scale histogram of the weights, so the last pass can stream the weights back
+# next to the trial rows.
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+COVARS_FILE = "lib/design/covars_seq_trials.R"
+
+
+def read_covars(columns, path=COVARS_FILE) -> list:
+    """
+    covariates of lib/design/covars_seq_trials.R (commented lines skipped)
+    that are among `columns`
+    """
+    lines = [line for line in Path(path).read_text().splitlines() if not line.strip().startswith("#")]
+    return [name for name in re.findall(r'"(\w+)"', "\n".join(lines)) if name in columns]
+
+
+@dataclass(frozen=True)
+class CensoringModel:
+    """
+    one source of censoring: `outcome` is 1 when the interval ends uncensored,
+    the model is fitted on (and only applies to) the intervals in `at_risk`
+    """
+
+    name: str
+    outcome: str
+    at_risk: str
+    terms: tuple
+    numerator_terms: tuple = ()  # stabilisation model, intercept only by default
+    categorical: tuple = ()  # terms coded as indicators even if numeric (e.g. tend)
+    strata: str = None  # a separate model per value (e.g. trial)
+    splines: tuple = ()  # (term, df) pairs entered as natural cubic splines, ns(term, df)
+
+
+def numeric_values(values: pd.Series) -> np.ndarray:
+    """
+    float values of a numeric or date column (dates as day numbers), NaN if missing
+    """
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        days = values.to_numpy(dtype="datetime64[ns]").astype("datetime64[D]")
+        return np.where(np.isnat(days), np.nan, days.astype("int64").astype("float64"))
+    return values.to_numpy(dtype="float64", na_value=np.nan)
+
+
+def quantile(counts: pd.Series, p: float) -> float:
+    """
+    quantile of the values counted in `counts` (value -> count), interpolated
+    as R's quantile() does by default
+    """
+    counts = counts.sort_index()
+    position = (counts.sum() - 1) * p
+    below, fraction = int(np.floor(position)), position - np.floor(position)
+    cumulative = np.cumsum(counts.to_numpy())
+    values = counts.index.to_numpy(dtype="float64")
+    low = values[np.searchsorted(cumulative, below, side="right")]
+    high = values[np.searchsorted(cumulative, below + 1, side="right")] if fraction > 0 else low
+    return low + fraction * (high - low)
+
+
+def natural_spline(x, knots) -> np.ndarray:
+    """
+    natural cubic spline basis without intercept (the truncated power basis of
+    Hastie et al., Elements of Statistical Learning, 5.2.1) over `knots`,
+    boundary knots included; it spans the same columns as ns() of R with these
+    knots, so the fitted probabilities are the same (the coefficients are not).
+    x is rescaled to [0, 1] between the boundary knots to keep the cubes small
+    """
+    knots = np.asarray(knots, dtype="float64")
+    width = knots[-1] - knots[0] if knots[-1] > knots[0] else 1.0
+    x, knots = (np.asarray(x, dtype="float64") - knots[0]) / width, (knots - knots[0]) / width
+
+    def d(k):
+        return (np.maximum(x - knots[k], 0) ** 3 - np.maximum(x - knots[-1], 0) ** 3) / (knots[-1] - knots[k])
+
+    last = d(len(knots) - 2)
+    return np.column_stack([x] + [d(k) - last for k in range(len(knots) - 2)])
+
+
+class Design:
+    """
+    model matrix of an intercept, numeric terms, natural splines of spline terms
+    and indicators of categorical terms (first level as reference), with the
+    levels and knots fixed across chunks
+    """
+
+    def __init__(self, terms, categorical=(), splines=()):
+        self.terms = list(terms)
+        self.categorical = set(categorical)
+        self.splines = {term: df for term, df in splines if term in self.terms}
+        self.levels = {}
+        self.values = {}  # spline term -> counts of its values, for the knots
+
+    def is_categorical(self, frame, term) -> bool:
+        dtype = frame[term].dtype
+        return term in self.categorical or not (pd.api.types.is_numeric_dtype(dtype) or pd.api.types.is_bool_dtype(dtype))
+
+    def learn(self, frame: pd.DataFrame, rows=None):
+        """
+        levels of the categorical terms, and the values of the spline terms
+        on `rows` (a boolean mask, e.g. the at-risk rows the model is fitted on)
+        """
+        for term in self.terms:
+            if term in self.splines:
+                values = numeric_values(frame[term])
+                values = values[rows] if rows is not None else values
+                counts = pd.Series(values[~np.isnan(values)]).value_counts()
+                self.values[term] = counts.add(self.values.get(term, pd.Series(dtype="float64")), fill_value=0)
+            elif self.is_categorical(frame, term):
+                seen = self.levels.setdefault(term, set())
+                seen.update(frame[term].dropna().unique().tolist())
+
+    def knots(self, term) -> list:
+        """
+        boundary knots at the range and df - 1 interior knots at equally spaced
+        quantiles of the learned values, as ns(term, df) places them
+        """
+        df = self.splines[term]
+        counts = self.values.get(term, pd.Series(dtype="float64"))
+        if not len(counts):
+            return [0.0] * (df + 1)
+        return [quantile(counts, i / df) for i in range(df + 1)]
+
+    def sorted_levels(self, term) -> list:
+        # factor levels of numbers stored as labels ("2" < "10") sort as numbers
+        levels = list(self.levels[term])
+        numbers = pd.to_numeric(pd.Series(levels, dtype=object), errors="coerce")
+        if numbers.notna().all():
+            return [levels[i] for i in np.argsort(numbers.to_numpy(), kind="stable")]
+        return sorted(levels, key=str)
+
+    @property
+    def columns(self) -> list:
+        names = ["(Intercept)"]
+        for term in self.terms:
+            if term in self.splines:
+                names += [f"ns({term}, {self.splines[term]}){i}" for i in range(1, self.splines[term] + 1)]
+            elif term in self.levels:
+                names += [f"{term}{level}" for level in self.sorted_levels(term)[1:]]
+            else:
+                names.append(term)
+        return names
+
+    def matrix(self, frame: pd.DataFrame):
+        """
+        (X, complete): rows with a missing term are not complete and are left
+        out of the fit, as in glm()
+        """
+        n = len(frame)
+        blocks = [np.ones((n, 1))]
+        complete = np.ones(n, dtype=bool)
+        for term in self.terms:
+            values = frame[term]
+            complete &= values.notna().to_numpy()
+            if term in self.splines:
+                block = natural_spline(np.nan_to_num(numeric_values(values)), self.knots(term))
+            elif term in self.levels:
+                levels = self.sorted_levels(term)
+                codes = pd.Categorical(values, categories=levels).codes
+                block = np.zeros((n, len(levels) - 1))
+                has = codes > 0
+                block[np.flatnonzero(has), codes[has] - 1] = 1.0
+            else:
+                block = values.to_numpy(dtype="float64", na_value=np.nan)[:, None]
+            blocks.append(block)
+        return np.nan_to_num(np.hstack(blocks)), complete
+
+
+def expit(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+class LogisticFit:
+    """
+    logistic model of `outcome` over the rows flagged in `rows` (per stratum;
+    key None without strata), fitted by IRLS: accumulate() every chunk, then
+    step(), until converged
+    """
+
+    def __init__(self, design: Design, outcome: str, rows: str, strata=None, tol=1e-8, ridge=1e-8):
+        self.design, self.outcome, self.rows, self.strata = design, outcome, rows, strata
+        self.tol, self.ridge = tol, ridge
+        self.betas, self.converged = {}, False
+        self.hessian, self.gradient = {}, {}
+
+    def accumulate(self, frame: pd.DataFrame):
+        x, complete = self.design.matrix(frame)
+        use = frame[self.rows].fillna(False).to_numpy(dtype=bool) & complete & frame[self.outcome].notna().to_numpy()
+        y = frame[self.outcome].to_numpy(dtype="float64", na_value=np.nan)
+        keys = stratum_keys(frame, self.strata)
+        for key in pd.unique(keys[use]):
+            select = use & (keys == key)
+            xs = x[select]
+            p = expit(xs @ self.betas.setdefault(key, np.zeros(x.shape[1])))
+            w = p * (1 - p)
+            self.hessian[key] = self.hessian.get(key, 0) + xs.T @ (xs * w[:, None])
+            self.gradient[key] = self.gradient.get(key, 0) + xs.T @ (y[select] - p)
+
+    def step(self) -> bool:
+        largest = 0.0
+        for key, hessian in self.hessian.items():
+            beta = self.betas[key]
+            # a small ridge keeps separated or empty indicator columns finite
+            step = np.linalg.solve(hessian + self.ridge * np.eye(len(beta)), self.gradient[key] - self.ridge * beta)
+            self.betas[key] = beta + step
+            largest = max(largest, np.max(np.abs(step)))
+        self.hessian, self.gradient = {}, {}
+        self.converged = largest < self.tol
+        return self.converged
+
+
+def fit_logistic(frames, fits: list, max_iter=25) -> list:
+    """
+    fit several LogisticFit together, with one pass over the chunks per
+    iteration; `frames` is a callable returning a fresh iterator over them
+    """
+    for _ in range(max_iter):
+        pending = [fit for fit in fits if not fit.converged]
+        if not pending:
+            break
+        for frame in frames():
+            for fit in pending:
+                fit.accumulate(frame)
+        for fit in pending:
+            fit.step()
+    return fits
+
+
+def stratum_keys(frame: pd.DataFrame, strata=None) -> np.ndarray:
+    return frame[strata].to_numpy() if strata else np.full(len(frame), None)
+
+
+def predict(betas: dict, design: Design, frame: pd.DataFrame, strata=None):
+    """
+    P(outcome = 1) per row, NaN for incomplete rows and unseen strata
+    """
+    x, complete = design.matrix(frame)
+    keys = stratum_keys(frame, strata)
+    p = np.full(len(frame), np.nan)
+    for key, beta in betas.items():
+        select = complete & (keys == key)
+        p[select] = expit(x[select] @ beta)
+    return p
+
+
+def group_starts(frame: pd.DataFrame, group_columns) -> np.ndarray:
+    """
+    first row of every run of rows with equal values of `group_columns`
+    """
+    starts = np.ones(len(frame), dtype=bool)
+    starts[1:] = False
+    for column in group_columns:
+        values = frame[column]
+        values = values.cat.codes.to_numpy() if isinstance(values.dtype, pd.CategoricalDtype) else values.to_numpy()
+        starts[1:] |= values[1:] != values[:-1]
+    return starts
+
+
+def lagged_cumprod(values, starts) -> np.ndarray:
+    """
+    per group of contiguous rows, the product of `values` over the previous
+    rows of the group (1 on the first row), through cumulative sums of logs
+    """
+    logs = np.log(values)
+    total = np.cumsum(logs) - logs
+    first = np.maximum.accumulate(np.where(starts, np.arange(len(values)), 0))
+    return np.exp(total - total[first])
+
+
+class LogHistogram:
+    """
+    counts of positive values in bins of log(value) (width 0.001, i.e. 0.1%
+    relative) over a fixed range, for quantiles of a stream of weights
+    """
+
+    EDGES = np.linspace(-30.0, 30.0, 60_001)
+
+    def __init__(self):
+        self.counts = np.zeros(len(self.EDGES) + 1, dtype="int64")
+
+    def add(self, values):
+        values = np.asarray(values, dtype="float64")
+        values = values[values > 0]
+        self.counts += np.bincount(np.searchsorted(self.EDGES, np.log(values)), minlength=len(self.counts))
+
+    def quantile(self, q: float) -> float:
+        total = self.counts.sum()
+        if total == 0:
+            return np.nan
+        position = int(np.searchsorted(np.cumsum(self.counts), q * total, side="left"))
+        return float(np.exp(self.EDGES[min(max(position, 1), len(self.EDGES)) - 1]))
+
+
+class CensoringWeights:
+    """
+    fits the censoring models of a stream of person-interval chunks and adds
+    the weights: w_<model> per model and w, their product (truncated)
+    """
+
+    def __init__(self, models, group_columns=("patient_id", "trial")):
+        self.models = list(models)
+        self.group_columns = list(group_columns)
+        self.designs = {
+            model.name: (
+                Design(model.terms, model.categorical, model.splines),
+                Design(model.numerator_terms, model.categorical, model.splines),
+            )
+            for model in self.models
+        }
+        self.coefficients = {}
+        self.bounds = None
+
+    def fit(self, frames, max_iter=25):
+        for frame in frames():
+            for model in self.models:
+                at_risk = frame[model.at_risk].fillna(False).to_numpy(dtype=bool)
+                for design in self.designs[model.name]:
+                    design.learn(frame, at_risk)
+        fits = {
+            model.name: [LogisticFit(design, model.outcome, model.at_risk, model.strata) for design in self.designs[model.name]]
+            for model in self.models
+        }
+        fit_logistic(frames, [fit for pair in fits.values() for fit in pair], max_iter)
+        self.coefficients = {name: tuple(fit.betas for fit in pair) for name, pair in fits.items()}
+        return self
+
+    def weights(self, frame: pd.DataFrame, truncate=True) -> pd.DataFrame:
+        """
+        `frame` with the weight columns; intervals outside a model's at-risk
+        set (or with missing covariates) do not change that model's weight
+        """
+        out = frame.copy()
+        starts = group_starts(frame, self.group_columns)
+        total = np.ones(len(frame))
+        for model in self.models:
+            denominator, numerator = self.designs[model.name]
+            denominator_coef, numerator_coef = self.coefficients[model.name]
+            ratio = predict(numerator_coef, numerator, frame, model.strata) / predict(
+                denominator_coef, denominator, frame, model.strata
+            )
+            at_risk = frame[model.at_risk].fillna(False).to_numpy(dtype=bool)
+            ratio = np.where(at_risk & np.isfinite(ratio), ratio, 1.0)
+            out[f"w_{model.name}"] = lagged_cumprod(ratio, starts)
+            total *= out[f"w_{model.name}"].to_numpy()
+        if truncate and self.bounds is not None:
+            total = np.clip(total, *self.bounds)
+        out["w"] = total
+        return out
+
+    def truncation_bounds(self, frames, percentiles=(1, 99)) -> tuple:
+        """
+        weights at the given percentiles (one more pass over the chunks); the
+        weights of weights() and stream() are clipped to them from then on
+        """
+        histogram = LogHistogram()
+        for frame in frames():
+            histogram.add(self.weights(frame, truncate=False)["w"])
+        self.bounds = tuple(histogram.quantile(p / 100) for p in percentiles)
+        return self.bounds
+
+    def stream(self, frames):
+        for frame in frames():
+            yield self.weights(frame)
+
+
+def coefficient_table(weights: CensoringWeights) -> pd.DataFrame:
+    """
+    fitted coefficients of every model: model, part (denominator/numerator),
+    stratum, term, estimate
+    """
+    tables = [
+        pd.DataFrame({"model": model.name, "part": part, "stratum": stratum, "term": design.columns, "estimate": beta})
+        for model in weights.models
+        for part, design, betas in zip(("denominator", "numerator"), weights.designs[model.name], weights.coefficients[model.name])
+        for stratum, beta in betas.items()
+    ]
+    return pd.concat(tables, ignore_index=True)
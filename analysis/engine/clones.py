@@ -0,0 +1,131 @@
+#######################################################################################
+# Clone-censor-weight emulation of the metformin-within-grace-period trial
+#######################################################################################
+# Every patient of the trial is cloned into both of its arms: treated (metformin
+# started on or before baseline_date + grace_days) and untreated (no metformin
+# within the grace period). A clone is only an id, 2 * patient + arm, so that the
+# arm is its lowest bit and nothing of the patient is copied. What differs between
+# the arms (the day a clone deviates from its arm, its follow-up time and status)
+# is held as (patients, 2) arrays, computed for both arms at once, whose rows
+# flatten into clone order without a copy. A clone of the untreated arm deviates,
+# and is censored, on the day metformin is started within the grace period; a clone
+# of the treated arm at the end of the grace period if metformin was not started by
+# then. An event on the day of deviation still counts, as events win ties with
+# censoring in follow_up(). The person-day rows that the censoring and outcome
+# models are fitted on are built lazily, one chunk of patients at a time, with the
+# covariates of the chunk taken from the patient table (e.g. the memory-mapped
+# dataset).
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from engine.event_store import EventStore, to_days
+
+ARMS = ("untreated", "treated")  # arm bit 0, 1 of a clone id
+NEVER = np.iinfo(np.int64).max
+
+
+def clone_arm(clones) -> np.ndarray:
+    return np.asarray(clones, dtype="int64") & 1
+
+
+def clone_patient(clones) -> np.ndarray:
+    return np.asarray(clones, dtype="int64") >> 1
+
+
+class Clones:
+    """
+    both clones of every trial patient; `rows` are the rows of `table` (the
+    patient columns) in the trial, `fu_time` and `status` their follow_up()
+    without regard to treatment and `treat_day` the day (since baseline) they
+    started treatment, NULL if never
+    """
+
+    def __init__(self, table: pa.Table, fu_time, status, treat_day, grace_days=6, rows=None):
+        self.table = table
+        self.rows = np.arange(table.num_rows, dtype="int64") if rows is None else np.asarray(rows, dtype="int64")
+        self.grace_days = grace_days
+        fu_time = np.asarray(fu_time, dtype="int64")
+        treat_day = np.asarray(treat_day, dtype="int64")
+        # NULL is negative, so patients never treated are not treated in the grace period
+        self.treated = (treat_day >= 0) & (treat_day <= grace_days)
+        deviation = np.full((len(self.rows), 2), NEVER, dtype="int64")
+        deviation[self.treated, 0] = treat_day[self.treated]
+        deviation[~self.treated, 1] = grace_days
+        self.deviation = deviation
+        self.deviated = deviation < fu_time[:, None]
+        self.time = np.minimum(fu_time[:, None], deviation)
+        self.status = np.where(self.deviated, 0, np.asarray(status, dtype="int64")[:, None])
+
+    @classmethod
+    def from_frame(cls, table: pa.Table, data: pd.DataFrame, fu_time, status, grace_days=6, rows=None):
+        """
+        clones with the day of treatment taken from exp_date_first_metfin and
+        baseline_date of `data` (one row per trial patient)
+        """
+        origin, first = to_days(data["baseline_date"]), to_days(data["exp_date_first_metfin"])
+        missing = (first == EventStore.NULL) | (origin == EventStore.NULL)
+        treat_day = np.where(missing, EventStore.NULL, first - np.where(missing, 0, origin))
+        return cls(table, fu_time, status, treat_day, grace_days, rows)
+
+    @property
+    def n_patients(self) -> int:
+        return len(self.rows)
+
+    def __len__(self):
+        return 2 * self.n_patients
+
+    def summary(self) -> pd.DataFrame:
+        """
+        per arm: clones, clones censored by deviation, events per status
+        """
+        rows = []
+        for arm, name in enumerate(ARMS):
+            row = {"arm": name, "n_clones": self.n_patients, "n_deviated": int(self.deviated[:, arm].sum())}
+            for status, n in zip(*np.unique(self.status[:, arm], return_counts=True)):
+                row[f"n_status_{status}"] = int(n)
+            rows.append(row)
+        return pd.DataFrame(rows).fillna(0)
+
+    def expand(self, start: int, stop: int, columns=()) -> pd.DataFrame:
+        """
+        person-day rows of the clones of trial patients [start, stop): one row
+        per clone and day of follow-up (0 to time), in clone order, with the
+        status and deviation of the clone on its last row, the artificial
+        censoring indicators (at_risk_<arm>, uncensored) and `columns` of the
+        patient table
+        """
+        time = self.time[start:stop].reshape(-1)
+        n_days = np.maximum(time + 1, 0)
+        local = np.repeat(np.arange(len(time)), n_days)
+        day = np.arange(len(local)) - np.repeat(np.cumsum(n_days) - n_days, n_days)
+        last = day == time[local]
+        arm = clone_arm(local)
+        patient = clone_patient(local)
+        deviated = last & self.deviated[start:stop].reshape(-1)[local]
+        rows = pa.array(self.rows[start:stop])
+        frame = pd.DataFrame(
+            {
+                "patient_id": self.table.column("patient_id").take(rows).to_numpy()[patient],
+                "arm": arm,
+                "day": day,
+                "status": np.where(last, self.status[start:stop].reshape(-1)[local], 0),
+                "deviated": deviated,
+                # untreated clones may deviate on any day of the grace period,
+                # treated clones only at its end
+                "at_risk_untreated": (arm == 0) & (day <= self.grace_days),
+                "at_risk_treated": (arm == 1) & (day == self.grace_days),
+                "uncensored": (~deviated).astype("int64"),
+            }
+        )
+        if columns:
+            covariates = self.table.select(list(columns)).take(rows).to_pandas(date_as_object=False)
+            frame = pd.concat([frame, covariates.iloc[patient].reset_index(drop=True)], axis=1)
+        return frame
+
+    def chunks(self, columns=(), chunk_patients=100_000):
+        """
+        expand() of consecutive chunks of patients, so that no chunk splits a clone
+        """
+        for start in range(0, self.n_patients, chunk_patients):
+            yield self.expand(start, min(start + chunk_patients, self.n_patients), columns)
@@ -0,0 +1,280 @@
+#######################################################################################
+# Streaming code frequencies and codelist coverage
+#######################################################################################
+# clinical_events, medications and hospital_admissions are read once, in chunks. Every
+# code column is looked up in an inverted index of all codelist codes (code -> the
+# codelists containing it): codelist codes get exact event counts and distinct
+# patients, every other code goes into an approximate top-k (Misra-Gries summary).
+# A codelist is only counted in the code columns the dataset definition matches it
+# against (DependencyGraph.matched), and an event counts once per codelist however
+# many of its codes match: a hospital admission with E119 among its diagnoses is one
+# event of a codelist holding both E11 and E119, as in FeatureStore.match().
+import numpy as np
+import pandas as pd
+
+from engine.tables import explode_diagnoses, iter_table
+
+# code columns scanned per table; ICD-10 codes come from hospital_admissions.all_diagnoses
+CODE_COLUMNS = {
+    "clinical_events": ["snomedct_code", "ctv3_code"],
+    "medications": ["dmd_code"],
+    "hospital_admissions": ["diagnosis"],
+}
+
+# (table, column) of the dataset definition -> scanned code column
+DEFINITION_COLUMNS = {
+    ("clinical_events", "snomedct_code"): "snomedct_code",
+    ("clinical_events", "ctv3_code"): "ctv3_code",
+    ("medications", "dmd_code"): "dmd_code",
+    ("hospital_admissions", "all_diagnoses"): "diagnosis",
+}
+
+
+def code_columns(graph, names) -> dict:
+    """
+    codelist -> the scanned code columns the definition of `graph` matches it
+    against (empty for codelists it does not match against an event table)
+    """
+    return {
+        name: sorted({DEFINITION_COLUMNS[pair] for pair in graph.matched.get(name, ()) if pair in DEFINITION_COLUMNS})
+        for name in names
+    }
+
+
+class CodeIndex:
+    """
+    inverted index of codelists: code -> position, position -> codelists (CSR)
+    """
+
+    def __init__(self, codelists: dict):
+        self.names = list(codelists)
+        pairs = pd.DataFrame(
+            [(str(code).strip(), i) for i, codes in enumerate(codelists.values()) for code in codes],
+            columns=["code", "codelist"],
+        ).drop_duplicates()
+        pairs = pairs.sort_values(["code", "codelist"], kind="stable")
+        self.codes = pd.Index(pairs["code"].unique())
+        position = self.codes.get_indexer(pairs["code"])
+        self.offsets = np.searchsorted(position, np.arange(len(self.codes) + 1))
+        self.codelist_ids = pairs["codelist"].to_numpy()
+
+    def lookup(self, values) -> np.ndarray:
+        """
+        position of each code in the index, -1 for codes in no codelist
+        """
+        return self.codes.get_indexer(values)
+
+    def codelists_of(self, positions):
+        """
+        (row, codelist id) pairs for an array of code positions
+        """
+        positions = np.asarray(positions)
+        lengths = self.offsets[positions + 1] - self.offsets[positions]
+        rows = np.repeat(np.arange(len(positions)), lengths)
+        starts = np.repeat(self.offsets[positions] - np.cumsum(lengths) + lengths, lengths)
+        return rows, self.codelist_ids[starts + np.arange(len(rows))]
+
+
+class TopK:
+    """
+    Misra-Gries summary of code counts: keeps at most `capacity` codes, each
+    count is a lower bound and at most `error` below the true count
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counts = pd.Series(dtype="int64")
+        self.error = 0
+
+    def update(self, counts: pd.Series):
+        merged = self.counts.add(counts, fill_value=0).astype("int64")
+        if len(merged) > self.capacity:
+            threshold = int(merged.nlargest(self.capacity + 1).iloc[-1])
+            merged = merged[merged > threshold] - threshold
+            self.error += threshold
+        self.counts = merged
+
+    def top(self, k=100) -> pd.DataFrame:
+        top = self.counts.nlargest(k)
+        return pd.DataFrame({"code": top.index, "n_events_min": top.to_numpy(), "max_error": self.error})
+
+
+class DistinctPairs:
+    """
+    exact set of (code position, patient_id) pairs, compacted as it grows
+    """
+
+    def __init__(self):
+        self.parts = []
+        self.n_rows = 0
+        self.n_compacted = 0
+
+    def add(self, positions, patient_ids):
+        part = pd.DataFrame({"position": positions, "patient_id": patient_ids}).drop_duplicates()
+        self.parts.append(part)
+        self.n_rows += len(part)
+        if self.n_rows > 2 * max(self.n_compacted, 1_000_000):
+            self.compact()
+
+    def compact(self) -> pd.DataFrame:
+        frame = pd.concat(self.parts, ignore_index=True).drop_duplicates() if self.parts else pd.DataFrame(
+            {"position": pd.Series([], dtype="int64"), "patient_id": pd.Series([], dtype="int64")}
+        )
+        self.parts = [frame]
+        self.n_rows = self.n_compacted = len(frame)
+        return frame
+
+
+class CodeFrequencies:
+    """
+    exact counts of codelist codes and top-k of all other codes, per code
+    column; `columns` maps a codelist to the code columns it is counted in
+    (default: every column)
+    """
+
+    def __init__(self, codelists: dict, top_k_capacity=1000, columns=None):
+        self.index = CodeIndex(codelists)
+        self.codelists = codelists
+        self.columns = columns
+        self.n_events = {}
+        self.codelist_events = {}
+        self.patients = {}
+        self.others = {}
+        self.top_k_capacity = top_k_capacity
+
+    def _column(self, column):
+        if column not in self.n_events:
+            self.n_events[column] = np.zeros(len(self.index.codes), dtype="int64")
+            self.codelist_events[column] = np.zeros(len(self.index.names), dtype="int64")
+            self.patients[column] = DistinctPairs()
+            self.others[column] = TopK(self.top_k_capacity)
+
+    def counted(self, column) -> np.ndarray:
+        """
+        whether each codelist is counted in `column`
+        """
+        if self.columns is None:
+            return np.ones(len(self.index.names), dtype=bool)
+        return np.array([column in self.columns.get(name, ()) for name in self.index.names])
+
+    def update(self, column, codes: pd.Series, patient_ids: pd.Series, events=None):
+        """
+        count one chunk of a code column; `events` numbers the events the codes
+        belong to (default: one event per code), so that an event with several
+        codes of a codelist counts once for the codelist and for each code
+        """
+        self._column(column)
+        known = codes.notna().to_numpy()
+        codes = codes[known].astype(str).str.strip()
+        patient_ids = patient_ids.to_numpy()[known]
+        events = np.arange(len(known)) if events is None else np.asarray(events)
+        events = events[known]
+        positions = self.index.lookup(codes)
+        matched = positions >= 0
+        per_code = pd.DataFrame({"event": events[matched], "position": positions[matched]}).drop_duplicates()
+        self.n_events[column] += np.bincount(per_code["position"], minlength=len(self.index.codes))
+        rows, codelist_ids = self.index.codelists_of(per_code["position"].to_numpy())
+        per_codelist = pd.DataFrame({"event": per_code["event"].to_numpy()[rows], "codelist": codelist_ids}).drop_duplicates()
+        self.codelist_events[column] += np.bincount(per_codelist["codelist"], minlength=len(self.index.names))
+        self.patients[column].add(positions[matched], patient_ids[matched])
+        self.others[column].update(codes[~matched].value_counts())
+
+    def update_admissions(self, admissions: pd.DataFrame):
+        diagnoses = explode_diagnoses(admissions)
+        # 3-character codelist entries match any code in their category
+        category = diagnoses[diagnoses["diagnosis_3"] != diagnoses["diagnosis"]]
+        category = category[self.index.lookup(category["diagnosis_3"]) >= 0]
+        self.update(
+            "diagnosis",
+            pd.concat([diagnoses["diagnosis"], category["diagnosis_3"]], ignore_index=True),
+            pd.concat([diagnoses["patient_id"], category["patient_id"]], ignore_index=True),
+            np.concatenate([diagnoses["admission_row"], category["admission_row"]]),
+        )
+
+    def code_counts(self) -> pd.DataFrame:
+        """
+        one row per codelist code and code column it is counted in (codes that
+        never occur there get a single row with n_events 0)
+        """
+        frames = []
+        for column, n_events in self.n_events.items():
+            pairs = self.patients[column].compact()
+            n_patients = np.bincount(pairs["position"], minlength=len(self.index.codes))
+            seen = np.flatnonzero(n_events)
+            frames.append(
+                pd.DataFrame(
+                    {"position": seen, "column": column, "n_events": n_events[seen], "n_patients": n_patients[seen]}
+                )
+            )
+        counts = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=["position", "column", "n_events", "n_patients"])
+        rows, codelist_ids = self.index.codelists_of(np.arange(len(self.index.codes)))
+        membership = pd.DataFrame({"position": rows, "codelist_id": codelist_ids})
+        out = membership.merge(counts, on="position", how="left")
+        counted = {column: self.counted(column) for column in self.n_events}
+        keep = np.array([column in counted and counted[column][i] for i, column in zip(out["codelist_id"], out["column"])], dtype=bool)
+        out = out[keep]
+        unseen = membership.merge(out[["position", "codelist_id"]], how="left", indicator=True)
+        out = pd.concat([out, unseen[unseen["_merge"] == "left_only"].drop(columns="_merge")], ignore_index=True)
+        out["codelist"] = np.asarray(self.index.names)[out["codelist_id"].to_numpy(dtype="int64")]
+        out["code"] = self.index.codes[out["position"].to_numpy(dtype="int64")]
+        out[["n_events", "n_patients"]] = out[["n_events", "n_patients"]].fillna(0).astype("int64")
+        return out[["codelist", "code", "column", "n_events", "n_patients"]].sort_values(
+            ["codelist", "n_events", "code"], ascending=[True, False, True], ignore_index=True
+        )
+
+    def coverage(self) -> pd.DataFrame:
+        """
+        per codelist: codes occurring, events and distinct patients over the
+        columns it is counted in
+        """
+        counts = self.code_counts()
+        n_events = np.zeros(len(self.index.names), dtype="int64")
+        pairs = []
+        for column in self.n_events:
+            counted = self.counted(column)
+            n_events += np.where(counted, self.codelist_events[column], 0)
+            column_pairs = self.patients[column].compact()
+            rows, codelist_ids = self.index.codelists_of(column_pairs["position"].to_numpy(dtype="int64"))
+            keep = counted[codelist_ids]
+            pairs.append(pd.DataFrame({"codelist": codelist_ids[keep], "patient_id": column_pairs["patient_id"].to_numpy()[rows[keep]]}))
+        pairs = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame({"codelist": [], "patient_id": []})
+        n_patients = pairs.drop_duplicates().groupby("codelist").size()
+        rows = []
+        for i, name in enumerate(self.index.names):
+            codes = counts[counts["codelist"] == name]
+            seen = codes[codes["n_events"] > 0]
+            n_codes = codes["code"].nunique()
+            rows.append(
+                {
+                    "codelist": name,
+                    "n_codes": n_codes,
+                    "n_codes_seen": seen["code"].nunique(),
+                    "pct_codes_seen": round(100 * seen["code"].nunique() / n_codes, 1) if n_codes else np.nan,
+                    "n_events": int(n_events[i]),
+                    "n_patients": int(n_patients.get(i, 0)),
+                    "columns": ";".join(sorted(seen["column"].unique())),
+                }
+            )
+        return pd.DataFrame(rows)
+
+    def top_other_codes(self, k=100) -> pd.DataFrame:
+        frames = [top.top(k).assign(column=column) for column, top in self.others.items()]
+        if not frames:
+            return pd.DataFrame(columns=["column", "code", "n_events_min", "max_error"])
+        return pd.concat(frames, ignore_index=True)[["column", "code", "n_events_min", "max_error"]]
+
+
+def stream_code_frequencies(codelists: dict, path="example-data", chunk_rows=1_000_000, top_k_capacity=1000, columns=None):
+    """
+    one pass over the coded event tables in chunks
+    """
+    frequencies = CodeFrequencies(codelists, top_k_capacity, columns)
+    for table, columns in CODE_COLUMNS.items():
+        if table == "hospital_admissions":
+            for chunk in iter_table(table, path, ["all_diagnoses"], chunk_rows):
+                frequencies.update_admissions(chunk)
+            continue
+        for chunk in iter_table(table, path, columns, chunk_rows):
+            for column in columns:
+                frequencies.update(column, chunk[column], chunk["patient_id"])
+    return frequencies
@@ -0,0 +1,81 @@
+#######################################################################################
+# Codelists of analysis/codelists.py, read without importing ehrQL
+#######################################################################################
+# codelists.py is parsed statically: every module-level `name = codelist_from_csv(...)`
+# or `name = ["code", ...]` is registered with its CSV file, code column and the
+# sha recorded by `opensafely codelists update` in codelists/codelists.json.
+import ast
+import json
+from dataclasses import dataclass
+from pathlib import Path
+
+import pandas as pd
+
+
+@dataclass(frozen=True)
+class CodelistSpec:
+    name: str
+    file: str = None  # relative to the repository root, None for inline lists
+    column: str = None
+    category_column: str = None
+    inline_codes: tuple = None
+    sha: str = None
+
+
+def parse_codelists(path="analysis/codelists.py", manifest="codelists/codelists.json") -> dict:
+    """
+    registry of codelist name -> CodelistSpec, in the order of codelists.py
+    """
+    tree = ast.parse(Path(path).read_text())
+    shas = {}
+    if Path(manifest).exists():
+        files = json.loads(Path(manifest).read_text()).get("files", {})
+        shas = {file: entry.get("sha") for file, entry in files.items()}
+
+    registry = {}
+    for node in tree.body:
+        if not (isinstance(node, ast.Assign) and len(node.targets) == 1 and isinstance(node.targets[0], ast.Name)):
+            continue
+        name, value = node.targets[0].id, node.value
+        if isinstance(value, ast.Call) and getattr(value.func, "id", None) == "codelist_from_csv":
+            file = ast.literal_eval(value.args[0])
+            kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in value.keywords}
+            column = value.args[1] if len(value.args) > 1 else None
+            registry[name] = CodelistSpec(
+                name=name,
+                file=file,
+                column=ast.literal_eval(column) if column is not None else kwargs.get("column"),
+                category_column=kwargs.get("category_column"),
+                sha=shas.get(Path(file).name),
+            )
+        elif isinstance(value, (ast.List, ast.Tuple)):
+            codes = tuple(ast.literal_eval(value))
+            registry[name] = CodelistSpec(name=name, inline_codes=codes)
+    return registry
+
+
+def load_codes(spec: CodelistSpec) -> list:
+    """
+    codes of a codelist as strings (categories are dropped)
+    """
+    if spec.inline_codes is not None:
+        return list(spec.inline_codes)
+    frame = pd.read_csv(spec.file, usecols=[spec.column], dtype=str)
+    return frame[spec.column].dropna().str.strip().unique().tolist()
+
+
+def load_categories(spec: CodelistSpec) -> dict:
+    """
+    code -> category for categorised codelists (e.g. ethnicity, smoking)
+    """
+    if spec.category_column is None:
+        return {}
+    frame = pd.read_csv(spec.file, usecols=[spec.column, spec.category_column], dtype=str).dropna()
+    return dict(zip(frame[spec.column].str.strip(), frame[spec.category_column]))
+
+
+def load_codelists(registry: dict) -> dict:
+    """
+    codelist name -> list of codes for every codelist of the registry
+    """
+    return {name: load_codes(spec) for name, spec in registry.items()}
@@ -0,0 +1,263 @@
+#######################################################################################
+# Per-patient cumulative count cubes of appointments and vaccinations
+#######################################################################################
+# For every category of a table (appointment status, vaccination target disease) the
+# events are reduced to the distinct (patient, day) pairs with their counts, stored
+# as CSR arrays over the population (offsets, days, counts). Loading adds the running
+# total, so the number of events in any window is two binary searches and one
+# subtraction, and the date of the last (first) event in a window is the day at
+# the window's upper (lower) end. The cube store keeps the months it has seen: rows
+# of new months are counted on their own and merged into the stored cubes, without
+# reading the months already in the store again.
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from engine.event_store import DAY_SHIFT, DAY_SPAN, NULL_KEY, EventStore, day_bounds, from_days, to_days
+from engine.sampling import active_sample
+from engine.tables import read_table
+
+# table -> (date column, category column)
+CUBE_SOURCES = {
+    "appointments": ("seen_date", "status"),
+    "vaccinations": ("date", "target_disease"),
+}
+
+# appointment statuses counted as a consultation in the dataset definition
+SEEN_STATUSES = ["Arrived", "In Progress", "Finished", "Visit", "Waiting", "Patient Walked Out"]
+# vaccination target disease of the COVID-19 vaccine history
+COVID_VACCINE_TARGETS = ["SARS-2 CORONAVIRUS"]
+
+
+class CountCube:
+    """
+    counts of one category per patient and distinct day, with running totals
+    """
+
+    def __init__(self, population, offsets, days, counts):
+        self.population = np.asarray(population, dtype="int64")
+        self.offsets = np.asarray(offsets, dtype="int64")
+        self.days = np.asarray(days, dtype="int64")
+        self.counts = np.asarray(counts, dtype="int64")
+        # total[i] = events on rows before i (all patients), so a window is total[hi] - total[lo]
+        self.total = np.concatenate([[0], np.cumsum(self.counts)])
+        positions = np.repeat(np.arange(len(self.population)), np.diff(self.offsets))
+        self.keys = positions * DAY_SPAN + self.days + DAY_SHIFT
+
+    @classmethod
+    def from_events(cls, population, positions, days, counts=None):
+        """
+        aggregate events (population positions, day numbers, optional counts)
+        to distinct (patient, day) rows; undated events are dropped
+        """
+        positions, days = np.asarray(positions, dtype="int64"), np.asarray(days, dtype="int64")
+        counts = np.ones(len(days), dtype="int64") if counts is None else np.asarray(counts, dtype="int64")
+        dated = days != EventStore.NULL
+        keys = positions[dated] * DAY_SPAN + days[dated] + DAY_SHIFT
+        keys, inverse = np.unique(keys, return_inverse=True)
+        counts = np.bincount(inverse, counts[dated], minlength=len(keys)).astype("int64")
+        positions = keys // DAY_SPAN
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(positions, minlength=len(population)))])
+        return cls(population, offsets, keys - positions * DAY_SPAN - DAY_SHIFT, counts)
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def n_patients(self):
+        return len(self.population)
+
+    def reindex(self, population) -> "CountCube":
+        """
+        the same counts over a larger (sorted) population
+        """
+        positions = np.repeat(np.arange(self.n_patients), np.diff(self.offsets))
+        return CountCube.from_events(population, np.searchsorted(population, self.population[positions]), self.days, self.counts)
+
+    def merge(self, other: "CountCube") -> "CountCube":
+        population = np.union1d(self.population, other.population)
+        cubes = [cube if np.array_equal(cube.population, population) else cube.reindex(population) for cube in (self, other)]
+        positions = np.concatenate([np.repeat(np.arange(len(population)), np.diff(cube.offsets)) for cube in cubes])
+        return CountCube.from_events(
+            population,
+            positions,
+            np.concatenate([cube.days for cube in cubes]),
+            np.concatenate([cube.counts for cube in cubes]),
+        )
+
+    def window(self, start=None, end=None, patients=None):
+        """
+        row ranges [lo, hi) of the days on or between `start` and `end` (see
+        EventStore.window); `patients` are population positions, -1 for none
+        """
+        if patients is None:
+            patients = np.arange(self.n_patients, dtype="int64")
+        patients = np.asarray(patients, dtype="int64")
+        n = len(patients)
+        start, end = day_bounds(start, n), day_bounds(end, n)
+        outside = (patients < 0) | (patients >= self.n_patients)
+        clipped = np.where(outside, 0, patients)
+        base = clipped * DAY_SPAN
+        lo = np.searchsorted(self.keys, base + NULL_KEY, side="right")
+        hi = np.where(outside, lo, self.offsets[clipped + 1])
+        null = outside.copy()
+        if start is not None:
+            lo = np.maximum(lo, np.searchsorted(self.keys, base + start + DAY_SHIFT, side="left"))
+            null |= start == EventStore.NULL
+        if end is not None:
+            hi = np.searchsorted(self.keys, base + end + DAY_SHIFT, side="right")
+            null |= end == EventStore.NULL
+        hi = np.where(null, lo, np.maximum(hi, lo))
+        return lo, hi
+
+    def count(self, start=None, end=None, patients=None) -> np.ndarray:
+        lo, hi = self.window(start, end, patients)
+        return self.total[hi] - self.total[lo]
+
+    def last(self, start=None, end=None, patients=None) -> np.ndarray:
+        lo, hi = self.window(start, end, patients)
+        return np.where(hi > lo, self.days[np.maximum(hi - 1, 0)] if len(self) else 0, EventStore.NULL)
+
+    def first(self, start=None, end=None, patients=None) -> np.ndarray:
+        lo, hi = self.window(start, end, patients)
+        return np.where(hi > lo, self.days[np.minimum(lo, max(len(self) - 1, 0))] if len(self) else 0, EventStore.NULL)
+
+
+class CubeStore:
+    """
+    on-disk count cubes: manifest.json (months counted so far), population.npy
+    (all patients with an event) and <table>__<category>.npz (population,
+    offsets, days, counts of the patients at the time it was written)
+    """
+
+    def __init__(self, directory="output/count_cube"):
+        self.directory = Path(directory)
+        manifest = self.directory / "manifest.json"
+        self.manifest = json.loads(manifest.read_text()) if manifest.exists() else {"months": {}, "cubes": {}}
+        self._cubes = {}
+
+    @property
+    def population(self) -> np.ndarray:
+        file = self.directory / "population.npy"
+        return np.load(file) if file.exists() else np.array([], dtype="int64")
+
+    @staticmethod
+    def file_name(table, category) -> str:
+        return f"{table}__{''.join(c if c.isalnum() else '_' for c in str(category))}.npz"
+
+    def update(self, tables="example-data", sources=CUBE_SOURCES) -> dict:
+        """
+        count the rows of the months not yet in the store (months are taken to
+        arrive whole) and merge them into the cubes; returns table -> months added.
+        A store counted on another patient sample is counted again from scratch
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        sample = active_sample()
+        signature = sample.signature() if sample is not None else None
+        if signature != self.manifest.get("sample"):
+            for names in self.manifest["cubes"].values():
+                for name in names.values():
+                    (self.directory / name).unlink(missing_ok=True)
+            (self.directory / "population.npy").unlink(missing_ok=True)
+            self.manifest = {"months": {}, "cubes": {}, "sample": signature}
+            self._cubes.clear()
+            (self.directory / "manifest.json").write_text(json.dumps(self.manifest, indent=2))
+        added = {}
+        population = self.population
+        new_cubes = {}
+        for table, (date_column, category_column) in sources.items():
+            frame = read_table(table, tables, [date_column, category_column])
+            months = pd.to_datetime(frame[date_column]).dt.strftime("%Y-%m")
+            seen = set(self.manifest["months"].get(table, []))
+            new = months.notna() & ~months.isin(seen)
+            if not new.any():
+                continue
+            frame = frame[new.to_numpy()]
+            population = np.union1d(population, frame["patient_id"].to_numpy(dtype="int64"))
+            added[table] = sorted(months[new].unique())
+            self.manifest["months"][table] = sorted(seen | set(added[table]))
+            for category, rows in frame.groupby(category_column, dropna=True):
+                new_cubes[(table, category)] = (rows["patient_id"].to_numpy(dtype="int64"), to_days(rows[date_column]))
+        if not added:
+            return added
+        np.save(self.directory / "population.npy", population)
+        for (table, category), (patient_ids, days) in new_cubes.items():
+            cube = CountCube.from_events(population, np.searchsorted(population, patient_ids), days)
+            name = self.file_name(table, category)
+            if name in self.manifest["cubes"].get(table, {}).values():
+                cube = self.load(table, category).merge(cube)
+            np.savez_compressed(
+                self.directory / name,
+                population=cube.population,
+                offsets=cube.offsets,
+                days=cube.days.astype("int32"),
+                counts=cube.counts.astype("int32"),
+            )
+            self.manifest["cubes"].setdefault(table, {})[str(category)] = name
+        (self.directory / "manifest.json").write_text(json.dumps(self.manifest, indent=2))
+        self._cubes.clear()
+        return added
+
+    def load(self, table, category) -> CountCube:
+        """
+        the cube of one category, over the current population (empty if the
+        category never occurs)
+        """
+        key = (table, str(category))
+        if key not in self._cubes:
+            population = self.population
+            name = self.manifest["cubes"].get(table, {}).get(str(category))
+            if name is None:
+                cube = CountCube(population, np.zeros(len(population) + 1, dtype="int64"), [], [])
+            else:
+                with np.load(self.directory / name) as arrays:
+                    cube = CountCube(arrays["population"], arrays["offsets"], arrays["days"], arrays["counts"])
+                if not np.array_equal(cube.population, population):
+                    cube = cube.reindex(population)
+            self._cubes[key] = cube
+        return self._cubes[key]
+
+    def positions(self, patient_ids) -> np.ndarray:
+        """
+        population positions of patient_ids, -1 for patients not in the store
+        """
+        population = self.population
+        patient_ids = np.asarray(patient_ids, dtype="int64")
+        positions = np.minimum(np.searchsorted(population, patient_ids), max(len(population) - 1, 0))
+        found = (len(population) > 0) & (population[positions] == patient_ids)
+        return np.where(found, positions, -1)
+
+    def count(self, table, categories, start=None, end=None, patients=None) -> np.ndarray:
+        """
+        events of any of `categories` on or between `start` and `end`
+        """
+        return sum(self.load(table, category).count(start, end, patients) for category in categories)
+
+    def last_date(self, table, categories, start=None, end=None, patients=None) -> np.ndarray:
+        """
+        date of the latest event of any of `categories` in the window (NaT if none)
+        """
+        days = np.maximum.reduce([self.load(table, category).last(start, end, patients) for category in categories])
+        return from_days(days)
+
+
+def cube_covariates(store: CubeStore, patient_ids, baseline_date, studystart_date) -> pd.DataFrame:
+    """
+    the appointment and vaccination covariates of the dataset definition, read
+    off the cubes: consultations in the year before `studystart_date`, and the
+    number and latest date of COVID-19 vaccinations on or before baseline_date
+    """
+    patients = store.positions(patient_ids)
+    studystart = to_days([studystart_date])[0]
+    return pd.DataFrame(
+        {
+            "patient_id": np.asarray(patient_ids, dtype="int64"),
+            "cov_num_consultation_rate": store.count("appointments", SEEN_STATUSES, studystart - 366, studystart, patients),
+            "cov_count_covid_vaccines": store.count("vaccinations", COVID_VACCINE_TARGETS, None, baseline_date, patients),
+            "cov_date_recent_covid_vaccines": store.last_date(
+                "vaccinations", COVID_VACCINE_TARGETS, None, baseline_date, patients
+            ),
+        }
+    )
@@ -0,0 +1,220 @@
+#######################################################################################
+# Streaming diff of two extracted datasets (output/dataset.arrow)
+#######################################################################################
+# Both files are read record batch by record batch (memory-mapped) and aligned on
+# patient_id by a sort-merge: each step takes the rows of both files up to the
+# smaller of their current last patient_ids, so only about two batches are ever in
+# memory. When the current batches of both files hold the same patient_ids (the
+# usual case for two extractions of one population), every column is first
+# compared by the hash of its Arrow buffers, and only the columns whose hashes
+# differ are decoded and compared value by value. Both files must be sorted by
+# patient_id, as ehrQL writes them.
+import hashlib
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+ID_COLUMN = "patient_id"
+
+
+def array_hash(array: pa.Array) -> bytes:
+    """
+    digest of the type, length, null count and buffers of an Arrow array, and
+    of the dictionary of a dictionary-encoded array (its buffers only hold
+    the indices); equal digests mean equal values (the converse need not hold)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{array.type}:{len(array)}:{array.null_count}:{array.offset}".encode())
+    for buffer in array.buffers():
+        digest.update(b"\x00" if buffer is None else memoryview(buffer))
+    if pa.types.is_dictionary(array.type):
+        digest.update(array_hash(array.dictionary))
+    return digest.digest()
+
+
+class BatchCursor:
+    """
+    the rows of an Arrow file not yet consumed, one record batch at a time
+    """
+
+    def __init__(self, path, id_column=ID_COLUMN):
+        self.reader = pa.ipc.open_file(pa.memory_map(str(path)))
+        self.schema = self.reader.schema
+        self.id_column = id_column
+        self.next_batch = 0
+        self.batch, self.whole = None, False
+        self.last_id = None
+        self._load()
+
+    def _load(self):
+        while self.batch is None and self.next_batch < self.reader.num_record_batches:
+            batch = self.reader.get_batch(self.next_batch)
+            self.next_batch += 1
+            if batch.num_rows == 0:
+                continue
+            ids = batch.column(self.id_column).to_numpy()
+            if np.any(ids[1:] <= ids[:-1]) or (self.last_id is not None and ids[0] <= self.last_id):
+                raise ValueError(f"{self.id_column} must be unique and sorted in both datasets")
+            self.batch, self.ids, self.whole = batch, ids, True
+
+    @property
+    def exhausted(self) -> bool:
+        return self.batch is None
+
+    def take_upto(self, bound) -> pa.RecordBatch:
+        """
+        consume and return the current batch's rows with ids <= bound
+        """
+        if self.batch is None:
+            return None
+        n = int(np.searchsorted(self.ids, bound, side="right"))
+        rows = self.batch.slice(0, n)
+        if n == self.batch.num_rows:
+            self.last_id = self.ids[-1]
+            self.batch = None
+            self._load()
+        else:
+            self.batch, self.ids, self.whole = self.batch.slice(n), self.ids[n:], False
+        return rows
+
+    def take_batch(self) -> pa.RecordBatch:
+        return self.take_upto(self.ids[-1])
+
+
+def is_categorical(column: str) -> bool:
+    return "_cat_" in column or "_bin_" in column or column.endswith(("_cat", "_bin"))
+
+
+class DatasetDiff:
+    """
+    changed-value counts, sample patient_ids and (for _cat_ / _bin_ columns)
+    transition counts per column, accumulated over aligned blocks
+    """
+
+    def __init__(self, old_schema: pa.Schema, new_schema: pa.Schema, n_samples=10, id_column=ID_COLUMN):
+        self.id_column = id_column
+        self.columns = [name for name in old_schema.names if name in new_schema.names and name != id_column]
+        self.removed = [name for name in old_schema.names if name not in new_schema.names]
+        self.added = [name for name in new_schema.names if name not in old_schema.names]
+        self.n_samples = n_samples
+        self.n_compared = Counter()
+        self.n_changed = Counter()
+        self.n_skipped = Counter()
+        self.samples = {name: [] for name in self.columns}
+        self.transitions = {name: Counter() for name in self.columns if is_categorical(name)}
+        self.patients = {"only_old": 0, "only_new": 0, "common": 0}
+        self.patient_samples = {"only_old": [], "only_new": []}
+
+    def _sample(self, samples: list, ids):
+        if len(samples) < self.n_samples:
+            samples.extend(int(i) for i in ids[: self.n_samples - len(samples)])
+
+    def compare_columns(self, column, old: pa.Array, new: pa.Array, ids):
+        """
+        value comparison of one column over rows of the same patients
+        """
+        x, y = old.to_pandas(date_as_object=False), new.to_pandas(date_as_object=False)
+        missing_x, missing_y = x.isna().to_numpy(), y.isna().to_numpy()
+        with np.errstate(invalid="ignore"):
+            equal = (x.to_numpy(dtype=object) == y.to_numpy(dtype=object)) if x.dtype != y.dtype else (x == y).to_numpy(dtype=bool, na_value=False)
+        changed = ~((equal & ~missing_x & ~missing_y) | (missing_x & missing_y))
+        self.n_compared[column] += len(ids)
+        self.n_changed[column] += int(changed.sum())
+        if changed.any():
+            self._sample(self.samples[column], ids[changed])
+            if column in self.transitions:
+                pairs = pd.DataFrame({"old": x[changed].astype("string"), "new": y[changed].astype("string")})
+                for (before, after), n in pairs.value_counts(dropna=False).items():
+                    self.transitions[column][(before, after)] += int(n)
+
+    def compare_block(self, old: pa.RecordBatch, new: pa.RecordBatch):
+        """
+        rows of both datasets over the same patient_id range
+        """
+        old_ids = old.column(self.id_column).to_numpy() if old is not None else np.array([], dtype="int64")
+        new_ids = new.column(self.id_column).to_numpy() if new is not None else np.array([], dtype="int64")
+        common, i, j = np.intersect1d(old_ids, new_ids, assume_unique=True, return_indices=True)
+        for side, ids, kept in (("only_old", old_ids, i), ("only_new", new_ids, j)):
+            only = np.delete(ids, kept)
+            self.patients[side] += len(only)
+            self._sample(self.patient_samples[side], only)
+        self.patients["common"] += len(common)
+        if not len(common):
+            return
+        i, j = pa.array(i), pa.array(j)
+        for column in self.columns:
+            self.compare_columns(column, old.column(column).take(i), new.column(column).take(j), common)
+
+    def compare_batches(self, old: pa.RecordBatch, new: pa.RecordBatch):
+        """
+        whole batches with the same patient_ids: columns with equal buffer
+        hashes are skipped without decoding
+        """
+        ids = old.column(self.id_column).to_numpy()
+        self.patients["common"] += len(ids)
+        for column in self.columns:
+            x, y = old.column(column), new.column(column)
+            if x.type == y.type and array_hash(x) == array_hash(y):
+                self.n_compared[column] += len(ids)
+                self.n_skipped[column] += len(ids)
+            else:
+                self.compare_columns(column, x, y, ids)
+
+    def summary(self) -> pd.DataFrame:
+        rows = [
+            {
+                "column": self.id_column,
+                "status": "changed" if self.patients["only_old"] or self.patients["only_new"] else "same",
+                "n_compared": self.patients["common"],
+                "n_only_old": self.patients["only_old"],
+                "n_only_new": self.patients["only_new"],
+                "sample_patient_ids": ";".join(map(str, self.patient_samples["only_old"] + self.patient_samples["only_new"])),
+            }
+        ]
+        for column in self.columns:
+            rows.append(
+                {
+                    "column": column,
+                    "status": "changed" if self.n_changed[column] else "same",
+                    "n_compared": self.n_compared[column],
+                    "n_changed": self.n_changed[column],
+                    "n_skipped": self.n_skipped[column],
+                    "sample_patient_ids": ";".join(map(str, self.samples[column])),
+                }
+            )
+        rows += [{"column": column, "status": "removed"} for column in self.removed]
+        rows += [{"column": column, "status": "added"} for column in self.added]
+        summary = pd.DataFrame(rows)
+        counts = ["n_compared", "n_changed", "n_skipped", "n_only_old", "n_only_new"]
+        return summary[["column", "status", *counts, "sample_patient_ids"]].astype({name: "Int64" for name in counts})
+
+    def transition_table(self) -> pd.DataFrame:
+        rows = [
+            {"column": column, "old": before, "new": after, "n": n}
+            for column, counts in self.transitions.items()
+            for (before, after), n in sorted(counts.items(), key=lambda item: -item[1])
+        ]
+        return pd.DataFrame(rows, columns=["column", "old", "new", "n"])
+
+
+def diff_datasets(old_path, new_path, n_samples=10, id_column=ID_COLUMN) -> DatasetDiff:
+    """
+    sort-merge of two datasets on `id_column`, one pair of batches at a time
+    """
+    old, new = BatchCursor(old_path, id_column), BatchCursor(new_path, id_column)
+    diff = DatasetDiff(old.schema, new.schema, n_samples, id_column)
+    while not (old.exhausted and new.exhausted):
+        if old.exhausted:
+            diff.compare_block(None, new.take_batch())
+            continue
+        if new.exhausted:
+            diff.compare_block(old.take_batch(), None)
+            continue
+        if old.whole and new.whole and old.batch.num_rows == new.batch.num_rows and np.array_equal(old.ids, new.ids):
+            diff.compare_batches(old.take_batch(), new.take_batch())
+            continue
+        bound = min(old.ids[-1], new.ids[-1])
+        diff.compare_block(old.take_upto(bound), new.take_upto(bound))
+    return diff
@@ -0,0 +1,74 @@
+#######################################################################################
+# Reading and writing extracted datasets (output/dataset.arrow)
+#######################################################################################
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+
+def read_dataset(path="output/dataset.arrow", columns=None) -> pd.DataFrame:
+    """
+    extracted dataset as pandas, with date columns as datetime64
+    """
+    table = feather.read_table(path, columns=columns)
+    frame = table.to_pandas(date_as_object=False)
+    return frame
+
+
+def to_arrow(frame: pd.DataFrame) -> pa.Table:
+    """
+    frame to an Arrow table, writing datetime columns back as date32 as ehrQL does
+    """
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    fields = []
+    for column in table.schema:
+        if pa.types.is_timestamp(column.type):
+            fields.append(pa.field(column.name, pa.date32()))
+        else:
+            fields.append(column)
+    return table.cast(pa.schema(fields))
+
+
+def write_dataset(frame: pd.DataFrame, path):
+    feather.write_feather(to_arrow(frame), path)
+
+
+def iter_frames(path, chunk_rows=1_000_000, group_columns=None):
+    """
+    the rows of an Arrow file as pandas frames of about `chunk_rows` rows; with
+    `group_columns` a chunk never splits a run of rows with equal values of
+    these columns (the rows of a group must be contiguous, not sorted)
+    """
+    reader = pa.ipc.open_file(pa.memory_map(str(path)))
+
+    def slices():
+        batches, n_rows = [], 0
+        for i in range(reader.num_record_batches):
+            batch = reader.get_batch(i)
+            for offset in range(0, batch.num_rows, chunk_rows):
+                batches.append(batch.slice(offset, chunk_rows))
+                n_rows += batches[-1].num_rows
+                if n_rows >= chunk_rows:
+                    yield pa.Table.from_batches(batches).to_pandas(date_as_object=False)
+                    batches, n_rows = [], 0
+        if batches:
+            yield pa.Table.from_batches(batches).to_pandas(date_as_object=False)
+
+    pending = None
+    for frame in slices():
+        if pending is not None:
+            frame = pd.concat([pending, frame], ignore_index=True)
+        if group_columns is None:
+            yield frame
+            continue
+        keys = frame[list(group_columns)]
+        changed = (keys.iloc[1:].to_numpy() != keys.iloc[:-1].to_numpy()).any(axis=1)
+        starts = np.flatnonzero(changed) + 1
+        if len(starts):
+            yield frame.iloc[: starts[-1]].reset_index(drop=True)
+            pending = frame.iloc[starts[-1]:].reset_index(drop=True)
+        else:
+            pending = frame
+    if pending is not None and len(pending):
+        yield pending
@@ -0,0 +1,334 @@
+#######################################################################################
+# Static dependency graph of analysis/dataset_definition.py
+#######################################################################################
+# The definition is parsed (not executed) and every `dataset.<column> = ...` is
+# traced through module-level names and helper functions down to the source
+# tables, table columns and codelists it reads. `baseline_date` is kept as a node
+# of its own, so that e.g. cov_cat_region lists practice_registrations columns
+# only, with baseline_date as an upstream node.
+import ast
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import pandas as pd
+
+from engine.tables import TABLES, read_tables, table_path
+
+# module-level names that are graph nodes of their own rather than inlined
+BOUNDARY_NAMES = ("baseline_date",)
+
+# ehrQL methods that read table columns not named in the definition
+IMPLICIT_COLUMNS = {
+    "age_on": ["date_of_birth"],
+    "for_patient_on": ["start_date", "end_date"],
+    "spanning": ["start_date", "end_date"],
+}
+
+
+@dataclass
+class Dependencies:
+    tables: set = field(default_factory=set)
+    columns: set = field(default_factory=set)  # (table, column) pairs
+    codelists: set = field(default_factory=set)
+    upstream: set = field(default_factory=set)  # boundary nodes, e.g. baseline_date
+
+    def __or__(self, other):
+        return Dependencies(
+            self.tables | other.tables,
+            self.columns | other.columns,
+            self.codelists | other.codelists,
+            self.upstream | other.upstream,
+        )
+
+
+class DependencyGraph:
+    """
+    dataset column -> tables, columns and codelists it depends on
+    """
+
+    def __init__(self, path="analysis/dataset_definition.py", codelist_names=()):
+        self.path = path
+        self.codelist_names = set(codelist_names)
+        self.tables = set()
+        self.schema_aliases = set()
+        self.env = {}
+        self.functions = {}
+        self.nodes = {}  # boundary name -> Dependencies
+        self.variables = {}  # dataset column -> Dependencies (direct, without boundary nodes)
+        self.matched = {}  # codelist -> (table, column) pairs it is matched against with is_in()
+        self._resolving = []
+        self._parse(ast.parse(Path(path).read_text()))
+
+    ## Parsing ----
+    def _parse(self, tree):
+        for node in tree.body:
+            if isinstance(node, ast.ImportFrom) and node.module:
+                for alias in node.names:
+                    if node.module.startswith("ehrql.tables") and node.module.endswith(".tpp"):
+                        self.tables.add(alias.asname or alias.name)
+                    elif node.module.startswith("ehrql.tables") and alias.name == "tpp":
+                        self.schema_aliases.add(alias.asname or alias.name)
+            elif isinstance(node, ast.FunctionDef):
+                self.functions[node.name] = node
+            elif isinstance(node, ast.Assign) and len(node.targets) == 1:
+                self._assign(node.targets[0], node.value)
+            elif isinstance(node, ast.Expr) and isinstance(node.value, ast.Call):
+                func = node.value.func
+                if self._is_dataset(func) and func.attr == "define_population":
+                    self.variables["population"] = self.deps(node.value.args[0], {})
+
+    def _assign(self, target, value):
+        if isinstance(target, ast.Name):
+            self.env[target.id] = value
+            if target.id in BOUNDARY_NAMES:
+                self._resolving.append(target.id)
+                self.nodes[target.id] = self.deps(value, {})
+                self._resolving.pop()
+        elif self._is_dataset(target):
+            self.variables[target.attr] = self.deps(value, {})
+
+    @staticmethod
+    def _is_dataset(node):
+        return isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == "dataset"
+
+    ## Tracing ----
+    def deps(self, node, scope) -> Dependencies:
+        """
+        dependencies of an expression; `scope` binds function parameters and
+        locals to (expression, scope) pairs or to lists of constant strings
+        """
+        if isinstance(node, ast.Name):
+            return self._name_deps(node.id, scope)
+        if isinstance(node, ast.Attribute):
+            out = self.deps(node.value, scope)
+            table = self.root_table(node.value, scope)
+            schema = TABLES.get(table, {}).get("columns", {})
+            if table is not None and node.attr in schema:
+                out = out | Dependencies(tables={table}, columns={(table, node.attr)})
+            elif table is not None and node.attr in IMPLICIT_COLUMNS:
+                columns = {(table, column) for column in IMPLICIT_COLUMNS[node.attr] if column in schema}
+                out = out | Dependencies(tables={table}, columns=columns)
+            elif isinstance(node.value, ast.Name) and node.value.id in self.schema_aliases and node.attr in TABLES:
+                out = out | Dependencies(tables={node.attr})
+            return out
+        if isinstance(node, ast.Call):
+            return self._call_deps(node, scope)
+        if isinstance(node, (ast.ListComp, ast.GeneratorExp)) and len(node.generators) == 1:
+            generator = node.generators[0]
+            inner = dict(scope)
+            if isinstance(generator.target, ast.Name):
+                inner[generator.target.id] = ("strings", self._constant_strings(node))
+            out = self.deps(generator.iter, scope)
+            for child in [node.elt] + generator.ifs:
+                out = out | self.deps(child, inner)
+            return out
+        out = Dependencies()
+        for child in ast.iter_child_nodes(node):
+            out = out | self.deps(child, scope)
+        return out
+
+    def _name_deps(self, name, scope) -> Dependencies:
+        if name in scope:
+            binding = scope[name]
+            if binding[0] == "expr":
+                return self.deps(binding[1], binding[2])
+            return Dependencies()
+        if name in BOUNDARY_NAMES and name not in self._resolving:
+            return Dependencies(upstream={name})
+        if name in self.tables:
+            return Dependencies(tables={name})
+        if name in self.codelist_names:
+            return Dependencies(codelists={name})
+        if name in self.env and name not in self._resolving:
+            self._resolving.append(name)
+            try:
+                return self.deps(self.env[name], {})
+            finally:
+                self._resolving.pop()
+        return Dependencies()
+
+    def _call_deps(self, node, scope) -> Dependencies:
+        func = node.func
+        out = Dependencies()
+        for arg in list(node.args) + [kw.value for kw in node.keywords]:
+            out = out | self.deps(arg, scope)
+        if isinstance(func, ast.Attribute) and func.attr == "is_in":
+            for codelist in out.codelists:
+                self.matched.setdefault(codelist, set()).update(self._code_columns(func.value, scope))
+        if isinstance(func, ast.Name) and func.id in self.functions and func.id not in scope:
+            function_scope = self._bind(self.functions[func.id], node, scope)
+            return out | self._function_deps(self.functions[func.id], function_scope)
+        if isinstance(func, ast.Name) and func.id == "getattr" and len(node.args) == 2:
+            table = self.root_table(node.args[0], scope)
+            names = self._strings(node.args[1], scope)
+            if table is not None:
+                columns = {(table, name) for name in names if name in TABLES.get(table, {}).get("columns", {})}
+                out = out | Dependencies(tables={table}, columns=columns)
+            return out
+        return out | self.deps(func, scope)
+
+    def _code_columns(self, node, scope) -> set:
+        # (table, column) pairs of the series a codelist is matched against,
+        # e.g. clinical_events.ctv3_code or getattr(ons_deaths, column_name)
+        if isinstance(node, ast.Attribute):
+            table = self.root_table(node.value, scope)
+            if node.attr in TABLES.get(table, {}).get("columns", {}):
+                return {(table, node.attr)}
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "getattr" and len(node.args) == 2:
+            table = self.root_table(node.args[0], scope)
+            return {(table, name) for name in self._strings(node.args[1], scope) if name in TABLES.get(table, {}).get("columns", {})}
+        return set()
+
+    def _bind(self, function, call, scope) -> dict:
+        # bind parameters to call arguments, falling back to defaults
+        args = function.args
+        bound = {}
+        positional = args.args
+        defaults = dict(zip([a.arg for a in positional[len(positional) - len(args.defaults):]], args.defaults))
+        defaults.update({a.arg: d for a, d in zip(args.kwonlyargs, args.kw_defaults) if d is not None})
+        for param, default in defaults.items():
+            bound[param] = ("expr", default, {})
+        for param, value in zip(positional, call.args):
+            bound[param.arg] = ("expr", value, scope)
+        for kw in call.keywords:
+            bound[kw.arg] = ("expr", kw.value, scope)
+        return bound
+
+    def _function_deps(self, function, scope) -> Dependencies:
+        out = Dependencies()
+        scope = dict(scope)
+        for statement in function.body:
+            if isinstance(statement, ast.Assign) and isinstance(statement.targets[0], ast.Name):
+                scope[statement.targets[0].id] = ("expr", statement.value, dict(scope))
+            elif isinstance(statement, ast.Return) and statement.value is not None:
+                out = out | self.deps(statement.value, scope)
+        return out
+
+    def root_table(self, node, scope):
+        """
+        source table an expression is a frame or series of, if any
+        """
+        if isinstance(node, ast.Name):
+            if node.id in scope:
+                binding = scope[node.id]
+                return self.root_table(binding[1], binding[2]) if binding[0] == "expr" else None
+            if node.id in self.tables:
+                return node.id
+            if node.id in self.env and node.id not in BOUNDARY_NAMES:
+                return self.root_table(self.env[node.id], {})
+            return None
+        if isinstance(node, ast.Attribute):
+            if isinstance(node.value, ast.Name) and node.value.id in self.schema_aliases:
+                return node.attr if node.attr in TABLES else None
+            return self.root_table(node.value, scope)
+        if isinstance(node, ast.Call):
+            if isinstance(node.func, ast.Name) and node.func.id in self.functions:
+                function = self.functions[node.func.id]
+                function_scope = self._bind(function, node, scope)
+                for statement in function.body:
+                    if isinstance(statement, ast.Assign) and isinstance(statement.targets[0], ast.Name):
+                        function_scope[statement.targets[0].id] = ("expr", statement.value, dict(function_scope))
+                    elif isinstance(statement, ast.Return) and statement.value is not None:
+                        return self.root_table(statement.value, function_scope)
+                return None
+            return self.root_table(node.func, scope)
+        return None
+
+    def _strings(self, node, scope) -> list:
+        if isinstance(node, ast.Constant) and isinstance(node.value, str):
+            return [node.value]
+        if isinstance(node, ast.Name) and node.id in scope and scope[node.id][0] == "strings":
+            return scope[node.id][1]
+        return []
+
+    @staticmethod
+    def _constant_strings(comprehension) -> list:
+        # values of the loop variable, e.g. [f"diagnosis_{i:02d}" for i in range(1, 25)]
+        try:
+            code = compile(ast.Expression(comprehension.generators[0].iter), "<iter>", "eval")
+            values = eval(code, {"__builtins__": {}, "range": range})
+            return [str(value) for value in values]
+        except Exception:
+            return []
+
+    ## Queries on the graph ----
+    def closure(self, variable: str) -> Dependencies:
+        """
+        dependencies of a dataset column including its upstream nodes
+        """
+        out = self.variables[variable]
+        for name in out.upstream:
+            out = out | self.nodes[name]
+        return out
+
+    def columns_needed(self, variables=None) -> dict:
+        """
+        table -> sorted columns read by the selected dataset columns (all by default)
+        """
+        variables = list(self.variables) if variables is None else list(variables) + ["population"]
+        needed = {}
+        for variable in variables:
+            if variable not in self.variables:
+                continue
+            deps = self.closure(variable)
+            for table in deps.tables:
+                needed.setdefault(table, set())
+            for table, column in deps.columns:
+                needed[table].add(column)
+        return {table: sorted(columns) for table, columns in sorted(needed.items())}
+
+    def tables_needed(self, variables=None) -> list:
+        return list(self.columns_needed(variables))
+
+
+def count_rows(path) -> dict:
+    """
+    number of rows of each source table in a directory of dummy tables
+    """
+    counts = {}
+    for name in TABLES:
+        file = table_path(name, path)
+        if file is None:
+            counts[name] = 0
+        elif file.suffix in (".csv", ".gz"):
+            counts[name] = len(pd.read_csv(file, usecols=["patient_id"]))
+        else:
+            counts[name] = len(read_tables([name], path, {name: []})[name])
+    return counts
+
+
+def explain(graph: DependencyGraph, row_counts: dict, codelist_sizes=None, variables=None) -> pd.DataFrame:
+    """
+    explain report: one row per dataset column with its tables, columns,
+    codelists and the estimated number of source rows scanned (the rows of
+    every table in its closure, including baseline_date)
+    """
+    codelist_sizes = codelist_sizes or {}
+    rows = []
+    for variable in variables or graph.variables:
+        direct = graph.variables[variable]
+        deps = graph.closure(variable)
+        rows.append(
+            {
+                "variable": variable,
+                "tables": ";".join(sorted(direct.tables)),
+                "columns": ";".join(sorted(f"{t}.{c}" for t, c in direct.columns)),
+                "codelists": ";".join(sorted(direct.codelists)),
+                "n_codes": sum(codelist_sizes.get(name, 0) for name in direct.codelists),
+                "upstream": ";".join(sorted(direct.upstream)),
+                "est_rows_scanned": sum(row_counts.get(table, 0) for table in deps.tables),
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def read_tables_for(graph: DependencyGraph, variables=None, path="example-data", within=None) -> dict:
+    """
+    read only the source tables and columns the selected dataset columns need;
+    `within` (table -> columns) restricts the read to those of its tables the
+    selection needs, with its columns (e.g. the event tables of the feature store)
+    """
+    columns = graph.columns_needed(variables)
+    if within is not None:
+        columns = {table: within[table] for table in within if table in columns}
+    return read_tables(list(columns), path, columns)
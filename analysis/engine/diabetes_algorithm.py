@@ -0,0 +1,321 @@
+#######################################################################################
+# Vectorised port of the post-covid-diabetes classification algorithm
+#######################################################################################
+# Python version of analysis/data_import/functions/diabetes_algorithm.R and of the
+# helper variables process_data.R derives for it, evaluated column-wise on the
+# extracted dataset. R's three-valued logic matters here (an NA test in ifelse()
+# gives NA, and an NA in the nested ifelse() of cov_cat_diabetes ends up as "None"),
+# so each step is held as a Tri (Kleene logic) and ifelse() follows R exactly.
+import numpy as np
+import pandas as pd
+
+YES, NO, NA = 1, 0, -1
+
+# raw ehrQL ethnicity categories recoded to "White", "Mixed" or "Other" in process_data.R
+WHITE_MIXED_OTHER = ["1", "2", "5"]
+
+# input columns of the algorithm, all extracted with the tmp_ prefix or as cov_date_*
+INPUT_COLUMNS = [
+    "qa_num_birth_year",
+    "cov_cat_ethnicity",
+    "cov_date_t1dm",
+    "cov_date_t2dm",
+    "cov_date_otherdm",
+    "cov_date_gestationaldm",
+    "tmp_cov_date_t1dm_ctv3",
+    "tmp_cov_date_t2dm_ctv3",
+    "tmp_cov_count_t1dm",
+    "tmp_cov_count_t2dm",
+    "tmp_cov_date_poccdm",
+    "tmp_cov_count_poccdm_ctv3",
+    "tmp_cov_num_max_hba1c_mmol_mol",
+    "tmp_cov_date_max_hba1c",
+    "tmp_cov_date_nonmetform_drugs_snomed",
+    "tmp_cov_date_diabetes_medication",
+    "tmp_cov_date_latest_diabetes_diag",
+]
+
+# extracted tmp_ columns that only build the inputs above (the ctv3 / hes parts
+# of the counts, the drugs of the medication date); nothing after the algorithm
+# reads them
+COMPONENT_COLUMNS = [
+    "tmp_cov_count_t1dm_ctv3",
+    "tmp_cov_count_t1dm_hes",
+    "tmp_cov_count_t2dm_ctv3",
+    "tmp_cov_count_t2dm_hes",
+    "tmp_cov_count_otherdm",
+    "tmp_cov_date_insulin_snomed",
+    "tmp_cov_date_antidiabetic_drugs_snomed",
+]
+
+
+class Tri:
+    """
+    three-valued logical vector (TRUE / FALSE / NA), as in R
+    """
+
+    def __init__(self, true, false):
+        self.true = np.asarray(true, dtype=bool)
+        self.false = np.asarray(false, dtype=bool) & ~self.true
+
+    @classmethod
+    def of(cls, values):
+        # from a boolean array without NAs
+        values = np.asarray(values, dtype=bool)
+        return cls(values, ~values)
+
+    @classmethod
+    def compare(cls, left, op, right):
+        # numeric comparison where NaN/NaT on either side gives NA
+        left, right = np.asarray(left, dtype="float64"), np.asarray(right, dtype="float64")
+        known = ~(np.isnan(left) | np.isnan(right))
+        with np.errstate(invalid="ignore"):
+            result = op(left, right)
+        return cls(known & result, known & ~result)
+
+    def __and__(self, other):
+        return Tri(self.true & other.true, self.false | other.false)
+
+    def __or__(self, other):
+        return Tri(self.true | other.true, self.false & other.false)
+
+    def __invert__(self):
+        return Tri(self.false, self.true)
+
+
+def eq(step, value) -> Tri:
+    """
+    step == "Yes"/"No" for a step coded YES/NO/NA
+    """
+    step = np.asarray(step)
+    return Tri(step == value, (step != value) & (step != NA))
+
+
+def ifelse(test: Tri, yes, no):
+    """
+    R's ifelse(): `yes` where test is TRUE, `no` where FALSE, NA where NA
+    """
+    n = len(test.true)
+    yes, no = np.broadcast_to(yes, n), np.broadcast_to(no, n)
+    return np.where(test.true, yes, np.where(test.false, no, NA)).astype("int8")
+
+
+def is_na(values) -> Tri:
+    return Tri.of(pd.isna(values))
+
+
+def not_na(values) -> Tri:
+    return Tri.of(pd.notna(values))
+
+
+def as_days(values) -> np.ndarray:
+    """
+    dates as float day numbers (NaN for missing), for comparisons
+    """
+    dates = pd.to_datetime(pd.Series(values)).to_numpy(dtype="datetime64[D]")
+    days = dates.astype("int64").astype("float64")
+    days[np.isnat(dates)] = np.nan
+    return days
+
+
+def as_float(values) -> np.ndarray:
+    return pd.to_numeric(pd.Series(values), errors="coerce").to_numpy(dtype="float64")
+
+
+def helper_variables(data: pd.DataFrame) -> dict:
+    """
+    helper variables of process_data.R needed by the algorithm (step 5 and 7)
+    """
+    latest_year = pd.to_datetime(data["tmp_cov_date_latest_diabetes_diag"]).dt.year.to_numpy(dtype="float64")
+    # qa_num_birth_year is extracted as patients.date_of_birth (extract_data.R keeps the year)
+    birth_year = data["qa_num_birth_year"]
+    if pd.api.types.is_numeric_dtype(birth_year):
+        birth_year = as_float(birth_year)
+    else:
+        birth_year = pd.to_datetime(birth_year).dt.year.to_numpy(dtype="float64")
+    age_1st_diag = latest_year - birth_year
+    age_1st_diag[age_1st_diag < 0] = np.nan
+
+    # ethnicity is NA in R for missing or unmapped raw categories
+    ethnicity = data["cov_cat_ethnicity"].astype("string")
+    known_ethnicity = ethnicity.isin(["0", "1", "2", "3", "4", "5"]).fillna(False).to_numpy(dtype=bool)
+    white_mixed_other = ethnicity.isin(WHITE_MIXED_OTHER).fillna(False).to_numpy(dtype=bool)
+    ethnicity_test = Tri(known_ethnicity & white_mixed_other, known_ethnicity & ~white_mixed_other)
+
+    zeros = np.zeros(len(data))
+    age_test = (
+        not_na(age_1st_diag) & (Tri.compare(age_1st_diag, np.less, zeros + 35) & ethnicity_test)
+    ) | Tri.compare(age_1st_diag, np.less, zeros + 30)
+    under_35_30 = ifelse(age_test, YES, NO)
+
+    max_hba1c = as_float(data["tmp_cov_num_max_hba1c_mmol_mol"])
+    count_poccdm = as_float(data["tmp_cov_count_poccdm_ctv3"])
+    hba1c_date_step7 = data["tmp_cov_date_max_hba1c"].where(np.nan_to_num(max_hba1c, nan=-np.inf) >= 47.5)
+    over5_pocc_step7 = data["tmp_cov_date_poccdm"].where(np.nan_to_num(count_poccdm, nan=-np.inf) >= 5)
+    return {
+        "under_35_30_1st_diag": under_35_30,
+        "hba1c_date_step7": pd.to_datetime(hba1c_date_step7),
+        "over5_pocc_step7": pd.to_datetime(over5_pocc_step7),
+    }
+
+
+def diabetes_steps(data: pd.DataFrame, under_35_30_1st_diag) -> dict:
+    """
+    steps 1 to 7 of diabetes_algo(), each coded YES/NO/NA
+    """
+    t1dm, t2dm = not_na(data["cov_date_t1dm"]), not_na(data["cov_date_t2dm"])
+    no_t1dm, no_t2dm = ~t1dm, ~t2dm
+    t1dm_ctv3, t2dm_ctv3 = not_na(data["tmp_cov_date_t1dm_ctv3"]), not_na(data["tmp_cov_date_t2dm_ctv3"])
+    count_t1dm, count_t2dm = as_float(data["tmp_cov_count_t1dm"]), as_float(data["tmp_cov_count_t2dm"])
+    zeros = np.zeros(len(data))
+    s = {}
+
+    # Step 1. Any gestational diabetes code?
+    s["step_1"] = ifelse(not_na(data["cov_date_gestationaldm"]), YES, NO)
+    # Step 1a. Any T1/ T2 diagnostic codes present?
+    s["step_1a"] = ifelse(
+        eq(s["step_1"], YES) & (t1dm | t2dm), YES,
+        ifelse(eq(s["step_1"], YES) & no_t1dm & no_t2dm, NO, NA),
+    )
+    # Step 2. Non-metformin antidiabetic
+    step_2_denominator = eq(s["step_1"], NO) | eq(s["step_1a"], YES)
+    nonmetform = not_na(data["tmp_cov_date_nonmetform_drugs_snomed"])
+    s["step_2"] = ifelse(
+        step_2_denominator & nonmetform, YES,
+        ifelse(step_2_denominator & ~nonmetform, NO, NA),
+    )
+    # Step 3. Type 1 code in the absence of type 2 code?
+    s["step_3"] = ifelse(eq(s["step_2"], NO) & t1dm & no_t2dm, YES, ifelse(eq(s["step_2"], NO), NO, NA))
+    # Step 4. Type 2 code in the absence of type 1 code
+    s["step_4"] = ifelse(eq(s["step_3"], NO) & no_t1dm & t2dm, YES, ifelse(eq(s["step_3"], NO), NO, NA))
+    # Step 5. Aged <35yrs (or <30 yrs for SAs and AFCS) at first diagnostic code?
+    step_5 = ifelse(
+        eq(s["step_4"], NO) & eq(under_35_30_1st_diag, YES), YES,
+        ifelse(eq(s["step_4"], NO) & eq(under_35_30_1st_diag, NO), NO, NA),
+    )
+    s["step_5"] = ifelse(eq(step_5, NO) | (Tri.of(step_5 == NA) & eq(s["step_4"], NO)), NO, YES)
+    # Step 6. Type 1 and type 2 codes present?
+    s["step_6"] = ifelse(
+        eq(s["step_5"], NO) & t1dm & t2dm, YES,
+        ifelse(eq(s["step_5"], NO) & (no_t1dm | no_t2dm), NO, NA),
+    )
+    # Step 6a. Type 1 only reported in primary care
+    s["step_6a"] = ifelse(eq(s["step_6"], YES) & t1dm_ctv3 & ~t2dm_ctv3, YES, ifelse(eq(s["step_6"], YES), NO, NA))
+    # Step 6b. Type 2 only reported in primary care
+    s["step_6b"] = ifelse(eq(s["step_6a"], NO) & ~t1dm_ctv3 & t2dm_ctv3, YES, ifelse(eq(s["step_6a"], NO), NO, NA))
+    # Step 6c. Number of type 1 codes > number of type 2 codes?
+    s["step_6c"] = ifelse(
+        eq(s["step_6b"], NO) & Tri.compare(count_t1dm, np.greater, count_t2dm), YES,
+        ifelse(eq(s["step_6b"], NO) & Tri.compare(count_t1dm, np.less_equal, count_t2dm), NO, NA),
+    )
+    # Step 6d. Number of type 2 codes > number of type 1 codes
+    s["step_6d"] = ifelse(
+        eq(s["step_6c"], NO) & Tri.compare(count_t2dm, np.greater, count_t1dm), YES,
+        ifelse(eq(s["step_6c"], NO) & Tri.compare(count_t2dm, np.less_equal, count_t1dm), NO, NA),
+    )
+    # Step 6e. Type 2 code most recent?
+    date_t1dm, date_t2dm = as_days(data["cov_date_t1dm"]), as_days(data["cov_date_t2dm"])
+    s["step_6e"] = ifelse(
+        eq(s["step_6d"], NO) & Tri.compare(date_t2dm, np.greater, date_t1dm), YES,
+        ifelse(eq(s["step_6d"], NO) & Tri.compare(date_t2dm, np.less, date_t1dm), NO, NA),
+    )
+    # Step 7. Diabetes medication or >5 process of care codes or HbA1c>=6.5?
+    evidence = (
+        not_na(data["tmp_cov_date_diabetes_medication"])
+        | Tri.compare(as_float(data["tmp_cov_num_max_hba1c_mmol_mol"]), np.greater_equal, zeros + 47.5)
+        | Tri.compare(as_float(data["tmp_cov_count_poccdm_ctv3"]), np.greater_equal, zeros + 5)
+    )
+    s["step_7"] = ifelse(eq(s["step_6"], NO) & evidence, YES, ifelse(eq(s["step_6"], NO), NO, NA))
+    return s
+
+
+def all_of(s, **steps) -> Tri:
+    test = None
+    for name, value in steps.items():
+        term = eq(s[name], value)
+        test = term if test is None else test & term
+    return test
+
+
+def any_of(*tests) -> Tri:
+    out = tests[0]
+    for test in tests[1:]:
+        out = out | test
+    return out
+
+
+def diabetes_category(s: dict) -> np.ndarray:
+    """
+    cov_cat_diabetes from the steps, with NA replaced by "None"
+    """
+    Y, N = YES, NO
+    # the two pathways into step 2: no gestational code, or gestational with a T1/T2 code
+    entry = [dict(step_1=N), dict(step_1=Y, step_1a=Y)]
+    tests = [
+        ("DM unlikely", any_of(*[all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=N, step_7=N) for e in entry])),
+        ("DM_other", any_of(*[all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=N, step_7=Y) for e in entry])),
+        ("T2DM", any_of(*[
+            test
+            for e in entry
+            for test in (
+                all_of(s, **e, step_2=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=Y, step_6a=N, step_6b=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=Y, step_6a=N, step_6b=N, step_6c=N, step_6d=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=Y, step_6a=N, step_6b=N, step_6c=N, step_6d=N, step_6e=Y),
+            )
+        ])),
+        ("T1DM", any_of(*[
+            test
+            for e in entry
+            for test in (
+                all_of(s, **e, step_2=N, step_3=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=Y, step_6a=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=Y, step_6a=N, step_6b=N, step_6c=Y),
+                all_of(s, **e, step_2=N, step_3=N, step_4=N, step_5=N, step_6=Y, step_6a=N, step_6b=N, step_6c=N, step_6d=N, step_6e=N),
+            )
+        ])),
+        ("GDM", all_of(s, step_1=Y, step_1a=N)),
+    ]
+    # nested ifelse(): the first test that is TRUE wins, an NA test stops the cascade
+    category = np.full(len(s["step_1"]), None, dtype=object)
+    undecided = np.ones(len(category), dtype=bool)
+    for label, test in tests:
+        category[undecided & test.true] = label
+        undecided &= test.false
+    category[pd.isna(category)] = "None"
+    return category
+
+
+def apply_diabetes_algorithm(data: pd.DataFrame, keep_steps=False) -> pd.DataFrame:
+    """
+    add cov_cat_diabetes and cov_bin_t2dm and redefine cov_date_gestationaldm,
+    cov_date_t2dm, cov_date_t1dm and cov_date_otherdm as diabetes_algo() does
+    """
+    helpers = helper_variables(data)
+    steps = diabetes_steps(data, helpers["under_35_30_1st_diag"])
+    category = diabetes_category(steps)
+
+    out = data.copy()
+    latest = pd.to_datetime(out["tmp_cov_date_latest_diabetes_diag"])
+    out["cov_cat_diabetes"] = category
+    out["cov_date_gestationaldm"] = latest.where(category == "GDM")
+    out["cov_date_t2dm"] = latest.where(category == "T2DM")
+    out["cov_date_t1dm"] = latest.where(category == "T1DM")
+    other = pd.concat([helpers["hba1c_date_step7"], helpers["over5_pocc_step7"]], axis=1).min(axis=1)
+    out["cov_date_otherdm"] = other.where(category == "DM_other")
+    out["cov_bin_t2dm"] = category == "T2DM"
+    if keep_steps:
+        for name, values in steps.items():
+            out[name] = pd.Series(values).map({YES: "Yes", NO: "No"}).to_numpy()
+    return out
+
+
+def drop_tmp_columns(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    drop the tmp_ inputs of the algorithm and their components once it has run
+    (other tmp_ columns, e.g. cholesterol, are still used by process_data.R)
+    """
+    consumed = [c for c in INPUT_COLUMNS if c.startswith("tmp_")] + COMPONENT_COLUMNS
+    return data.drop(columns=[c for c in consumed if c in data.columns])
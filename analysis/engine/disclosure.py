@@ -0,0 +1,343 @@
+#######################################################################################
+# Batched disclosure control of count tables
+#######################################################################################
+# The rules of redactor() (analysis/functions/redaction.R) and of the rounding in the
+# seq_trials descriptives, applied to a long-format stack of all count tables of a
+# release at once: one row per cell with its table, its complementary group (the
+# cells that add up to a published margin) and its count. Primary suppression,
+# the secondary suppression of the next smallest cell of a group and midpoint
+# rounding are array operations over the whole stack, grouped with bincount and one
+# lexsort, and every table gets a line in the audit log. Which columns of a table
+# are counts, which are keys and which cells make up a margin is declared per table
+# type (TABLE_TYPES), never guessed. Survival tables are redacted as the Kaplan-Meier
+# outputs of the R code are: the cumulative events and censorings of every stratum
+# are rounded, the numbers at risk follow from them and the estimates are computed
+# again from the rounded counts.
+import fnmatch
+import re
+from dataclasses import dataclass
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from engine.survival import estimates, stratum_ids
+
+REDACTION_FILE = "lib/design/redaction.R"
+
+
+@dataclass(frozen=True)
+class TableType:
+    """
+    the columns of one kind of output table, matched by file name: `counts`
+    (a regular expression) are redacted, `derived` columns are computed from
+    the counts and recomputed from the redacted ones, `safe` columns are no
+    patient counts (e.g. shares of the codes of a codelist) and all other
+    columns are keys. With method "cells" the cells of a count column with
+    equal keys other than `margin` make up one margin; with method "survival"
+    the table is a survival_curves() output (keys: the strata and time)
+    """
+
+    pattern: str
+    counts: str
+    derived: str = None
+    margin: tuple = ()
+    method: str = "cells"
+    safe: str = None
+
+    def matches(self, file) -> bool:
+        return fnmatch.fnmatch(Path(file).name, self.pattern)
+
+    def columns(self, table: pd.DataFrame) -> tuple:
+        """
+        (keys, counts, derived) of a table; tables with float columns that are
+        neither counts nor derived cannot be published and raise ValueError
+        """
+        counts = [c for c in table.columns if re.search(self.counts, c)]
+        derived = [c for c in table.columns if c not in counts and self.derived and re.search(self.derived, c)]
+        keys = [c for c in table.columns if c not in counts and c not in derived]
+        floats = [c for c in keys if pd.api.types.is_float_dtype(table[c]) and not (self.safe and re.search(self.safe, c))]
+        if floats:
+            raise ValueError(f"float columns {', '.join(floats)} are not declared as counts or derived columns")
+        if self.method == "cells" and derived:
+            raise ValueError(f"derived columns {', '.join(derived)} cannot be recomputed from redacted cells")
+        if not set(self.margin) <= set(keys):
+            raise ValueError(f"margin columns {', '.join(self.margin)} are not all keys of the table")
+        return keys, counts, derived
+
+
+TABLE_TYPES = [
+    # estimate_survival.py
+    TableType(
+        "survival_*.csv",
+        counts=r"^n_(risk|event|censor)(_|$)",
+        derived=r"^(surv|cuminc)(_|$)",
+        method="survival",
+    ),
+    # clone_censor_weight.py: the counts of the two arms of a column
+    TableType("clones_summary.csv", counts=r"^n_", margin=("arm",)),
+    # codelist_coverage.py: the codes of a codelist add up to its events
+    TableType("codelist_coverage.csv", counts=r"^n_(events|patients)$", safe=r"^pct_codes_seen$"),
+    TableType("code_counts.csv", counts=r"^n_(events|patients)$", margin=("code",)),
+    TableType("top_other_codes.csv", counts=r"^n_events_min$"),
+]
+
+
+def table_type(file, types=TABLE_TYPES) -> TableType:
+    """
+    the declared type of a table file, None if there is none
+    """
+    return next((kind for kind in types if kind.matches(file)), None)
+
+
+def read_thresholds(path=REDACTION_FILE) -> dict:
+    """
+    rounding_threshold and redaction_threshold as set in lib/design/redaction.R
+    """
+    text = Path(path).read_text()
+    return {name: int(value) for name, value in re.findall(r"^(\w+_threshold)\s*(?:=|<-)\s*(\d+)", text, re.MULTILINE)}
+
+
+def roundmid_any(x, to=1) -> np.ndarray:
+    """
+    midpoint rounding of utility.R: up to a multiple of `to`, then down by
+    floor(to / 2), zero stays zero
+    """
+    x = np.asarray(x, dtype="float64")
+    return np.ceil(x / to) * to - (to // 2) * (x != 0)
+
+
+def group_ids(frame: pd.DataFrame, columns) -> np.ndarray:
+    return frame.groupby(list(columns), sort=False, dropna=False, observed=True).ngroup().to_numpy(dtype="int64")
+
+
+def suppress(n, groups, threshold) -> tuple:
+    """
+    (primary, secondary) flags of redactor(): counts in 1..threshold, and per
+    group where those add up to no more than the threshold, the smallest
+    other count of the group (zeros included, as in redactor())
+    """
+    n = np.asarray(n, dtype="int64")
+    primary = (n >= 1) & (n <= threshold)
+    n_groups = int(groups.max()) + 1 if len(groups) else 0
+    primary_sum = np.bincount(groups, weights=n * primary, minlength=n_groups)
+    any_primary = np.bincount(groups, weights=primary, minlength=n_groups) > 0
+    needs = any_primary & (primary_sum <= threshold)
+    # smallest non-primary cell per group: first row of each group in (group, n) order
+    candidate = np.where(primary, np.iinfo(np.int64).max, n)
+    order = np.lexsort((candidate, groups))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = groups[order][1:] != groups[order][:-1]
+    chosen = order[first]
+    chosen = chosen[needs[groups[chosen]] & ~primary[chosen]]
+    secondary = np.zeros(len(n), dtype=bool)
+    secondary[chosen] = True
+    return primary, secondary
+
+
+def redact(
+    cells: pd.DataFrame,
+    group_columns,
+    count="n",
+    table="table",
+    cell=None,
+    redaction_threshold=None,
+    rounding_threshold=None,
+) -> tuple:
+    """
+    (cells, audit): the cells with `redacted` (primary / secondary / "") and
+    `<count>_redacted` (rounded count, NaN where suppressed), and one audit row
+    per table. The cells of a table with equal `group_columns` make up one
+    margin. A cell in several margins (rows and columns of a two-way table, as
+    in redacted_summary_catcat()) is stacked once per margin with the same
+    `cell` id, and is suppressed in all its rows if it is in any
+    """
+    thresholds = read_thresholds() if redaction_threshold is None or rounding_threshold is None else {}
+    redaction_threshold = thresholds.get("redaction_threshold") if redaction_threshold is None else redaction_threshold
+    rounding_threshold = thresholds.get("rounding_threshold") if rounding_threshold is None else rounding_threshold
+
+    cells = cells.reset_index(drop=True)
+    n = cells[count].fillna(0).to_numpy(dtype="int64")
+    groups = group_ids(cells, [table, *group_columns])
+    primary, secondary = suppress(n, groups, redaction_threshold)
+    if cell is not None:
+        cell_ids = group_ids(cells, [table, cell])
+        secondary = (np.bincount(cell_ids, weights=secondary) > 0)[cell_ids] & ~primary
+    rounded = roundmid_any(n, rounding_threshold)
+    out = cells.copy()
+    out["redacted"] = np.where(primary, "primary", np.where(secondary, "secondary", ""))
+    out[f"{count}_redacted"] = np.where(primary | secondary, np.nan, rounded)
+
+    audit = pd.DataFrame(
+        {
+            table: cells[table],
+            "n_cells": 1,
+            "n_primary": primary,
+            "n_secondary": secondary,
+            "n_rounded": ~(primary | secondary) & (rounded != n),
+            "total": n,
+            "total_published": np.where(primary | secondary, 0, rounded),
+            "max_rounding_change": np.where(primary | secondary, 0, np.abs(rounded - n)),
+        }
+    )
+    audit = audit.groupby(table, sort=False).agg(
+        n_cells=("n_cells", "sum"),
+        n_primary=("n_primary", "sum"),
+        n_secondary=("n_secondary", "sum"),
+        n_rounded=("n_rounded", "sum"),
+        total=("total", "sum"),
+        total_published=("total_published", "sum"),
+        max_rounding_change=("max_rounding_change", "max"),
+    )
+    audit["redaction_threshold"] = redaction_threshold
+    audit["rounding_threshold"] = rounding_threshold
+    return out, audit.reset_index()
+
+
+def redact_survival(
+    table: pd.DataFrame, keys, derived=(), redaction_threshold=None, rounding_threshold=None, time="time"
+) -> tuple:
+    """
+    (table, audit) of a survival_curves() table with the counts rounded as in
+    the R Kaplan-Meier outputs: per stratum (the keys other than `time`) the
+    cumulative events of every cause and the cumulative censorings are rounded
+    with roundmid_any(), events and censorings are their differences and the
+    number at risk is the rounded number at the start minus the rounded exits
+    before. The `derived` estimates are then computed again from the rounded
+    counts (ValueError for one survival_curves() does not compute). Strata of
+    1 to redaction_threshold patients are suppressed entirely. `audit` has one
+    row per count column, as redact() has per table
+    """
+    thresholds = read_thresholds() if redaction_threshold is None or rounding_threshold is None else {}
+    redaction_threshold = thresholds.get("redaction_threshold") if redaction_threshold is None else redaction_threshold
+    rounding_threshold = thresholds.get("rounding_threshold") if rounding_threshold is None else rounding_threshold
+
+    causes = [column[len("n_event_"):] for column in table.columns if column.startswith("n_event_")]
+    counts = ["n_risk", "n_event", "n_censor", *(f"n_event_{cause}" for cause in causes)]
+    if not causes or not set(counts) <= set(table.columns) or time not in keys:
+        raise ValueError("not a survival_curves() table (n_risk, n_event, n_censor, n_event_<cause> and time)")
+    strata = [key for key in keys if key != time]
+    ids, _ = stratum_ids(table[strata] if strata else None, len(table))
+    sizes = np.bincount(ids)
+    if len(sizes) and (sizes != sizes[0]).any():
+        raise ValueError("the strata of a survival table must share one time grid")
+    order = np.lexsort((table[time].to_numpy(), ids))
+    shape = (len(sizes), sizes[0] if len(sizes) else 0)
+
+    def matrix(column):
+        return table[column].fillna(0).to_numpy(dtype="float64")[order].reshape(shape)
+
+    def rounded_steps(column):
+        cumulative = roundmid_any(np.cumsum(matrix(column), axis=1), rounding_threshold)
+        return np.diff(cumulative, axis=1, prepend=0)
+
+    events = {cause: rounded_steps(f"n_event_{cause}") for cause in causes}
+    events_any = sum(events.values())
+    censored = rounded_steps("n_censor")
+    exits = events_any + censored
+    start = roundmid_any(matrix("n_risk")[:, :1], rounding_threshold)
+    at_risk = np.maximum(start - (np.cumsum(exits, axis=1) - exits), 0)
+    curves = estimates(at_risk, events)
+    rounded = {"n_risk": at_risk, "n_event": events_any, "n_censor": censored}
+    rounded.update({f"n_event_{cause}": events[cause] for cause in causes})
+    unknown = [column for column in derived if column not in curves]
+    unknown += [column for column in table.columns if column not in (*keys, *derived, *rounded)]
+    if unknown:
+        raise ValueError(f"columns {', '.join(unknown)} cannot be recomputed from the rounded counts")
+
+    original = matrix("n_risk")[:, 0]
+    suppressed = np.repeat((original >= 1) & (original <= redaction_threshold), shape[1])
+    out = table.iloc[order].reset_index(drop=True)
+    audit = []
+    for column in table.columns:
+        if column in rounded or column in derived:
+            values = (rounded[column] if column in rounded else curves[column]).ravel()
+            out[column] = np.where(suppressed, np.nan, values)
+        if column in rounded:
+            n, published = matrix(column).ravel(), np.where(suppressed, 0, rounded[column].ravel())
+            audit.append(
+                {
+                    "column": column,
+                    "n_cells": len(n),
+                    "n_primary": int(suppressed.sum()),
+                    "n_secondary": 0,
+                    "n_rounded": int((~suppressed & (published != n)).sum()),
+                    "total": n.sum(),
+                    "total_published": published.sum(),
+                    "max_rounding_change": np.abs(np.where(suppressed, 0, published - n)).max(initial=0),
+                }
+            )
+    audit = pd.DataFrame(audit)
+    audit["redaction_threshold"] = redaction_threshold
+    audit["rounding_threshold"] = rounding_threshold
+    return out, audit
+
+
+def publish(values: pd.Series, counts=True) -> pd.Series:
+    """
+    a redacted column as published: "[REDACTED]" where suppressed, counts as integers
+    """
+    published = values.map(lambda n: "[REDACTED]" if pd.isna(n) else str(int(n))) if counts else values.astype(object)
+    return published.where(values.notna(), "[REDACTED]")
+
+
+def redact_release(tables: dict, types=TABLE_TYPES, redaction_threshold=None, rounding_threshold=None) -> tuple:
+    """
+    (redacted, log, refused) of the tables of a release (file name -> table):
+    survival tables by redact_survival(), the count columns of all other
+    tables stacked and redacted by redact() at once, with their margins as
+    declared by their table type. `redacted` maps file name to the table as
+    published (see publish()), `log` has one row per table and count column
+    and `refused` maps the tables without a declared type, or with columns
+    that cannot be published, to the reason
+    """
+    thresholds = read_thresholds() if redaction_threshold is None or rounding_threshold is None else {}
+    thresholds = {
+        "redaction_threshold": thresholds.get("redaction_threshold") if redaction_threshold is None else redaction_threshold,
+        "rounding_threshold": thresholds.get("rounding_threshold") if rounding_threshold is None else rounding_threshold,
+    }
+    redacted, stacked, logs, refused, count_tables = {}, [], [], {}, {}
+    for file, table in tables.items():
+        kind = table_type(file, types)
+        if kind is None:
+            refused[file] = "no table type declared in engine/disclosure.py"
+            continue
+        try:
+            keys, counts, derived = kind.columns(table)
+            if kind.method == "survival":
+                out, log = redact_survival(table, keys, derived, **thresholds)
+        except ValueError as error:
+            refused[file] = str(error)
+            continue
+        if kind.method == "survival":
+            for column in [*counts, *derived]:
+                out[column] = publish(out[column], column in counts)
+            redacted[file] = out
+            logs.append(log.assign(table=file))
+            continue
+        count_tables[file] = (table, counts)
+        if not counts:
+            continue
+        long = table[counts].reset_index(drop=True).reset_index(names="row")
+        long = long.melt(id_vars="row", var_name="column", value_name="n")
+        within = [key for key in keys if key not in kind.margin]
+        margin = table[within].astype("string").fillna("<NA>").agg("\x1f".join, axis=1) if within else pd.Series("", index=table.index)
+        long["margin"] = margin.to_numpy()[long["row"].to_numpy()]
+        long["table"] = file
+        long["table_column"] = file + "\x1f" + long["column"]
+        long["n"] = np.rint(long["n"].fillna(0))
+        stacked.append(long)
+
+    cells = pd.DataFrame(columns=["table", "column", "row", "n_redacted"])
+    if stacked:
+        cells, log = redact(pd.concat(stacked, ignore_index=True), ["margin"], table="table_column", **thresholds)
+        log[["table", "column"]] = log["table_column"].str.split("\x1f", expand=True)
+        logs.append(log.drop(columns="table_column"))
+    for file, (table, counts) in count_tables.items():
+        table = table.reset_index(drop=True).copy()
+        for column, values in cells[cells["table"] == file].groupby("column", sort=False):
+            table[column] = publish(values.set_index("row")["n_redacted"].sort_index()).to_numpy()
+        redacted[file] = table
+    log = pd.concat(logs, ignore_index=True) if logs else pd.DataFrame(columns=["table", "column"])
+    log = log[["table", "column", *[c for c in log.columns if c not in ("table", "column")]]]
+    return redacted, log, refused
@@ -0,0 +1,181 @@
+#######################################################################################
+# Long-format export of all post-baseline outcome and exposure events
+#######################################################################################
+# The wide dataset keeps the first date (and a count) of every outcome and exposure.
+# For recurrent events and time-varying exposures, every matching event on or after
+# baseline_date is exported instead, as rows (patient_id, variable, date, code,
+# value). The events come from the feature store, i.e. from the codelist matches
+# already scanned for the wide columns, so the export reads no source table. The
+# codelists and coding system of each variable are taken from the dependency graph
+# of the dataset definition. Rows are written in patient-range partitions, each
+# sorted by (patient_id, date, variable) with the variable dictionary-encoded (the
+# same dictionary in every partition), so that the events of one patient are a
+# contiguous, zero-copy slice of a memory-mapped partition.
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from engine.event_store import from_days, to_days
+from engine.feature_store import SOURCES, FeatureStore, merge_stores
+
+EXPORT_PREFIXES = ("out_date_", "exp_date_")
+
+# (table, code column read by the definition) -> coding system of the feature store
+CODE_COLUMNS = {(table, column): source for source, (table, column, _) in SOURCES.items()}
+
+# code columns whose matches in the definition differ from those of the feature
+# store, with the reason: events of these columns would not reproduce the wide column
+UNMATCHED_COLUMNS = {
+    ("hospital_admissions", "all_diagnoses"): "all_diagnoses.is_in() matches the whole field, "
+    "the feature store matches single diagnoses",
+}
+
+SCHEMA = pa.schema(
+    [
+        ("patient_id", pa.int64()),
+        ("variable", pa.dictionary(pa.int16(), pa.string())),
+        ("date", pa.date32()),
+        ("code", pa.string()),
+        ("value", pa.float64()),
+    ]
+)
+
+
+def variable_name(column: str) -> str:
+    """
+    out_date_long_covid_first -> out_long_covid, exp_date_first_metfin -> exp_metfin
+    """
+    return "_".join(token for token in column.split("_") if token not in ("date", "first"))
+
+
+def export_variables(graph, columns=None) -> tuple:
+    """
+    ({variable: (dataset column, coding system, codelists)}, {dataset column:
+    reason not exported}) for the date columns of outcomes and exposures whose
+    events are all codelist matches in one coding system of the feature store
+    """
+    columns = columns or [name for name in graph.variables if name.startswith(EXPORT_PREFIXES)]
+    variables, skipped = {}, {}
+    for column in columns:
+        deps = graph.variables[column]
+        systems = {CODE_COLUMNS.get(pair) for pair in deps.columns if pair in CODE_COLUMNS}
+        other = sorted(table for table in deps.tables if table not in {table for table, _ in CODE_COLUMNS})
+        unmatched = [UNMATCHED_COLUMNS[pair] for pair in sorted(deps.columns) if pair in UNMATCHED_COLUMNS]
+        if not deps.codelists:
+            skipped[column] = "no codelist"
+        elif unmatched:
+            skipped[column] = unmatched[0]
+        elif other:
+            skipped[column] = f"events of {', '.join(other)} are not in the feature store"
+        elif len(systems) != 1:
+            skipped[column] = "codelists of several coding systems"
+        else:
+            variables[variable_name(column)] = (column, systems.pop(), sorted(deps.codelists))
+    return variables, skipped
+
+
+def export_events(
+    features: FeatureStore,
+    baseline: pd.DataFrame,
+    variables: dict,
+    directory="output/events",
+    chunk_patients=200_000,
+) -> dict:
+    """
+    write the events of `variables` on or after each patient's baseline_date
+    (`baseline`: patient_id, baseline_date) to part-NNNN.arrow files of
+    `chunk_patients` patients each, plus manifest.json. Returns the manifest
+    """
+    if not variables:
+        raise ValueError("no variables to export")
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for old in directory.glob("part-*.arrow"):
+        old.unlink()
+    names = list(variables)
+    stores = [merge_stores([features.store(name, source) for name in lists]) for _, source, lists in variables.values()]
+    baseline = baseline.sort_values("patient_id")
+    patient_ids = baseline["patient_id"].to_numpy(dtype="int64")
+    positions = np.searchsorted(features.population, patient_ids)
+    found = positions < len(features.population)
+    found[found] = features.population[positions[found]] == patient_ids[found]
+    positions = np.where(found, positions, -1)
+    days = to_days(baseline["baseline_date"])
+
+    manifest = {"variables": names, "columns": {name: variables[name][0] for name in names}, "parts": []}
+    for part, start in enumerate(range(0, len(patient_ids), chunk_patients)):
+        chunk = slice(start, start + chunk_patients)
+        frames = []
+        for code, store in enumerate(stores):
+            lo, hi = store.window(days[chunk], None, positions[chunk])
+            counts = hi - lo
+            rows = np.repeat(hi - np.cumsum(counts), counts) + np.arange(counts.sum())
+            n = len(rows)
+            frames.append(
+                {
+                    "patient_id": np.repeat(patient_ids[chunk], counts),
+                    "variable": np.full(n, code, dtype="int16"),
+                    "day": store.days[rows],
+                    "code": store.columns["code"][rows] if "code" in store.columns else np.full(n, None, dtype=object),
+                    "value": store.columns["numeric_value"][rows] if "numeric_value" in store.columns else np.full(n, np.nan),
+                }
+            )
+        columns = {key: np.concatenate([frame[key] for frame in frames]) for key in frames[0]}
+        order = np.lexsort((columns["variable"], columns["day"], columns["patient_id"]))
+        columns = {key: values[order] for key, values in columns.items()}
+        table = pa.table(
+            {
+                "patient_id": pa.array(columns["patient_id"], pa.int64()),
+                "variable": pa.DictionaryArray.from_arrays(pa.array(columns["variable"]), pa.array(names, pa.string())),
+                "date": pa.array(from_days(columns["day"]), pa.date32()),
+                "code": pa.array(columns["code"].astype(object), pa.string()),
+                "value": pa.array(columns["value"], pa.float64()),
+            },
+            schema=SCHEMA,
+        )
+        file = directory / f"part-{part:04d}.arrow"
+        with pa.ipc.new_file(str(file), SCHEMA) as writer:
+            writer.write_table(table)
+        manifest["parts"].append(
+            {
+                "file": file.name,
+                "first_patient_id": int(patient_ids[chunk][0]),
+                "last_patient_id": int(patient_ids[chunk][-1]),
+                "n_events": table.num_rows,
+            }
+        )
+    (directory / "manifest.json").write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+class EventDataset:
+    """
+    memory-mapped reader of an exported event dataset
+    """
+
+    def __init__(self, directory="output/events"):
+        self.directory = Path(directory)
+        self.manifest = json.loads((self.directory / "manifest.json").read_text())
+        self._parts = {}
+
+    def part(self, index: int) -> pa.Table:
+        if index not in self._parts:
+            file = self.directory / self.manifest["parts"][index]["file"]
+            self._parts[index] = pa.ipc.open_file(pa.memory_map(str(file))).read_all()
+        return self._parts[index]
+
+    def patient(self, patient_id: int) -> pa.Table:
+        """
+        the events of one patient, a zero-copy slice of its partition
+        """
+        lasts = [part["last_patient_id"] for part in self.manifest["parts"]]
+        index = int(np.searchsorted(lasts, patient_id))
+        if index == len(lasts):
+            return pa.table({name: pa.array([], type=field.type) for name, field in zip(SCHEMA.names, SCHEMA)})
+        table = self.part(index)
+        ids = table.column("patient_id").to_numpy()
+        lo, hi = np.searchsorted(ids, patient_id, side="left"), np.searchsorted(ids, patient_id, side="right")
+        return table.slice(lo, hi - lo)
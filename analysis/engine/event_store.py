@@ -0,0 +1,284 @@
+#######################################################################################
+# Compressed-sparse-row (CSR) layout for per-patient event tables
+#######################################################################################
+# Events are sorted once by (patient, date) and stored as flat column arrays plus
+# an `offsets` array of length n_patients + 1: the events of the i-th patient of the
+# population are rows offsets[i]:offsets[i + 1]. First/last event, counts within a
+# window and before/after-baseline splits are then binary searches into each
+# patient's slice (O(log k) for k events), vectorised over all patients at once,
+# and no query has to re-sort the table.
+import numpy as np
+import pandas as pd
+
+# dates are held as int64 day numbers; within a patient the sort key is
+# patient_position * DAY_SPAN + (day + DAY_SHIFT), so that a single global
+# np.searchsorted() finds the window boundaries of every patient
+DAY_SHIFT = 2**21  # > 5,700 years either side of 1970
+DAY_SPAN = 2**22
+NULL_KEY = 0  # events without a date sort first within a patient
+
+
+def to_days(dates) -> np.ndarray:
+    """
+    convert dates (strings, datetime64, pandas Series) to int64 day numbers,
+    with missing dates as np.iinfo(np.int64).min; integer input is taken to
+    be day numbers already
+    """
+    dates = np.asarray(dates)
+    if dates.dtype.kind in "iu":
+        return dates.astype("int64")
+    if dates.dtype.kind != "M":
+        dates = pd.to_datetime(pd.Series(dates, dtype=object), errors="coerce").to_numpy()
+    return dates.astype("datetime64[D]").astype("int64")
+
+
+def from_days(days) -> np.ndarray:
+    """
+    inverse of to_days(): int64 day numbers to datetime64[D], nulls as NaT
+    """
+    return np.asarray(days, dtype="int64").astype("datetime64[D]")
+
+
+def day_bounds(bound, n: int):
+    """
+    normalise a window bound to an int64 array of day numbers of length n;
+    a bound can be None (unbounded), a single date or one date per patient
+    """
+    if bound is None:
+        return None
+    if np.ndim(bound) == 0:
+        return np.full(n, to_days([bound])[0], dtype="int64")
+    days = to_days(bound)
+    if len(days) != n:
+        raise ValueError(f"expected {n} per-patient dates, got {len(days)}")
+    return days
+
+
+class EventStore:
+    """
+    events of one source table for a fixed population, sorted by (patient, date),
+    with per-patient offsets
+    """
+
+    NULL = np.iinfo(np.int64).min
+
+    def __init__(self, population, offsets, days, columns):
+        self.population = np.asarray(population, dtype="int64")
+        self.offsets = np.asarray(offsets, dtype="int64")
+        self.days = np.asarray(days, dtype="int64")
+        self.columns = columns
+        self._keys = None
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame, population, date_column="date"):
+        """
+        build the store from a source table frame; `population` is the sorted
+        array of patient_ids the per-patient outputs are aligned to (events of
+        patients outside the population are dropped)
+        """
+        population = np.asarray(population, dtype="int64")
+        if np.any(population[1:] <= population[:-1]):
+            raise ValueError("population must be sorted and unique")
+        position = np.searchsorted(population, frame["patient_id"].to_numpy(dtype="int64"))
+        position = np.minimum(position, max(len(population) - 1, 0))
+        keep = (len(population) > 0) & (population[position] == frame["patient_id"].to_numpy(dtype="int64"))
+        position = position[keep]
+        days = to_days(frame[date_column])[keep]
+        # stable sort, so that rows with equal (patient, date) keep their table order
+        order = np.lexsort((days, position))
+        counts = np.bincount(position, minlength=len(population))
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        columns = {
+            name: frame[name].to_numpy()[keep][order]
+            for name in frame.columns
+            if name != "patient_id"
+        }
+        return cls(population, offsets, days[order], columns)
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def n_patients(self):
+        return len(self.population)
+
+    @property
+    def patient_positions(self) -> np.ndarray:
+        """
+        population position of every event
+        """
+        return np.repeat(np.arange(self.n_patients), np.diff(self.offsets))
+
+    @property
+    def keys(self) -> np.ndarray:
+        # composite (patient, date) sort key, built lazily and cached
+        if self._keys is None:
+            shifted = np.where(self.days == self.NULL, NULL_KEY, self.days + DAY_SHIFT)
+            self._keys = self.patient_positions * DAY_SPAN + shifted
+        return self._keys
+
+    ## Restrictions (return new stores, never re-sort) ----
+    def where(self, mask):
+        """
+        keep the events where `mask` (one boolean per event) is true
+        """
+        mask = np.asarray(mask, dtype=bool)
+        counts = np.bincount(self.patient_positions[mask], minlength=self.n_patients)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        columns = {name: values[mask] for name, values in self.columns.items()}
+        return EventStore(self.population, offsets, self.days[mask], columns)
+
+    def matching(self, column: str, codelist, prefix_column=None):
+        """
+        keep the events whose `column` is in the codelist (or, for hospital
+        diagnoses, whose 3-character `prefix_column` is)
+        """
+        codes = list(codelist)
+        mask = pd.Series(self.columns[column]).isin(codes).to_numpy()
+        if prefix_column is not None:
+            mask |= pd.Series(self.columns[prefix_column]).isin(codes).to_numpy()
+        return self.where(mask)
+
+    def distinct(self, column: str):
+        """
+        drop consecutive events of a patient with the same value of `column`
+        (e.g. several matching diagnoses of one admission)
+        """
+        values = self.columns[column]
+        positions = self.patient_positions
+        repeat = np.zeros(len(self), dtype=bool)
+        if len(self) > 1:
+            repeat[1:] = (positions[1:] == positions[:-1]) & (values[1:] == values[:-1])
+        return self.where(~repeat)
+
+    def take(self, patient_positions):
+        """
+        restrict to a subset of the population (sorted population positions),
+        e.g. to patients still eligible after a pre-filter
+        """
+        patient_positions = np.asarray(patient_positions, dtype="int64")
+        starts = self.offsets[patient_positions]
+        ends = self.offsets[patient_positions + 1]
+        counts = ends - starts
+        rows = np.repeat(ends - np.cumsum(counts), counts) + np.arange(counts.sum())
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        columns = {name: values[rows] for name, values in self.columns.items()}
+        return EventStore(self.population[patient_positions], offsets, self.days[rows], columns)
+
+    ## Windows ----
+    def window(self, start=None, end=None, patients=None):
+        """
+        per-patient row ranges [lo, hi) of the events dated on or between
+        `start` and `end` (both inclusive, either may be None). A missing
+        per-patient bound gives an empty window, as comparisons with a null
+        date are never true in ehrQL. `patients` (population positions, may
+        repeat) asks for one window per entry instead of one per patient, with
+        the bounds aligned to it; positions outside the population get an
+        empty window
+        """
+        if patients is None:
+            patients = np.arange(self.n_patients, dtype="int64")
+        patients = np.asarray(patients, dtype="int64")
+        n = len(patients)
+        start, end = day_bounds(start, n), day_bounds(end, n)
+        outside = (patients < 0) | (patients >= self.n_patients)
+        clipped = np.where(outside, 0, patients)
+        lo, hi = self.offsets[clipped], np.where(outside, self.offsets[clipped], self.offsets[clipped + 1])
+        base = clipped * DAY_SPAN
+        if start is not None or end is not None:
+            # any date condition excludes events without a date
+            lo = np.searchsorted(self.keys, base + NULL_KEY, side="right")
+        if start is not None:
+            lo = np.maximum(lo, np.searchsorted(self.keys, base + start + DAY_SHIFT, side="left"))
+        if end is not None:
+            hi = np.searchsorted(self.keys, base + end + DAY_SHIFT, side="right")
+        null = outside.copy()
+        for bound in (start, end):
+            if bound is not None:
+                null |= bound == self.NULL
+        hi = np.where(null, lo, np.maximum(hi, lo))
+        return lo, hi
+
+    def count(self, start=None, end=None, patients=None) -> np.ndarray:
+        lo, hi = self.window(start, end, patients)
+        return hi - lo
+
+    def exists(self, start=None, end=None, patients=None) -> np.ndarray:
+        lo, hi = self.window(start, end, patients)
+        return hi > lo
+
+    def first(self, column="date", start=None, end=None, patients=None) -> np.ndarray:
+        """
+        value of `column` on each patient's earliest event in the window
+        """
+        lo, hi = self.window(start, end, patients)
+        return self.gather(column, lo, hi > lo)
+
+    def last(self, column="date", start=None, end=None, patients=None) -> np.ndarray:
+        """
+        value of `column` on each patient's latest event in the window
+        """
+        lo, hi = self.window(start, end, patients)
+        return self.gather(column, hi - 1, hi > lo)
+
+    def spanning(self, end_column: str, at, patients=None) -> np.ndarray:
+        """
+        row of the latest-starting event (by date) that spans `at`: started on
+        or before it and ended on or after it, or not ended (for_patient_on() of
+        registrations and addresses); -1 where there is none. Steps back through
+        the events started by `at`, so the cost is the number of overlapping
+        periods per patient, which is small for these tables
+        """
+        if patients is None:
+            patients = np.arange(self.n_patients, dtype="int64")
+        at = day_bounds(at, len(patients))
+        lo, hi = self.window(None, at, patients)
+        ends = to_days(self.columns[end_column]) if len(self) else np.array([], dtype="int64")
+        row = hi - 1
+        pending = row >= lo
+        while pending.any():
+            candidate = row[pending]
+            spans = (ends[candidate] == self.NULL) | (ends[candidate] >= at[pending])
+            still = np.flatnonzero(pending)[~spans]
+            row[still] -= 1
+            pending[:] = False
+            pending[still] = row[still] >= lo[still]
+        return np.where(row >= lo, row, -1)
+
+    def gather(self, column: str, rows, valid) -> np.ndarray:
+        """
+        per-patient values of `column` at event `rows`, null where not `valid`
+        """
+        rows = np.where(valid, rows, 0)
+        if column == "date":
+            values = np.where(valid, self.days[rows] if len(self) else self.NULL, self.NULL)
+            return from_days(values)
+        source = self.columns[column]
+        if len(source) == 0:
+            return np.full(len(valid), np.nan if source.dtype.kind == "f" else None, dtype=object)
+        if source.dtype.kind == "M":
+            return np.where(valid, source[rows], np.datetime64("NaT"))
+        if source.dtype.kind == "f":
+            return np.where(valid, source[rows], np.nan)
+        values = source[rows].astype(object)
+        values[~valid] = None
+        return values
+
+    def reduce(self, column: str, ufunc, start=None, end=None, patients=None) -> np.ndarray:
+        """
+        per-patient reduction (np.fmax, np.fmin, np.add) of a numeric column
+        over the window, NaN for patients without events
+        """
+        lo, hi = self.window(start, end, patients)
+        values = np.asarray(self.columns[column], dtype="float64")
+        out = np.full(len(lo), np.nan)
+        has = hi > lo
+        if not has.any():
+            return out
+        # reduceat over the concatenated windows of the patients with events
+        lengths = (hi - lo)[has]
+        rows = np.repeat(lo[has] - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        rows += np.arange(lengths.sum())
+        starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        out[has] = ufunc.reduceat(values[rows], starts)
+        return out
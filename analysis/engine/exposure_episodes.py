@@ -0,0 +1,117 @@
+#######################################################################################
+# Continuous treatment episodes from prescriptions (per-protocol exposure)
+#######################################################################################
+# The dataset only has the first metformin prescription after baseline, its count and
+# whether it was within 7 days. The per-protocol analysis needs when treatment stopped:
+# prescriptions are joined into episodes, each covering `supply_days` from its issue
+# date, and a new episode starts when the gap between the end of the supply and the
+# next prescription exceeds `grace_days`. Everything is computed on the date-sorted
+# CSR arrays of the EventStore (differences of neighbouring dates, cumulative sums for
+# the episode ids), without a loop over patients or prescriptions.
+import numpy as np
+import pandas as pd
+
+from engine.event_store import DAY_SHIFT, DAY_SPAN, EventStore, from_days, to_days
+
+SUPPLY_DAYS = 28  # a usual primary care prescription
+GRACE_DAYS = 30
+
+EPISODE_COLUMNS = [
+    "patient_id",
+    "episode",
+    "start_date",
+    "end_date",
+    "n_prescriptions",
+    "discontinued",
+    "discontinuation_date",
+    "switched",
+    "switch_date",
+]
+
+
+def as_dates(days) -> np.ndarray:
+    # second resolution is what pandas stores, converting here avoids its slow
+    # per-element check of day resolution input
+    return from_days(days).astype("datetime64[s]")
+
+
+def build_episodes(
+    treatment: EventStore, other: EventStore = None, followup_end=None, supply_days=SUPPLY_DAYS, grace_days=GRACE_DAYS
+) -> pd.DataFrame:
+    """
+    one row per continuous episode of the prescriptions in `treatment`, from the
+    first issue date to the last issue date + `supply_days`. An episode is
+    discontinued when no prescription follows within `grace_days` of its end
+    (episodes whose grace period reaches past `followup_end` are censored, not
+    discontinued), and switched when a prescription of `other` (same population)
+    is dated after its last prescription and up to the end of its grace period;
+    earlier prescriptions of `other` were taken alongside (add-on), not instead
+    """
+    dated = treatment.where(treatment.days != EventStore.NULL)
+    days, positions = dated.days, dated.patient_positions
+    if not len(days):
+        return pd.DataFrame({name: [] for name in EPISODE_COLUMNS})
+
+    new = np.ones(len(days), dtype=bool)
+    new[1:] = (positions[1:] != positions[:-1]) | (np.diff(days) > supply_days + grace_days)
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(days)) - 1
+    patients = positions[first]
+    start, end = days[first], days[last] + supply_days
+
+    # episode number within the patient: running count minus the patient's first
+    episode_id = np.arange(len(first))
+    patient_first = np.ones(len(first), dtype=bool)
+    patient_first[1:] = patients[1:] != patients[:-1]
+    episode = episode_id - np.maximum.accumulate(np.where(patient_first, episode_id, 0))
+
+    followed = np.zeros(len(first), dtype=bool)
+    followed[:-1] = ~patient_first[1:]
+    if followup_end is None:
+        discontinued = followed.copy()
+    else:
+        discontinued = followed | (end + grace_days < to_days([followup_end])[0])
+
+    out = pd.DataFrame(
+        {
+            "patient_id": dated.population[patients],
+            "episode": episode + 1,
+            "start_date": as_dates(start),
+            "end_date": as_dates(end),
+            "n_prescriptions": last - first + 1,
+            "discontinued": discontinued,
+            "discontinuation_date": as_dates(np.where(discontinued, end, EventStore.NULL)),
+        }
+    )
+    if other is None:
+        out["switched"] = False
+        out["switch_date"] = as_dates(np.full(len(out), EventStore.NULL))
+    else:
+        lo, hi = other.window(days[last] + 1, end + grace_days, patients)
+        switched = discontinued & (hi > lo)
+        switch_days = np.full(len(out), EventStore.NULL)
+        switch_days[switched] = other.days[lo[switched]]
+        out["switched"] = switched
+        out["switch_date"] = as_dates(switch_days)
+    return out[EPISODE_COLUMNS]
+
+
+def on_treatment(episodes: pd.DataFrame, patient_ids, dates) -> np.ndarray:
+    """
+    whether each (patient_id, date) falls within one of the patient's episodes
+    (the daily treatment status used for the per-protocol lags)
+    """
+    if not len(episodes):
+        return np.zeros(len(patient_ids), dtype=bool)
+    population, patients = np.unique(episodes["patient_id"].to_numpy(dtype="int64"), return_inverse=True)
+    patient_ids = np.asarray(patient_ids, dtype="int64")
+    at = to_days(dates)
+    # episodes are sorted and disjoint within a patient: find the latest one
+    # starting on or before the date on the composite (patient, day) key
+    starts = patients * DAY_SPAN + to_days(episodes["start_date"]) + DAY_SHIFT
+    position = np.minimum(np.searchsorted(population, patient_ids), len(population) - 1)
+    known = (population[position] == patient_ids) & (at != EventStore.NULL)
+    row = np.searchsorted(starts, position * DAY_SPAN + np.where(known, at, 0) + DAY_SHIFT, side="right") - 1
+    row = np.maximum(row, 0)
+    ends = to_days(episodes["end_date"])
+    return known & (patients[row] == position) & (to_days(episodes["start_date"])[row] <= at) & (at <= ends[row])
@@ -0,0 +1,292 @@
+#######################################################################################
+# Persisted patient x codelist feature store
+#######################################################################################
+# For every codelist of codelists.py and every coding system it occurs in, the
+# matching events of a data snapshot are kept as a CSR EventStore (per-patient
+# offsets, sorted dates, matched codes, numeric values for clinical events) and
+# saved to disk. The helpers of the dataset definition are then answered from the
+# store for any baseline_date without reading the raw event tables (FeatureQueries).
+#
+# The manifest records the snapshot (size and mtime of the source tables) and the sha
+# of every codelist: a new snapshot rebuilds everything, a new codelist or a changed
+# sha only rebuilds that codelist, in one pass over the event tables. Given the
+# dependency graph of the definition, event tables no dataset column reads are not
+# scanned (read_tables_for()).
+import hashlib
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from engine.code_frequencies import CodeIndex
+from engine.codelist_registry import load_codes
+from engine.dependencies import DependencyGraph, read_tables_for
+from engine.event_store import EventStore, day_bounds
+from engine.memo import Memo, memoised, normalise
+from engine.queries import BaselineQueries, build_stores
+from engine.sampling import active_sample
+from engine.tables import read_table, read_tables, table_path
+
+# coding system -> (event table, code column, 3-character prefix column)
+SOURCES = {
+    "snomed": ("clinical_events", "snomedct_code", None),
+    "ctv3": ("clinical_events", "ctv3_code", None),
+    "dmd": ("medications", "dmd_code", None),
+    "icd10": ("hospital_admissions", "diagnosis", "diagnosis_3"),
+}
+
+SOURCE_COLUMNS = {
+    "clinical_events": ["date", "snomedct_code", "ctv3_code", "numeric_value"],
+    "medications": ["date", "dmd_code"],
+    "hospital_admissions": ["admission_date", "all_diagnoses"],
+}
+
+
+def codes_hash(codes) -> str:
+    """
+    content hash of a set of codes (order and duplicates do not matter)
+    """
+    return hashlib.sha1("\n".join(sorted(normalise(codes))).encode()).hexdigest()
+
+
+def snapshot_id(path, sources=tuple(SOURCE_COLUMNS)) -> str:
+    """
+    fingerprint of the source tables: the event tables scanned, file name, size
+    and modification time, and the active patient sample
+    """
+    sample = active_sample()
+    parts = [f"sample:{sample.signature()}"] if sample is not None else []
+    parts.append("sources:" + ",".join(sources))
+    for name in ["patients", *sources]:
+        file = table_path(name, path)
+        if file is not None:
+            stat = file.stat()
+            parts.append(f"{file.name}:{stat.st_size}:{stat.st_mtime_ns}")
+    return hashlib.sha1("\n".join(parts).encode()).hexdigest()
+
+
+def merge_stores(stores: list) -> EventStore:
+    """
+    union of stores of the same population, events matched by several of them
+    kept once (identified by their source `row`)
+    """
+    if len(stores) == 1:
+        return stores[0]
+    population = stores[0].population
+    positions = np.concatenate([store.patient_positions for store in stores])
+    days = np.concatenate([store.days for store in stores])
+    names = set.intersection(*(set(store.columns) for store in stores))
+    columns = {name: np.concatenate([store.columns[name] for store in stores]) for name in names}
+    order = np.lexsort((columns["row"], days, positions))
+    positions, days = positions[order], days[order]
+    columns = {name: values[order] for name, values in columns.items()}
+    repeat = np.zeros(len(days), dtype=bool)
+    repeat[1:] = (positions[1:] == positions[:-1]) & (columns["row"][1:] == columns["row"][:-1])
+    counts = np.bincount(positions[~repeat], minlength=len(population))
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    return EventStore(population, offsets, days[~repeat], {name: values[~repeat] for name, values in columns.items()})
+
+
+class FeatureStore:
+    """
+    on-disk store of codelist matches: manifest.json, population.npy and one
+    .npz per codelist with the CSR arrays of each coding system it occurs in
+    """
+
+    def __init__(self, directory="output/feature_store"):
+        self.directory = Path(directory)
+        manifest = self.directory / "manifest.json"
+        self.manifest = json.loads(manifest.read_text()) if manifest.exists() else {"snapshot": None, "codelists": {}}
+        self._population = None
+        self._stores = {}
+
+    @property
+    def population(self) -> np.ndarray:
+        if self._population is None:
+            self._population = np.load(self.directory / "population.npy")
+        return self._population
+
+    ## Building ----
+    def stale(self, registry: dict, codes: dict, snapshot: str) -> list:
+        """
+        codelists to (re)build: all of them for a new snapshot, otherwise the new
+        ones and those whose sha changed
+        """
+        if snapshot != self.manifest["snapshot"]:
+            return list(registry)
+        entries = self.manifest["codelists"]
+        return [name for name in registry if entries.get(name, {}).get("sha") != self.sha(registry[name], codes[name])]
+
+    @staticmethod
+    def sha(spec, codes) -> str:
+        # inline codelists (and files missing from codelists.json) are hashed by content
+        return spec.sha or codes_hash(codes)
+
+    def update(self, registry: dict, tables="example-data", graph: DependencyGraph = None) -> dict:
+        """
+        bring the store up to date with the codelist registry and the source
+        tables (those the definition of `graph` reads, all without a graph);
+        returns the names of the codelists built and removed
+        """
+        codes = {name: load_codes(spec) for name, spec in registry.items()}
+        sources = list(SOURCE_COLUMNS) if graph is None else [t for t in SOURCE_COLUMNS if t in graph.columns_needed()]
+        snapshot = snapshot_id(tables, sources)
+        build = self.stale(registry, codes, snapshot)
+        removed = [name for name in self.manifest["codelists"] if name not in registry]
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        if snapshot != self.manifest["snapshot"]:
+            population = np.unique(read_table("patients", tables, []).patient_id.to_numpy(dtype="int64"))
+            np.save(self.directory / "population.npy", population)
+            self._population = population
+            for name in self.manifest["codelists"]:
+                (self.directory / f"{name}.npz").unlink(missing_ok=True)
+            self.manifest = {"snapshot": snapshot, "codelists": {}}
+        for name in removed:
+            self.manifest["codelists"].pop(name, None)
+            (self.directory / f"{name}.npz").unlink(missing_ok=True)
+        self._stores.clear()
+
+        if build:
+            matches = self.match({name: codes[name] for name in build}, tables, graph)
+            for name in build:
+                arrays = {}
+                for source, store in matches[name].items():
+                    arrays[f"{source}__offsets"] = store.offsets
+                    arrays[f"{source}__days"] = store.days
+                    for column, values in store.columns.items():
+                        arrays[f"{source}__{column}"] = values
+                np.savez_compressed(self.directory / f"{name}.npz", **arrays)
+                self.manifest["codelists"][name] = {
+                    "sha": self.sha(registry[name], codes[name]),
+                    "codes_hash": codes_hash(codes[name]),
+                    "codes": sorted(normalise(codes[name])),
+                    "n_events": {source: len(store) for source, store in matches[name].items()},
+                }
+        (self.directory / "manifest.json").write_text(json.dumps(self.manifest, indent=2))
+        return {"built": build, "removed": removed}
+
+    def match(self, codes: dict, tables, graph: DependencyGraph = None) -> dict:
+        """
+        codelist -> {coding system -> EventStore of matching events}, with one
+        lookup of every code column in the inverted codelist index
+        """
+        index = CodeIndex(codes)
+        names = np.asarray(index.names)
+        if graph is None:
+            frames = read_tables(list(SOURCE_COLUMNS), tables, SOURCE_COLUMNS)
+        else:
+            frames = read_tables_for(graph, None, tables, within=SOURCE_COLUMNS)
+        stores = build_stores(frames, self.population)
+        matches = {name: {} for name in codes}
+        for source, (table, column, prefix_column) in SOURCES.items():
+            if table not in stores or len(stores[table]) == 0:
+                continue
+            store = stores[table]
+            store.columns["row"] = np.arange(len(store), dtype="int64")
+            pairs = []
+            for lookup_column in [column, prefix_column]:
+                if lookup_column is None:
+                    continue
+                values = pd.Series(store.columns[lookup_column]).astype("string").str.strip()
+                positions = index.lookup(values.fillna(""))
+                matched = np.flatnonzero(positions >= 0)
+                rows, codelist_ids = index.codelists_of(positions[matched])
+                pairs.append(pd.DataFrame({"codelist": codelist_ids, "row": matched[rows]}))
+            pairs = pd.concat(pairs, ignore_index=True).drop_duplicates()
+            # the matched code, as fixed-width strings (np.load reads no object arrays)
+            store.columns["code"] = pd.Series(store.columns[column]).fillna("").astype(str).to_numpy().astype("U")
+            keep = {"numeric_value", "code"} if table == "clinical_events" else {"admission_row", "code"}
+            for codelist_id, rows in pairs.groupby("codelist")["row"]:
+                mask = np.zeros(len(store), dtype=bool)
+                mask[rows.to_numpy()] = True
+                found = store.where(mask)
+                if table == "hospital_admissions":
+                    # several matching diagnoses of one admission count once
+                    found = found.distinct("admission_row")
+                    found.columns["row"] = found.columns["admission_row"]
+                found.columns = {name: values for name, values in found.columns.items() if name in keep | {"row"}}
+                matches[names[codelist_id]][source] = found
+        return matches
+
+    ## Reading ----
+    def store(self, name: str, source: str) -> EventStore:
+        """
+        matches of one codelist in one coding system (empty if it never occurs)
+        """
+        if (name, source) not in self._stores:
+            population = self.population
+            file = self.directory / f"{name}.npz"
+            if name not in self.manifest["codelists"]:
+                raise KeyError(f"codelist {name} is not in the feature store")
+            with np.load(file) as arrays:
+                prefix = f"{source}__"
+                if f"{prefix}offsets" in arrays:
+                    columns = {
+                        key[len(prefix):]: arrays[key]
+                        for key in arrays.files
+                        if key.startswith(prefix) and key not in (f"{prefix}offsets", f"{prefix}days")
+                    }
+                    store = EventStore(population, arrays[f"{prefix}offsets"], arrays[f"{prefix}days"], columns)
+                else:
+                    empty = {"row": np.array([], dtype="int64"), "code": np.array([], dtype="U1")}
+                    if source in ("snomed", "ctv3"):
+                        empty["numeric_value"] = np.array([], dtype="float64")
+                    store = EventStore(population, np.zeros(len(population) + 1, dtype="int64"), [], empty)
+            self._stores[(name, source)] = store
+        return self._stores[(name, source)]
+
+    def names_for(self, codes) -> list:
+        """
+        stored codelists making up `codes`: the codelist with exactly these codes,
+        or the stored codelists whose union is `codes` (e.g. `a + b` in the
+        dataset definition)
+        """
+        entries = self.manifest["codelists"]
+        by_hash = {entry["codes_hash"]: name for name, entry in entries.items()}
+        if codes_hash(codes) in by_hash:
+            return [by_hash[codes_hash(codes)]]
+        wanted, covered, names = normalise(codes), set(), []
+        for name in sorted(entries, key=lambda name: -len(entries[name]["codes"])):
+            subset = set(entries[name]["codes"])
+            if subset <= wanted and not subset <= covered:
+                names.append(name)
+                covered |= subset
+        if covered != wanted:
+            raise KeyError("codelist not in the feature store, add it to codelists.py and update the store")
+        return names
+
+    def events(self, codes, source: str) -> EventStore:
+        return merge_stores([self.store(name, source) for name in self.names_for(codes)])
+
+
+class FeatureQueries(BaselineQueries):
+    """
+    the helpers of BaselineQueries answered from a FeatureStore instead of the
+    raw event tables
+    """
+
+    def __init__(self, features: FeatureStore, baseline_date, memo=None):
+        self.features = features
+        self.stores = None
+        self.memo = Memo() if memo is None else memo
+        self.n_patients = len(features.population)
+        self.baseline = day_bounds(baseline_date, self.n_patients)
+        self.patients = None
+
+    @memoised
+    def events_snomed(self, codelist) -> EventStore:
+        return self.features.events(codelist, "snomed")
+
+    @memoised
+    def events_ctv3(self, codelist) -> EventStore:
+        return self.features.events(codelist, "ctv3")
+
+    @memoised
+    def prescriptions(self, codelist) -> EventStore:
+        return self.features.events(codelist, "dmd")
+
+    @memoised
+    def admissions(self, codelist) -> EventStore:
+        return self.features.events(codelist, "icd10")
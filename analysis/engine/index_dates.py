@@ -0,0 +1,113 @@
+#######################################################################################
+# Covariates at many index dates per patient (sequential trials)
+#######################################################################################
+# The helpers of BaselineQueries, evaluated for a table of (patient_id, index_date)
+# pairs instead of one baseline_date per patient. The CSR stores are not expanded
+# per pair: every pair's window is found with a binary search into its patient's
+# date-sorted events, so the cost is O((events + pairs) log events) however many
+# trial starts a patient has. for_patient_on() and spanning() of registrations and
+# addresses are answered by their interval indexes (engine/intervals.py): the period
+# of every pair is looked up once, and all its attributes are read from that row.
+import numpy as np
+import pandas as pd
+
+from engine.event_store import day_bounds
+from engine.intervals import PERIOD_RULES, IntervalIndex
+from engine.memo import Memo, memoised
+from engine.queries import BaselineQueries, shift_days
+
+# tables of periods (start_date, end_date), held as interval indexes
+PERIOD_TABLES = list(PERIOD_RULES)
+
+
+def build_period_stores(tables: dict, population) -> dict:
+    """
+    interval indexes of the period tables, for for_patient_on() and spanning()
+    """
+    return {
+        name: IntervalIndex.from_table(name, tables[name], population)
+        for name in PERIOD_TABLES
+        if name in tables
+    }
+
+
+class IndexDateQueries(BaselineQueries):
+    """
+    BaselineQueries for (patient_id, index_date) pairs: every helper returns one
+    value per row of `index_dates`, in its order. Pairs of patients outside the
+    population of the stores get empty windows (False / 0 / null)
+    """
+
+    def __init__(self, stores: dict, index_dates: pd.DataFrame, memo=None):
+        self.stores = stores
+        self.memo = Memo() if memo is None else memo
+        population = next(iter(stores.values())).population
+        patient_ids = index_dates["patient_id"].to_numpy(dtype="int64")
+        positions = np.searchsorted(population, patient_ids)
+        found = positions < len(population)
+        found[found] = population[positions[found]] == patient_ids[found]
+        self.patients = np.where(found, positions, -1)
+        self.index_dates = index_dates
+        self.n_patients = len(index_dates)
+        self.baseline = day_bounds(index_dates["index_date"].to_numpy(), self.n_patients)
+
+    ## FOR_PATIENT_ON (registrations and addresses spanning the index date)
+    @memoised
+    def _rows_on(self, table):
+        return self.stores[table].rows_on(self.baseline, self.patients)
+
+    def for_patient_on(self, table: str, column: str) -> np.ndarray:
+        """
+        `column` of the period of `table` ongoing on the index date, by the
+        preference rules of engine/intervals.py (null where there is none)
+        """
+        return self.periods_on(table, [column])[column].to_numpy()
+
+    def periods_on(self, table: str, columns) -> pd.DataFrame:
+        """
+        `exists` and `columns` of the period of `table` ongoing on the index
+        date, all from one lookup (shared by every helper of the same table)
+        """
+        return self.stores[table].on(self.baseline, columns, self.patients, rows=self._rows_on(table))
+
+    def has_period_on(self, table: str) -> np.ndarray:
+        return self._rows_on(table) >= 0
+
+    @memoised
+    def registered_spanning(self, days_before=366):
+        """
+        practice_registrations.spanning(index date - days_before, index date)
+        .exists_for_patient() (qa_bin_was_registered)
+        """
+        start = shift_days(self.baseline, -days_before)
+        return self.stores["practice_registrations"].spanning(start, self.baseline, self.patients)
+
+    def registration_on(self, column="practice_pseudo_id"):
+        return self.for_patient_on("practice_registrations", column)
+
+    def address_on(self, column="imd_rounded"):
+        return self.for_patient_on("addresses", column)
+
+    def evaluate(self, helpers: dict) -> pd.DataFrame:
+        """
+        one column per `name: (helper, *args)`, next to the index date pairs
+        """
+        out = self.index_dates[["patient_id", "index_date"]].reset_index(drop=True)
+        for name, (helper, *args) in helpers.items():
+            out[name] = getattr(self, helper)(*args)
+        return out
+
+
+def trial_index_dates(dataset: pd.DataFrame, n_trials: int, date_column="baseline_date") -> pd.DataFrame:
+    """
+    (patient_id, trial, index_date) of the sequential trials: trial k of a
+    patient starts k days after `date_column` (patients without one have none)
+    """
+    dataset = dataset[dataset[date_column].notna()]
+    trial = np.tile(np.arange(n_trials), len(dataset))
+    start = pd.to_datetime(dataset[date_column]).to_numpy().astype("datetime64[D]")
+    return pd.DataFrame({
+        "patient_id": np.repeat(dataset["patient_id"].to_numpy(dtype="int64"), n_trials),
+        "trial": trial,
+        "index_date": np.repeat(start, n_trials) + trial.astype("timedelta64[D]"),
+    })
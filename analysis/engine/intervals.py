@@ -0,0 +1,129 @@
+#######################################################################################
+# Per-patient interval index of registration and address periods
+#######################################################################################
+# The periods (start_date, end_date) of a patient are sorted into the order in which
+# for_patient_on() prefers them, so that the period chosen on a date is always the
+# last one of the patient's periods started by then that has not ended before it.
+# Next to the periods the index keeps the running maximum of their end dates, which
+# answers spanning(start, end).exists_for_patient() with one binary search, and
+# tells for_patient_on() that no period is ongoing without stepping through them.
+# All attributes of the chosen period are gathered from the same rows, so that one
+# pass over the query dates serves every variable taken from it.
+import numpy as np
+import pandas as pd
+
+from engine.event_store import DAY_SHIFT, DAY_SPAN, EventStore, day_bounds, to_days
+
+# an end_date that is missing means the period is ongoing
+OPEN_END = DAY_SHIFT - 1
+
+# the order of preference of overlapping periods, after "preferred" (periods where
+# this column is known come first) and the latest start_date: the latest end_date
+# (ongoing periods last longest), then the largest "tiebreak". addresses.has_postcode
+# is not in the dummy tables, a known msoa_code stands in for it
+PERIOD_RULES = {
+    "practice_registrations": {"preferred": None, "tiebreak": "practice_pseudo_id"},
+    "addresses": {"preferred": "msoa_code", "tiebreak": "address_id"},
+}
+
+
+class IntervalIndex:
+    """
+    periods of one table for a fixed (sorted) population, ordered by preference
+    within each patient (and preference level, see PERIOD_RULES)
+    """
+
+    def __init__(self, frame: pd.DataFrame, population, preferred=None, tiebreak=None):
+        self.population = np.asarray(population, dtype="int64")
+        patient_ids = frame["patient_id"].to_numpy(dtype="int64")
+        position = np.minimum(np.searchsorted(self.population, patient_ids), max(len(self.population) - 1, 0))
+        keep = (len(self.population) > 0) & (self.population[position] == patient_ids)
+        frame = frame[keep]
+        # preference levels are slots of their own: slot = position * n_levels + level
+        self.n_levels = 2 if preferred is not None else 1
+        level = frame[preferred].notna().to_numpy(dtype="int64") if preferred is not None else 0
+        slot = position[keep] * self.n_levels + level
+        start = to_days(frame["start_date"])
+        end = to_days(frame["end_date"])
+        end = np.where(end == EventStore.NULL, OPEN_END, end)
+        tiebreak = frame[tiebreak].fillna(np.iinfo(np.int64).min).to_numpy(dtype="int64") if tiebreak else np.zeros(len(frame), dtype="int64")
+        order = np.lexsort((tiebreak, end, start, slot))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(slot, minlength=len(self.population) * self.n_levels))])
+        columns = {name: frame[name].to_numpy()[order] for name in frame.columns if name != "patient_id"}
+        self.store = EventStore(np.arange(len(offsets) - 1), offsets, start[order], columns)
+        # running maximum of the end dates within a slot (periods without a
+        # start_date never span a date and do not count); both arrays end with a
+        # sentinel row, so that row -1 (no period) can be looked up
+        slot, start, end = slot[order], start[order], end[order]
+        shifted = np.where(start == EventStore.NULL, 0, end + DAY_SHIFT)
+        reach = np.maximum.accumulate(slot * DAY_SPAN + shifted) - slot * DAY_SPAN - DAY_SHIFT if len(slot) else shifted
+        self.ends = np.append(end, EventStore.NULL)
+        self.reach = np.append(reach, EventStore.NULL)
+
+    @classmethod
+    def from_table(cls, name: str, frame: pd.DataFrame, population):
+        return cls(frame, population, **PERIOD_RULES[name])
+
+    @property
+    def n_patients(self):
+        return len(self.population)
+
+    def _slots(self, level, patients):
+        patients = np.asarray(patients, dtype="int64")
+        return np.where(patients < 0, -1, patients * self.n_levels + level)
+
+    def rows_on(self, at, patients=None) -> np.ndarray:
+        """
+        row of the preferred period ongoing on `at` (started on or before it,
+        ended on or after it or not ended); -1 where there is none
+        """
+        if patients is None:
+            patients = np.arange(self.n_patients, dtype="int64")
+        at = day_bounds(at, len(patients))
+        found = np.full(len(patients), -1, dtype="int64")
+        for level in reversed(range(self.n_levels)):
+            open_ = np.flatnonzero(found < 0)
+            lo, hi = self.store.window(None, at[open_], self._slots(level, np.asarray(patients)[open_]))
+            # the running maximum tells whether a period is ongoing; if so, step
+            # back from the latest-starting one to the last that has not ended
+            row = hi - 1
+            hit = (hi > lo) & (self.reach[row] >= at[open_])
+            pending = hit.copy()
+            while pending.any():
+                index = np.flatnonzero(pending)
+                ended = self.ends[row[index]] < at[open_][index]
+                row[index[ended]] -= 1
+                pending[index[~ended]] = False
+            found[open_[hit]] = row[hit]
+        return found
+
+    def on(self, at, columns, patients=None, rows=None) -> pd.DataFrame:
+        """
+        `exists` and the `columns` of the period ongoing on `at`, one row per
+        patient (or entry of `patients`), from a single lookup (or the `rows`
+        of an earlier rows_on())
+        """
+        rows = self.rows_on(at, patients) if rows is None else rows
+        valid = rows >= 0
+        out = {"exists": valid}
+        for column in columns:
+            if column == "end_date":
+                values = self.ends[rows]
+                out[column] = np.where(values == OPEN_END, EventStore.NULL, values).astype("datetime64[D]")
+            else:
+                out[column] = self.store.gather("date" if column == "start_date" else column, rows, valid)
+        return pd.DataFrame(out)
+
+    def spanning(self, start, end, patients=None) -> np.ndarray:
+        """
+        whether a period started on or before `start` and ended after `end` (or
+        not ended): spanning(start, end).exists_for_patient()
+        """
+        if patients is None:
+            patients = np.arange(self.n_patients, dtype="int64")
+        start, end = day_bounds(start, len(patients)), day_bounds(end, len(patients))
+        exists = np.zeros(len(patients), dtype=bool)
+        for level in range(self.n_levels):
+            lo, hi = self.store.window(None, start, self._slots(level, patients))
+            exists |= (hi > lo) & (self.reach[hi - 1] > end) & (end != EventStore.NULL)
+        return exists
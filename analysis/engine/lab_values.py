@@ -0,0 +1,108 @@
+#######################################################################################
+# Several statistics of a lab value (numeric_value) in one pass
+#######################################################################################
+# HbA1c, cholesterol, HDL and BMI are each needed as more than one statistic (maximum
+# and its date, most recent value, ...). summarise_values() finds each patient's
+# events in the window once and derives every statistic from the same rows, so that
+# asking for another column of a lab never re-scans the events.
+import numpy as np
+
+from engine.event_store import EventStore, day_bounds, from_days
+
+# plausible ranges (inclusive) of the lab values, as cleaned in process_data.R;
+# None leaves that side open
+PLAUSIBLE_RANGES = {
+    "cholesterol": (1.75, 20),
+    "hdl_cholesterol": (0.4, 5),
+    "bmi": (12, 70),
+}
+
+STATISTICS = [
+    "count",
+    "last_value",
+    "last_date",
+    "max",
+    "max_date",
+    "min",
+    "mean",
+    "closest_value",
+    "closest_date",
+]
+
+
+def plausible(store: EventStore, valid_range, column="numeric_value") -> EventStore:
+    """
+    events with a value within `valid_range` (values outside, and missing
+    values, are dropped before any statistic is taken)
+    """
+    values = np.asarray(store.columns[column], dtype="float64")
+    keep = ~np.isnan(values)
+    low, high = valid_range if valid_range is not None else (None, None)
+    if low is not None:
+        keep &= values >= low
+    if high is not None:
+        keep &= values <= high
+    return store.where(keep)
+
+
+def summarise_values(
+    store: EventStore, baseline=None, start=None, end=None, valid_range=None, column="numeric_value", patients=None
+) -> dict:
+    """
+    per-patient statistics of `column` over the events dated on or between
+    `start` and `end`: count, last value and date, maximum and the date of
+    the latest maximum, minimum, mean and the value closest to `baseline`
+    (the later one on ties). Patients without events get NaN / NaT (count 0).
+    With `patients` the statistics are per entry, see EventStore.window()
+    """
+    store = plausible(store, valid_range, column)
+    lo, hi = store.window(start, end, patients)
+    n = len(lo)
+    lengths = hi - lo
+    has = lengths > 0
+    # the rows of all windows concatenated; `member` is the window of each row
+    starts = np.concatenate([[0], np.cumsum(lengths[has])[:-1]]).astype("int64")
+    rows = np.repeat(lo[has] - starts, lengths[has]) + np.arange(lengths.sum())
+    member = np.repeat(np.arange(has.sum()), lengths[has])
+    values = np.asarray(store.columns[column], dtype="float64")[rows]
+    days = store.days[rows]
+    local = np.arange(len(rows))
+
+    def per_patient(reduced, fill=np.nan, dtype="float64"):
+        out = np.full(n, fill, dtype=dtype)
+        out[has] = reduced
+        return out
+
+    def dates(reduced_rows, valid=True):
+        return from_days(per_patient(np.where(valid, days[reduced_rows], EventStore.NULL), EventStore.NULL, "int64"))
+
+    def last_where(selected):
+        # per window, the last row where `selected` (rows are in date order)
+        return np.maximum.reduceat(np.where(selected, local, -1), starts)
+
+    out = {"count": lengths.astype("int64")}
+    if not len(rows):
+        for name in STATISTICS[1:]:
+            out[name] = from_days(np.full(n, EventStore.NULL)) if name.endswith("_date") else np.full(n, np.nan)
+        return out
+
+    last = starts + lengths[has] - 1
+    out["last_value"] = per_patient(values[last])
+    out["last_date"] = dates(last)
+    maximum = np.maximum.reduceat(values, starts)
+    out["max"] = per_patient(maximum)
+    out["max_date"] = dates(last_where(values == maximum[member]))
+    out["min"] = per_patient(np.minimum.reduceat(values, starts))
+    out["mean"] = per_patient(np.add.reduceat(values, starts) / lengths[has])
+    if baseline is None:
+        out["closest_value"] = np.full(n, np.nan)
+        out["closest_date"] = from_days(np.full(n, EventStore.NULL))
+    else:
+        baseline = day_bounds(baseline, n)[has][member]
+        undated = (baseline == EventStore.NULL) | (days == EventStore.NULL)
+        distance = np.where(undated, np.inf, np.abs(np.where(undated, 0, days - baseline)).astype("float64"))
+        closest = last_where(distance == np.minimum.reduceat(distance, starts)[member])
+        found = np.isfinite(distance[closest])
+        out["closest_value"] = per_patient(np.where(found, values[closest], np.nan))
+        out["closest_date"] = dates(closest, found)
+    return out
@@ -0,0 +1,139 @@
+#######################################################################################
+# Hash-consing and memoisation of query nodes
+#######################################################################################
+# A query node is identified by a structural key: the helper (or restriction) name
+# plus its normalised arguments. Codelists are normalised to frozensets, so that
+# `a + b + c` and `c + a + b` are the same node. Each distinct node is evaluated
+# once per run; repeated requests are served from the cache and counted. Keys of
+# helper methods also carry the stores the instance reads (by identity) and a
+# fingerprint of its baseline dates and population positions, so that a memo
+# shared between instances never serves a result computed from other tables or
+# for other dates or patients.
+import hashlib
+import inspect
+from collections import Counter
+from functools import wraps
+
+import numpy as np
+import pandas as pd
+
+
+def node_key(name: str, *args) -> tuple:
+    """
+    structural key of a query node
+    """
+    return (name,) + tuple(normalise(arg) for arg in args)
+
+
+def normalise(arg):
+    if isinstance(arg, (list, tuple, set, frozenset)):
+        return frozenset(str(code) for code in arg)
+    if isinstance(arg, dict):  # categorised codelists
+        return frozenset((str(code), str(category)) for code, category in arg.items())
+    return arg
+
+
+class Memo:
+    """
+    cache of evaluated query nodes with counts of requests per node
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.requests = Counter()
+
+    def get(self, key: tuple, compute):
+        self.requests[key] += 1
+        if key not in self.values:
+            self.values[key] = compute()
+        return self.values[key]
+
+    def clear(self):
+        self.values.clear()
+        self.requests.clear()
+
+    @property
+    def n_requested(self) -> int:
+        return sum(self.requests.values())
+
+    @property
+    def n_evaluated(self) -> int:
+        return len(self.requests)
+
+    @property
+    def n_saved(self) -> int:
+        return self.n_requested - self.n_evaluated
+
+    def report(self) -> pd.DataFrame:
+        """
+        one row per node requested more than once, with the evaluations saved
+        """
+        rows = [
+            {
+                "node": key[0],
+                "n_codes": len(key[1]) if len(key) > 1 and isinstance(key[1], frozenset) else None,
+                "n_requested": n,
+                "n_saved": n - 1,
+            }
+            for key, n in self.requests.items()
+            if n > 1
+        ]
+        report = pd.DataFrame(rows, columns=["node", "n_codes", "n_requested", "n_saved"])
+        return report.sort_values("n_saved", ascending=False, ignore_index=True)
+
+    def summary(self) -> str:
+        return (
+            f"{self.n_requested} query nodes requested, {self.n_evaluated} evaluated, "
+            f"{self.n_saved} evaluations saved"
+        )
+
+
+def array_digest(values) -> str:
+    if values is None:
+        return None
+    values = np.ascontiguousarray(values)
+    digest = hashlib.blake2b(f"{values.dtype}:{values.shape}".encode(), digest_size=16)
+    digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+def store_identity(queries) -> tuple:
+    """
+    the stores (or feature store) of `queries`, hashed by identity; the key
+    holds them, so that their ids are not reused while the memo lives
+    """
+    stores = getattr(queries, "stores", None) or {}
+    return tuple(sorted(stores.items(), key=lambda item: item[0])) + (getattr(queries, "features", None),)
+
+
+def memo_scope(queries) -> tuple:
+    """
+    fingerprint of what a query helper's result depends on besides its
+    arguments: the stores, baseline dates and population positions of
+    `queries` (the digests are recomputed only when an attribute is replaced)
+    """
+    baseline, patients = getattr(queries, "baseline", None), getattr(queries, "patients", None)
+    cached = queries.__dict__.get("_memo_scope")
+    if cached is None or cached[0] is not baseline or cached[1] is not patients:
+        cached = (baseline, patients, (array_digest(baseline), array_digest(patients)))
+        queries.__dict__["_memo_scope"] = cached
+    return store_identity(queries) + cached[2]
+
+
+def memoised(method):
+    """
+    decorator for query helper methods taking a codelist: evaluate each
+    structurally distinct call once per `self.memo` and scope (positional
+    and keyword arguments are bound to the signature, defaults filled in)
+    """
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = list(bound.arguments.items())[1:]
+        key = node_key(method.__name__, *(value for _, value in arguments)) + (memo_scope(self),)
+        return self.memo.get(key, lambda: method(self, *args, **kwargs))
+
+    return wrapper
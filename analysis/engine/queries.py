@@ -0,0 +1,229 @@
+#######################################################################################
+# Query helpers of analysis/dataset_definition.py on top of the CSR event stores
+#######################################################################################
+# Method names and windows follow the FUNCTIONS section of the dataset definition,
+# e.g. `prior_event_date_ctv3(codelist)` is the date of the latest matching
+# clinical event on or before baseline_date. Results are numpy arrays aligned to
+# the population of the stores (one value per patient).
+import numpy as np
+
+from engine.event_store import EventStore, day_bounds
+from engine.lab_values import PLAUSIBLE_RANGES, summarise_values
+from engine.memo import Memo, memoised
+from engine.tables import TABLES, explode_diagnoses
+
+# event tables that are held as CSR stores
+EVENT_TABLES = ["clinical_events", "medications", "hospital_admissions"]
+
+
+def build_stores(tables: dict, population) -> dict:
+    """
+    sort the event tables once into CSR stores for the given population
+    (hospital admissions are exploded to one row per diagnosis code)
+    """
+    stores = {}
+    for name in EVENT_TABLES:
+        if name not in tables:
+            continue
+        frame = tables[name]
+        if name == "hospital_admissions":
+            frame = explode_diagnoses(frame)
+        stores[name] = EventStore.from_frame(frame, population, TABLES[name]["date_column"])
+    return stores
+
+
+def shift_days(days, n: int) -> np.ndarray:
+    """
+    per-patient date bound shifted by n days, keeping nulls (baseline_date - days(n))
+    """
+    if days is None:
+        return None
+    days = np.asarray(days, dtype="int64")
+    return np.where(days == EventStore.NULL, EventStore.NULL, days + n)
+
+
+class BaselineQueries:
+    """
+    the helper functions of the dataset definition, evaluated against CSR
+    stores for one per-patient baseline date. Structurally identical calls
+    (same helper, same codes) are evaluated once, see engine/memo.py; a memo
+    shared between instances only serves results of the same baseline dates
+    and patients
+    """
+
+    def __init__(self, stores: dict, baseline_date, memo=None):
+        self.stores = stores
+        self.memo = Memo() if memo is None else memo
+        population = next(iter(stores.values())).population
+        self.n_patients = len(population)
+        self.baseline = day_bounds(baseline_date, self.n_patients)
+        # population positions the outputs are aligned to (None: one per patient)
+        self.patients = None
+
+    ## Restrictions to a codelist ----
+    @memoised
+    def events_snomed(self, codelist) -> EventStore:
+        return self.stores["clinical_events"].matching("snomedct_code", codelist)
+
+    @memoised
+    def events_ctv3(self, codelist) -> EventStore:
+        return self.stores["clinical_events"].matching("ctv3_code", codelist)
+
+    @memoised
+    def prescriptions(self, codelist) -> EventStore:
+        return self.stores["medications"].matching("dmd_code", codelist)
+
+    @memoised
+    def admissions(self, codelist) -> EventStore:
+        # several matching diagnoses of one admission count once
+        return (
+            self.stores["hospital_admissions"]
+            .matching("diagnosis", codelist, prefix_column="diagnosis_3")
+            .distinct("admission_row")
+        )
+
+    ### PRIMARY CARE
+    ## EVER BEFORE BASELINE DATE (any history of)
+    @memoised
+    def has_prior_event_snomed(self, codelist):
+        return self.events_snomed(codelist).exists(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def has_prior_event_ctv3(self, codelist):
+        return self.events_ctv3(codelist).exists(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def prior_event_date_snomed(self, codelist):
+        return self.events_snomed(codelist).last(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def prior_event_date_ctv3(self, codelist):
+        return self.events_ctv3(codelist).last(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def prior_events_count_ctv3(self, codelist):
+        return self.events_ctv3(codelist).count(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def has_prior_prescription(self, codelist):
+        return self.prescriptions(codelist).exists(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def has_prior_prescription_date(self, codelist):
+        return self.prescriptions(codelist).last(end=self.baseline, patients=self.patients)
+
+    ## 2y BEFORE BASELINE DATE
+    @memoised
+    def recent_value_2y_snomed(self, codelist):
+        return self.events_snomed(codelist).reduce(
+            "numeric_value", np.fmax, start=shift_days(self.baseline, -2 * 366), end=self.baseline,
+            patients=self.patients,
+        )
+
+    @memoised
+    def recent_value_2y_ctv3(self, codelist):
+        return self.events_ctv3(codelist).reduce(
+            "numeric_value", np.fmax, start=shift_days(self.baseline, -2 * 366), end=self.baseline,
+            patients=self.patients,
+        )
+
+    ## Lab values: every statistic of engine/lab_values.py from one pass over
+    ## the events, `lab` selects the plausible range (e.g. "cholesterol")
+    @memoised
+    def lab_values_2y_snomed(self, codelist, lab=None):
+        return summarise_values(
+            self.events_snomed(codelist), self.baseline, start=shift_days(self.baseline, -2 * 366),
+            end=self.baseline, valid_range=PLAUSIBLE_RANGES.get(lab), patients=self.patients,
+        )
+
+    @memoised
+    def lab_values_2y_ctv3(self, codelist, lab=None):
+        return summarise_values(
+            self.events_ctv3(codelist), self.baseline, start=shift_days(self.baseline, -2 * 366),
+            end=self.baseline, valid_range=PLAUSIBLE_RANGES.get(lab), patients=self.patients,
+        )
+
+    @memoised
+    def prior_lab_values_ctv3(self, codelist, lab=None):
+        # ever before baseline, e.g. tmp_cov_num_max_hba1c_mmol_mol and tmp_cov_date_max_hba1c
+        return summarise_values(
+            self.events_ctv3(codelist), self.baseline, end=self.baseline, valid_range=PLAUSIBLE_RANGES.get(lab),
+            patients=self.patients,
+        )
+
+    ## BMI: most_recent_bmi() of the dataset definition (cov_num_bmi)
+    def most_recent_bmi(self, date_of_birth, minimum_age_at_measurement=16, codelist=("22K..",)):
+        """
+        value and date of the latest BMI recorded after baseline_date - 2*366
+        days, on or after the patient turned `minimum_age_at_measurement`
+        (not bounded by baseline_date, as in the definition). A value outside
+        PLAUSIBLE_RANGES["bmi"] is then set to NaN, as process_data.R does,
+        without falling back to an earlier measurement. `date_of_birth` has
+        one date per output row, so this helper is not memoised
+        """
+        n = len(self.baseline)
+        birth = day_bounds(date_of_birth, n)
+        after = shift_days(self.baseline, -2 * 366 + 1)
+        aged = shift_days(birth, int(365.25 * minimum_age_at_measurement))
+        start = np.where((after == EventStore.NULL) | (aged == EventStore.NULL), EventStore.NULL, np.maximum(after, aged))
+        events = self.events_ctv3(list(codelist))
+        lo, hi = events.window(start, None, self.patients)
+        value = events.gather("numeric_value", hi - 1, hi > lo).astype("float64")
+        low, high = PLAUSIBLE_RANGES["bmi"]
+        value[(value < low) | (value > high)] = np.nan
+        return {"value": value, "date": events.gather("date", hi - 1, hi > lo)}
+
+    ## 6M and 14 Days BEFORE BASELINE DATE (only for prescription data)
+    @memoised
+    def has_prior_prescription_6m(self, codelist):
+        return self.prescriptions(codelist).exists(
+            start=shift_days(self.baseline, -183), end=self.baseline, patients=self.patients
+        )
+
+    @memoised
+    def has_prior_prescription_6m_date(self, codelist):
+        return self.prescriptions(codelist).last(
+            start=shift_days(self.baseline, -183), end=self.baseline, patients=self.patients
+        )
+
+    @memoised
+    def has_prior_prescription_14d(self, codelist):
+        return self.prescriptions(codelist).exists(
+            start=shift_days(self.baseline, -14), end=self.baseline, patients=self.patients
+        )
+
+    @memoised
+    def has_prior_prescription_14d_date(self, codelist):
+        return self.prescriptions(codelist).last(
+            start=shift_days(self.baseline, -14), end=self.baseline, patients=self.patients
+        )
+
+    ### HOSPITAL ADMISSIONS (HES APC)
+    @memoised
+    def has_prior_admission(self, codelist):
+        return self.admissions(codelist).exists(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def prior_admission_date(self, codelist):
+        return self.admissions(codelist).last(end=self.baseline, patients=self.patients)
+
+    @memoised
+    def prior_admissions_count(self, codelist):
+        return self.admissions(codelist).count(end=self.baseline, patients=self.patients)
+
+    ### AFTER BASELINE DATE (outcomes and exposure)
+    @memoised
+    def first_event_date_snomed(self, codelist):
+        return self.events_snomed(codelist).first(start=self.baseline, patients=self.patients)
+
+    @memoised
+    def first_event_date_ctv3(self, codelist):
+        return self.events_ctv3(codelist).first(start=self.baseline, patients=self.patients)
+
+    @memoised
+    def first_prescription_date(self, codelist):
+        return self.prescriptions(codelist).first(start=self.baseline, patients=self.patients)
+
+    @memoised
+    def first_admission_date(self, codelist):
+        return self.admissions(codelist).first(start=self.baseline, patients=self.patients)
@@ -0,0 +1,130 @@
+#######################################################################################
+# Deterministic patient subsampling of the source tables
+#######################################################################################
+# A patient is in the sample when a keyed hash of its patient_id, read as a number
+# in [0, 1), is below the sampling fraction. The hash depends on nothing but the
+# patient_id and the key, so the same patients are drawn from every table (patients,
+# events, registrations, ...), in every run and on every machine, and the sample of
+# a smaller fraction is a subset of the sample of a larger one with the same key.
+# The active sample is applied by the readers of engine/tables.py to every frame or
+# chunk they read, so that everything downstream (stores, chunked extraction, ehrQL
+# on the chunk tables) only sees the sampled patients. Fractions may differ between
+# the strata of a column already computed per patient (e.g. cov_bin_pos_covid of an
+# earlier extraction), to keep rare groups represented; patients missing from the
+# strata file are sampled at the default fraction.
+import hashlib
+import json
+
+import numpy as np
+import pandas as pd
+
+from engine.dataset_io import read_dataset
+
+SAMPLE_KEY = "patient-sample"
+
+_active = None
+
+
+def patient_hash(patient_ids, key=SAMPLE_KEY) -> np.ndarray:
+    """
+    keyed hash of each patient_id as a float in [0, 1): the 64-bit mix of
+    pandas' hash_array() (which takes no key for numbers) applied twice, with
+    halves of a digest of `key` xor-ed in before each round
+    """
+    salt = np.frombuffer(hashlib.blake2b(key.encode(), digest_size=16).digest(), dtype="<u8")
+    hashes = np.asarray(patient_ids, dtype="int64").view("uint64")
+    for half in salt:
+        hashes = pd.util.hash_array(hashes ^ half, categorize=False)
+    return (hashes >> np.uint64(11)).astype("float64") / 2.0**53
+
+
+class PatientSample:
+    """
+    the patients whose hash is below `fraction`, or below `fractions[stratum]`
+    for patients in a stratum of `strata` (patient_id -> stratum)
+    """
+
+    def __init__(self, fraction: float, key=SAMPLE_KEY, strata: pd.Series = None, fractions=None):
+        if not 0 <= fraction <= 1 or not all(0 <= f <= 1 for f in (fractions or {}).values()):
+            raise ValueError("sampling fractions must be between 0 and 1")
+        self.fraction, self.key = fraction, key
+        self.fractions = {str(stratum): f for stratum, f in (fractions or {}).items()}
+        self.ids, self.id_fractions = np.array([], dtype="int64"), np.array([], dtype="float64")
+        if strata is not None and self.fractions:
+            strata = strata.astype("string")
+            fraction_of = strata.map(self.fractions).astype("float64").fillna(fraction)
+            order = np.argsort(strata.index.to_numpy(dtype="int64"), kind="stable")
+            self.ids = strata.index.to_numpy(dtype="int64")[order]
+            self.id_fractions = fraction_of.to_numpy()[order]
+
+    @classmethod
+    def stratified(cls, fraction: float, path, column: str, fractions: dict, key=SAMPLE_KEY):
+        """
+        strata from `column` of an extracted dataset (e.g. output/dataset.arrow)
+        """
+        frame = read_dataset(path, columns=["patient_id", column])
+        return cls(fraction, key, frame.set_index("patient_id")[column], fractions)
+
+    def fractions_of(self, patient_ids) -> np.ndarray:
+        patient_ids = np.asarray(patient_ids, dtype="int64")
+        out = np.full(len(patient_ids), self.fraction)
+        if len(self.ids):
+            position = np.minimum(np.searchsorted(self.ids, patient_ids), len(self.ids) - 1)
+            found = self.ids[position] == patient_ids
+            out[found] = self.id_fractions[position[found]]
+        return out
+
+    def keep(self, patient_ids) -> np.ndarray:
+        return patient_hash(patient_ids, self.key) < self.fractions_of(patient_ids)
+
+    def filter(self, frame: pd.DataFrame) -> pd.DataFrame:
+        return frame[self.keep(frame["patient_id"].to_numpy(dtype="int64"))]
+
+    def signature(self) -> str:
+        """
+        fingerprint of what is sampled, for caches of sampled tables
+        """
+        description = {"fraction": self.fraction, "key": self.key, "fractions": self.fractions}
+        digest = hashlib.sha1(json.dumps(description, sort_keys=True).encode())
+        digest.update(self.ids.tobytes())
+        digest.update(self.id_fractions.tobytes())
+        return digest.hexdigest()
+
+
+def use_sample(sample: PatientSample = None):
+    """
+    make `sample` the sample of all table reads from now on (None: no sampling)
+    """
+    global _active
+    _active = sample
+
+
+def active_sample() -> PatientSample:
+    return _active
+
+
+def add_sample_arguments(parser):
+    parser.add_argument("--sample", type=float, default=None, metavar="FRACTION",
+                        help="read only this fraction of patients (by a keyed hash of patient_id)")
+    parser.add_argument("--sample-key", default=SAMPLE_KEY, help="hash key; the same key draws the same patients")
+    parser.add_argument("--sample-by", nargs=2, default=None, metavar=("DATASET", "COLUMN"),
+                        help="stratify the sample by a column of an extracted dataset")
+    parser.add_argument("--sample-fraction", nargs=2, action="append", default=[], metavar=("STRATUM", "FRACTION"),
+                        help="sampling fraction of one stratum of --sample-by (e.g. True 1)")
+
+
+def sample_from_args(args) -> PatientSample:
+    """
+    the sample of the command-line arguments of add_sample_arguments(), made
+    active (None when --sample is not given)
+    """
+    if args.sample is None:
+        use_sample(None)
+        return None
+    fractions = {stratum: float(fraction) for stratum, fraction in args.sample_fraction}
+    if args.sample_by:
+        sample = PatientSample.stratified(args.sample, *args.sample_by, fractions, key=args.sample_key)
+    else:
+        sample = PatientSample(args.sample, args.sample_key)
+    use_sample(sample)
+    return sample
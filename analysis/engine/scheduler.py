@@ -0,0 +1,240 @@
+#######################################################################################
+# Content-addressed local runner of project.yaml actions
+#######################################################################################
+# Actions are read from project.yaml (and files extending it in the same format,
+# which may also declare `inputs`: code and data files other than those named in
+# the run command). The key of an action is a hash of its run command, the
+# contents of its code and input files and the contents of the outputs of the
+# actions it needs; an action whose key and outputs are unchanged since its last
+# successful run is a cache hit and is not run again. Keys are computed once all
+# needed actions are done, so an upstream action that re-runs but writes the same
+# outputs leaves everything downstream cached. Independent actions run
+# concurrently on a pool of workers.
+import fnmatch
+import glob
+import hashlib
+import json
+import shlex
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import pandas as pd
+import yaml
+
+STATE_DIR = "output/.actions"
+
+
+class Action:
+    def __init__(self, name: str, spec: dict):
+        self.name = name
+        self.run = spec["run"]
+        self.needs = list(spec.get("needs", []))
+        self.inputs = list(spec.get("inputs", []))
+        self.outputs = [
+            pattern for files in spec.get("outputs", {}).values() for pattern in files.values()
+        ]
+
+    def command(self) -> list:
+        """
+        the run command without its image: python scripts run with this
+        interpreter, R scripts with Rscript, ehrQL with the ehrql command
+        """
+        image, *args = shlex.split(self.run)
+        if image.startswith("python:") and args[:1] == ["python"]:
+            return [sys.executable, *args[1:]]
+        if image.startswith("r:"):
+            return ["Rscript", *args]
+        if image.startswith("ehrql:"):
+            return ["ehrql", *args]
+        return [image.split(":")[0], *args]
+
+    def code_files(self) -> list:
+        """
+        files named in the run command other than the action's own outputs
+        (e.g. --output output/dataset.arrow), and the declared inputs (globs)
+        """
+        named = [
+            arg for arg in shlex.split(self.run)[1:]
+            if Path(arg).is_file() and not any(fnmatch.fnmatch(arg, pattern) for pattern in self.outputs)
+        ]
+        declared = [file for pattern in self.inputs for file in sorted(glob.glob(pattern, recursive=True))]
+        return sorted(set(named + declared))
+
+
+def load_actions(paths) -> dict:
+    """
+    actions of project.yaml-style files; an action defined again in a later
+    file replaces the earlier definition
+    """
+    actions = {}
+    for path in paths:
+        with open(path) as f:
+            specs = yaml.safe_load(f).get("actions") or {}
+        actions.update({name: Action(name, spec) for name, spec in specs.items()})
+    for action in actions.values():
+        unknown = [need for need in action.needs if need not in actions]
+        if unknown:
+            raise ValueError(f"{action.name} needs unknown actions {unknown}")
+    return actions
+
+
+class FileHashes:
+    """
+    sha256 of file contents, cached by (size, mtime) between runs
+    """
+
+    def __init__(self, cache: dict):
+        self.cache = cache
+
+    def __call__(self, path) -> str:
+        stat = Path(path).stat()
+        signature = [stat.st_size, stat.st_mtime_ns]
+        cached = self.cache.get(str(path))
+        if cached is not None and cached[:2] == signature:
+            return cached[2]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        self.cache[str(path)] = [*signature, digest.hexdigest()]
+        return digest.hexdigest()
+
+
+class Scheduler:
+    def __init__(self, actions: dict, state_dir=STATE_DIR, workers=4):
+        self.actions = actions
+        self.state_dir = Path(state_dir)
+        self.workers = workers
+        state_file = self.state_dir / "state.json"
+        self.state = json.loads(state_file.read_text()) if state_file.exists() else {"actions": {}, "files": {}}
+        self.digest = FileHashes(self.state["files"])
+
+    def required(self, targets=None) -> list:
+        """
+        the targets and everything they need, in dependency order
+        """
+        order, seen = [], set()
+
+        def visit(name, path=()):
+            if name in path:
+                raise ValueError(f"cycle in needs: {' -> '.join([*path, name])}")
+            if name in seen:
+                return
+            for need in self.actions[name].needs:
+                visit(need, (*path, name))
+            seen.add(name)
+            order.append(name)
+
+        for name in targets or self.actions:
+            if name not in self.actions:
+                raise ValueError(f"unknown action {name}")
+            visit(name)
+        return order
+
+    def outputs(self, action: Action) -> dict:
+        files = {}
+        for pattern in action.outputs:
+            matches = sorted(glob.glob(pattern, recursive=True))
+            if not matches:
+                raise FileNotFoundError(f"{action.name}: no output matches {pattern}")
+            files.update({file: self.digest(file) for file in matches})
+        return files
+
+    def key(self, action: Action) -> str:
+        digest = hashlib.sha256(action.run.encode())
+        for file in action.code_files():
+            digest.update(f"{file}:{self.digest(file)}".encode())
+        for need in sorted(action.needs):
+            digest.update(json.dumps(self.state["actions"][need]["outputs"], sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def cached(self, action: Action, key: str) -> bool:
+        previous = self.state["actions"].get(action.name)
+        if previous is None or previous["key"] != key:
+            return False
+        try:
+            return self.outputs(action) == previous["outputs"]
+        except FileNotFoundError:
+            return False
+
+    def execute(self, action: Action) -> tuple:
+        log = self.state_dir / "logs" / f"{action.name}.log"
+        start = time.perf_counter()
+        with open(log, "w") as f:
+            try:
+                returncode = subprocess.run(action.command(), stdout=f, stderr=subprocess.STDOUT).returncode
+            except FileNotFoundError as error:  # executable not installed
+                f.write(f"{error}\n")
+                returncode = 127
+        return returncode, time.perf_counter() - start
+
+    def run(self, targets=None, force=(), dry_run=False) -> pd.DataFrame:
+        """
+        run the actions needed for `targets` (default: all) that are not cached;
+        `force` names actions to run regardless. Returns one row per action with
+        its status (cached / ran / failed / skipped / stale for a dry run), its
+        time and, for cache hits, the time of the run that is reused
+        """
+        (self.state_dir / "logs").mkdir(parents=True, exist_ok=True)
+        order = self.required(targets)
+        status, report = {}, {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while len(status) < len(order):
+                for name in order:
+                    action = self.actions[name]
+                    if name in status or name in running.values():
+                        continue
+                    if any(status.get(need) in ("failed", "skipped", "stale") for need in action.needs):
+                        status[name] = "skipped" if not dry_run else "stale"
+                        report[name] = {"action": name, "status": status[name], "seconds": 0.0}
+                        continue
+                    if not all(status.get(need) in ("cached", "ran") for need in action.needs):
+                        continue
+                    start = time.perf_counter()
+                    key = self.key(action)
+                    if name not in force and self.cached(action, key):
+                        status[name] = "cached"
+                        report[name] = {
+                            "action": name,
+                            "status": "cached",
+                            "seconds": time.perf_counter() - start,
+                            "seconds_saved": self.state["actions"][name].get("seconds"),
+                            "key": key[:12],
+                        }
+                    elif dry_run:
+                        status[name] = "stale"
+                        report[name] = {"action": name, "status": "stale", "seconds": 0.0, "key": key[:12]}
+                    else:
+                        running[pool.submit(self.execute, action)] = name
+                        report[name] = {"action": name, "key": key}
+                if len(status) == len(order):
+                    break
+                if not running:
+                    continue
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    action = self.actions[name]
+                    returncode, seconds = future.result()
+                    entry = report[name]
+                    key, entry["key"], entry["seconds"] = entry["key"], entry["key"][:12], seconds
+                    try:
+                        outputs = self.outputs(action) if returncode == 0 else None
+                    except FileNotFoundError:
+                        outputs = None
+                    if outputs is None:
+                        status[name] = entry["status"] = "failed"
+                        self.state["actions"].pop(name, None)
+                    else:
+                        status[name] = entry["status"] = "ran"
+                        self.state["actions"][name] = {"key": key, "outputs": outputs, "seconds": seconds}
+                    self.save()
+        self.save()
+        return pd.DataFrame([report[name] for name in order], columns=["action", "status", "seconds", "seconds_saved", "key"])
+
+    def save(self):
+        (self.state_dir / "state.json").write_text(json.dumps(self.state, indent=1))
@@ -0,0 +1,293 @@
+#######################################################################################
+# Mergeable one-pass summaries of dataset columns
+#######################################################################################
+# Every column of an extracted dataset is summarised by sketches that are filled
+# batch by batch and that merge: counts, null counts, min/max, category and
+# true/false frequencies and monthly date histograms merge exactly; quantiles of
+# numeric columns are a t-digest and distinct counts a HyperLogLog, which merge
+# with their usual approximation error. Sketches of shards of the population (or
+# of earlier runs of the same file) can therefore be combined into the summary of
+# the whole dataset without reading the data again. The kind of a column comes
+# from its name (_num_, _cat_, _bin_, _date_ as in the dataset definition), else
+# from its type.
+import base64
+import json
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+HASH_KEY = "0123456789abcdef"  # fixed, so that hashes agree between shards and runs
+
+
+class TDigest:
+    """
+    merging t-digest (arcsine scale function) of a numeric column
+    """
+
+    def __init__(self, compression=200, means=(), weights=()):
+        self.compression = compression
+        self.means = np.asarray(means, dtype="float64")
+        self.weights = np.asarray(weights, dtype="float64")
+
+    @property
+    def total(self) -> float:
+        return float(self.weights.sum())
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind="stable")
+        means, weights = means[order], weights[order]
+        if len(means) <= 1:
+            return means, weights
+        # centroids are merged while they fall into the same unit of the scale
+        # k(q) = compression / (2 pi) * asin(2q - 1), which keeps the tails fine
+        cumulative = np.cumsum(weights)
+        q_mid = (cumulative - weights / 2) / cumulative[-1]
+        k = np.floor(self.compression / (2 * np.pi) * np.arcsin(2 * q_mid - 1))
+        starts = np.flatnonzero(np.concatenate([[True], k[1:] != k[:-1]]))
+        merged_weights = np.add.reduceat(weights, starts)
+        merged_means = np.add.reduceat(means * weights, starts) / merged_weights
+        return merged_means, merged_weights
+
+    def update(self, values):
+        values = np.asarray(values, dtype="float64")
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.means, self.weights = self._compress(
+                np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))])
+            )
+
+    def merge(self, other: "TDigest") -> "TDigest":
+        digest = TDigest(self.compression)
+        digest.means, digest.weights = self._compress(
+            np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights])
+        )
+        return digest
+
+    def quantile(self, q, minimum=None, maximum=None):
+        """
+        interpolated between centroid midpoints, anchored at the exact min/max
+        """
+        if not len(self.means):
+            return np.full(np.shape(q), np.nan)
+        cumulative = np.cumsum(self.weights)
+        positions = (cumulative - self.weights / 2) / cumulative[-1]
+        means = self.means
+        if minimum is not None:
+            positions, means = np.concatenate([[0.0], positions, [1.0]]), np.concatenate([[minimum], means, [maximum]])
+        return np.interp(q, positions, means)
+
+    def to_dict(self) -> dict:
+        return {"compression": self.compression, "means": self.means.tolist(), "weights": self.weights.tolist()}
+
+
+class HyperLogLog:
+    """
+    distinct count sketch with 2 ** precision one-byte registers
+    """
+
+    def __init__(self, precision=14, registers=None):
+        self.precision = precision
+        self.registers = np.zeros(2**precision, dtype="uint8") if registers is None else np.asarray(registers, dtype="uint8")
+
+    def update(self, values: np.ndarray):
+        """
+        add non-missing values; a column must always be given in the same
+        dtype, for its hashes to agree between batches and shards
+        """
+        if not len(values):
+            return
+        hashes = pd.util.hash_array(np.asarray(values), hash_key=HASH_KEY, categorize=True)
+        p = self.precision
+        index = (hashes >> np.uint64(64 - p)).astype("int64")
+        rest = (hashes & np.uint64((1 << (64 - p)) - 1)).astype("float64")  # < 2 ** 53, exact
+        bit_length = np.where(rest > 0, np.frexp(rest)[1], 0)
+        rank = (64 - p - bit_length + 1).astype("uint8")
+        np.maximum.at(self.registers, index, rank)
+
+    def merge(self, other: "HyperLogLog") -> "HyperLogLog":
+        return HyperLogLog(self.precision, np.maximum(self.registers, other.registers))
+
+    def estimate(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(2.0 ** -self.registers.astype("float64"))
+        zeros = int(np.sum(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            return m * np.log(m / zeros)  # linear counting for small cardinalities
+        return float(raw)
+
+    def to_dict(self) -> dict:
+        return {"precision": self.precision, "registers": base64.b64encode(self.registers.tobytes()).decode()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "HyperLogLog":
+        return cls(data["precision"], np.frombuffer(base64.b64decode(data["registers"]), dtype="uint8").copy())
+
+
+def column_kind(name: str, values: pd.Series) -> str:
+    """
+    num / cat / bin / date from the name of a dataset column, else its type
+    """
+    tokens = name.split("_")
+    for kind in ("date", "bin", "cat", "num"):
+        if kind in tokens[:-1] or tokens[-1] == kind:
+            return kind
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return "date"
+    if pd.api.types.is_bool_dtype(values):
+        return "bin"
+    if pd.api.types.is_numeric_dtype(values):
+        return "num"
+    return "cat"
+
+
+class ColumnSketch:
+    """
+    the mergeable summary of one column
+    """
+
+    def __init__(self, name: str, kind: str):
+        self.name, self.kind = name, kind
+        self.n, self.n_missing = 0, 0
+        self.minimum = self.maximum = None
+        self.distinct = HyperLogLog()
+        self.digest = TDigest() if kind == "num" else None
+        self.frequencies = Counter()  # categories, true/false, or months of dates
+
+    def update(self, values: pd.Series):
+        missing = values.isna().to_numpy()
+        self.n += len(values)
+        self.n_missing += int(missing.sum())
+        present = values[~missing]
+        if not len(present):
+            return
+        if self.kind == "num":
+            numbers = pd.to_numeric(present, errors="coerce").to_numpy(dtype="float64")
+            self.distinct.update(numbers)
+            self.digest.update(numbers)
+            self._range(np.nanmin(numbers), np.nanmax(numbers))
+        elif self.kind == "date":
+            days = pd.to_datetime(present).to_numpy().astype("datetime64[D]")
+            self.distinct.update(days.astype("int64"))
+            months, counts = np.unique(days.astype("datetime64[M]"), return_counts=True)
+            self.frequencies.update(dict(zip(months.astype(str).tolist(), counts.tolist())))
+            self._range(str(days.min()), str(days.max()))  # ISO dates order as strings
+        else:
+            counts = present.value_counts()
+            self.frequencies.update({str(value): int(n) for value, n in counts.items()})
+            self.distinct.update(counts.index.astype(str).to_numpy(dtype=object))
+
+    def _range(self, low, high):
+        low = low.item() if hasattr(low, "item") else low
+        high = high.item() if hasattr(high, "item") else high
+        self.minimum = low if self.minimum is None else min(self.minimum, low)
+        self.maximum = high if self.maximum is None else max(self.maximum, high)
+
+    def merge(self, other: "ColumnSketch") -> "ColumnSketch":
+        merged = ColumnSketch(self.name, self.kind)
+        merged.n, merged.n_missing = self.n + other.n, self.n_missing + other.n_missing
+        for sketch in (self, other):
+            if sketch.minimum is not None:
+                merged._range(sketch.minimum, sketch.maximum)
+        merged.distinct = self.distinct.merge(other.distinct)
+        merged.digest = self.digest.merge(other.digest) if self.digest is not None else None
+        merged.frequencies = self.frequencies + other.frequencies
+        return merged
+
+    def summary(self, quantiles=(0.25, 0.5, 0.75)) -> dict:
+        row = {
+            "column": self.name,
+            "kind": self.kind,
+            "n": self.n,
+            "n_missing": self.n_missing,
+            "pct_complete": 1 - self.n_missing / self.n if self.n else np.nan,
+            "n_distinct": round(self.distinct.estimate()),
+            "min": self.minimum,
+            "max": self.maximum,
+        }
+        if self.digest is not None:
+            for q, value in zip(quantiles, self.digest.quantile(quantiles, self.minimum, self.maximum)):
+                row[f"p{round(q * 100)}"] = value
+        if self.kind == "bin":
+            n_true = self.frequencies.get("True", 0)
+            row["true_rate"] = n_true / (self.n - self.n_missing) if self.n > self.n_missing else np.nan
+        return row
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "kind": self.kind,
+            "n": self.n,
+            "n_missing": self.n_missing,
+            "minimum": self.minimum,
+            "maximum": self.maximum,
+            "distinct": self.distinct.to_dict(),
+            "digest": self.digest.to_dict() if self.digest is not None else None,
+            "frequencies": dict(self.frequencies),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "ColumnSketch":
+        sketch = cls(data["name"], data["kind"])
+        sketch.n, sketch.n_missing = data["n"], data["n_missing"]
+        sketch.minimum, sketch.maximum = data["minimum"], data["maximum"]
+        sketch.distinct = HyperLogLog.from_dict(data["distinct"])
+        sketch.digest = TDigest(**data["digest"]) if data["digest"] is not None else None
+        sketch.frequencies = Counter(data["frequencies"])
+        return sketch
+
+
+class DatasetSketch:
+    """
+    column sketches of a dataset (or a shard of it); `source` records what
+    was read (e.g. file size and modification time), to tell when to re-read
+    """
+
+    def __init__(self, columns=None, source=None):
+        self.columns = columns or {}
+        self.source = source
+
+    def update(self, frame: pd.DataFrame, skip=("patient_id",)):
+        for name in frame.columns:
+            if name in skip:
+                continue
+            if name not in self.columns:
+                self.columns[name] = ColumnSketch(name, column_kind(name, frame[name]))
+            self.columns[name].update(frame[name])
+
+    def merge(self, other: "DatasetSketch") -> "DatasetSketch":
+        names = list(self.columns) + [name for name in other.columns if name not in self.columns]
+        merged = {}
+        for name in names:
+            if name in self.columns and name in other.columns:
+                merged[name] = self.columns[name].merge(other.columns[name])
+            else:
+                merged[name] = self.columns.get(name) or other.columns[name]
+        return DatasetSketch(merged)
+
+    def summary(self) -> pd.DataFrame:
+        return pd.DataFrame([sketch.summary() for sketch in self.columns.values()])
+
+    def frequencies(self) -> pd.DataFrame:
+        """
+        category, true/false and month counts of the cat, bin and date columns
+        """
+        rows = [
+            {"column": name, "kind": sketch.kind, "value": value, "n": n}
+            for name, sketch in self.columns.items()
+            for value, n in sorted(sketch.frequencies.items())
+        ]
+        return pd.DataFrame(rows, columns=["column", "kind", "value", "n"])
+
+    def save(self, path):
+        columns = {name: sketch.to_dict() for name, sketch in self.columns.items()}
+        with open(path, "w") as f:
+            json.dump({"source": self.source, "columns": columns}, f)
+
+    @classmethod
+    def load(cls, path) -> "DatasetSketch":
+        with open(path) as f:
+            data = json.load(f)
+        columns = {name: ColumnSketch.from_dict(column) for name, column in data["columns"].items()}
+        return cls(columns, data["source"])
@@ -0,0 +1,155 @@
+#######################################################################################
+# Bounded-memory chunked evaluation of the dataset definition
+#######################################################################################
+# Every dataset column is per patient, so the definition can be evaluated on any
+# partition of the patients and the outputs concatenated. The patients are split into
+# chunks of patient_id ranges (taken from the patients table). A pass over the source
+# tables routes the rows of the next `chunks_per_pass` chunks (all of them by default,
+# so every table is read once) into chunk directories, ehrQL generates the dataset of
+# each chunk from its directory, and the chunk is appended to the output Arrow file
+# and its directory removed before the next is evaluated. Peak memory is set by
+# --chunk-rows and --chunk-patients, not by the size of the population. Staged disk
+# holds the needed columns of the chunks of one pass: a smaller --chunks-per-pass
+# bounds it, at the cost of one more read of every source table per pass. The chunks are
+# staged in the working directory (output/.chunks by default) and passed to ehrQL by
+# relative paths, as `opensafely exec` only sees the directory it is run from. Only
+# the tables and columns the definition reads are routed
+# (DependencyGraph.columns_needed()); the other columns are staged empty, so that
+# every staged table keeps its schema.
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from engine.tables import TABLES, iter_table
+
+
+def chunk_bounds(path, chunk_patients=100_000, chunk_rows=1_000_000) -> np.ndarray:
+    """
+    upper patient_id bound (exclusive) of every chunk, from the patients table
+    """
+    ids = [chunk["patient_id"].to_numpy() for chunk in iter_table("patients", path, [], chunk_rows)]
+    ids = np.unique(np.concatenate(ids)) if ids else np.array([], dtype="int64")
+    if len(ids) == 0:
+        return np.array([], dtype="int64")
+    bounds = ids[chunk_patients::chunk_patients]
+    return np.append(bounds, ids[-1] + 1)
+
+
+def partition_tables(path, bounds, directory, chunk_rows=1_000_000, columns=None, chunks=None) -> list:
+    """
+    route the rows of every source table to the directories of `chunks` (a
+    range of chunk numbers, all by default) by patient_id, skipping the rows
+    of other chunks; one pass per table, holding at most `chunk_rows` rows at
+    a time. `columns` (table -> columns, e.g. DependencyGraph.columns_needed())
+    limits this to the tables and columns the definition reads
+    """
+    chunks = range(len(bounds)) if chunks is None else chunks
+    directories = {chunk_id: Path(directory) / f"chunk_{chunk_id:04d}" for chunk_id in chunks}
+    for chunk_directory in directories.values():
+        chunk_directory.mkdir(parents=True, exist_ok=True)
+    for name in TABLES if columns is None else [table for table in TABLES if table in columns]:
+        written = set()
+        schema = ["patient_id", *TABLES[name]["columns"]]
+        bool_columns = [c for c, kind in TABLES[name]["columns"].items() if kind == "bool"]
+        for frame in iter_table(name, path, None if columns is None else columns[name], chunk_rows):
+            frame = frame.reindex(columns=schema)
+            chunk_ids = np.searchsorted(bounds, frame["patient_id"].to_numpy(), side="right")
+            # rows of patients missing from the patients table are in no chunk
+            staged = (chunk_ids >= chunks.start) & (chunk_ids < chunks.stop)
+            frame, chunk_ids = frame[staged], chunk_ids[staged]
+            for column in bool_columns:
+                frame[column] = frame[column].map({True: "T", False: "F"})
+            for chunk_id, rows in frame.groupby(chunk_ids, sort=True):
+                file = directories[chunk_id] / f"{name}.csv"
+                rows.to_csv(file, mode="a", header=chunk_id not in written, index=False, date_format="%Y-%m-%d")
+                written.add(chunk_id)
+        # a table with no rows in a chunk is still there, with its header
+        for chunk_id in set(chunks) - written:
+            pd.DataFrame(columns=schema).to_csv(directories[chunk_id] / f"{name}.csv", index=False)
+    return [directories[chunk_id] for chunk_id in chunks]
+
+
+def staged_chunks(path, bounds, directory, chunk_rows=1_000_000, columns=None, chunks_per_pass=None):
+    """
+    chunk directories, staged `chunks_per_pass` at a time (None: all in one
+    pass) by partition_tables(): the next pass only runs once the chunks of
+    the previous one have been taken
+    """
+    chunks_per_pass = chunks_per_pass or max(len(bounds), 1)
+    for first in range(0, len(bounds), chunks_per_pass):
+        chunks = range(first, min(first + chunks_per_pass, len(bounds)))
+        yield from partition_tables(path, bounds, directory, chunk_rows, columns, chunks)
+
+
+def evaluate_chunks(directories, definition, ehrql="opensafely exec ehrql:v0", user_args=()):
+    """
+    generate the dataset of each chunk directory in turn (generator of Arrow
+    tables); the chunk's tables are removed once evaluated
+    """
+    for chunk_directory in directories:
+        output = chunk_directory / "dataset.arrow"
+        command = shlex.split(ehrql) + [
+            "generate-dataset",
+            str(definition),
+            "--dummy-tables",
+            os.path.relpath(chunk_directory),
+            "--output",
+            os.path.relpath(output),
+        ]
+        if user_args:
+            command += ["--", *user_args]
+        subprocess.run(command, check=True)
+        table = feather.read_table(output)
+        shutil.rmtree(chunk_directory)
+        yield table
+
+
+def append_arrow(tables, path) -> int:
+    """
+    write a stream of Arrow tables with the same schema to one Arrow file
+    """
+    writer, n_rows = None, 0
+    try:
+        for table in tables:
+            if writer is None:
+                schema = table.schema
+                writer = pa.ipc.new_file(str(path), schema)
+            writer.write_table(table.cast(schema))
+            n_rows += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return n_rows
+
+
+def generate_dataset_streaming(
+    definition,
+    tables="example-data",
+    output="output/dataset.arrow",
+    chunk_patients=100_000,
+    chunk_rows=1_000_000,
+    ehrql="opensafely exec ehrql:v0",
+    user_args=(),
+    workdir="output/.chunks",
+    columns=None,
+    chunks_per_pass=None,
+) -> int:
+    """
+    evaluate the definition chunk by chunk, staging only `columns` of the source
+    tables (see partition_tables()) in a temporary directory under `workdir`,
+    which must be inside the directory ehrQL is run from; returns the number of
+    patients written
+    """
+    bounds = chunk_bounds(tables, chunk_patients, chunk_rows)
+    Path(workdir).mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=workdir) as directory:
+        directories = staged_chunks(tables, bounds, directory, chunk_rows, columns, chunks_per_pass)
+        return append_arrow(evaluate_chunks(directories, definition, ehrql, user_args), output)
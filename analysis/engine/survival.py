@@ -0,0 +1,168 @@
+#######################################################################################
+# Stratified Kaplan-Meier and Aalen-Johansen curves on a day grid
+#######################################################################################
+# Follow-up is in whole days, so every curve lives on the grid 0..max_day. The events
+# and exits of all strata are counted with one weighted np.bincount over the key
+# stratum * n_days + day, which gives (strata x days) matrices; numbers at risk, the
+# Kaplan-Meier product and the Aalen-Johansen cumulative incidences are then cumulative
+# sums and products along the day axis for every stratum at once. The cost is one
+# pass over the patients plus strata x days, however many strata there are.
+import numpy as np
+import pandas as pd
+
+from engine.event_store import EventStore, to_days
+
+Z = 1.959963984540054  # 97.5% normal quantile
+
+
+def follow_up(origin, end, events: dict, censoring=()) -> tuple:
+    """
+    (time in days since `origin`, status) from event dates: the earliest of the
+    event dates, the censoring dates and `end` ends follow-up; status is the
+    position (1, 2, ...) of the event in `events` that happened then (earlier
+    causes win ties), 0 when censored. Missing dates never end follow-up
+    """
+    origin, end = to_days(origin), to_days(end)
+    inf = np.iinfo(np.int64).max
+
+    def days(dates):
+        days = to_days(dates)
+        return np.where(days == EventStore.NULL, inf, days)
+
+    event_days = [days(dates) for dates in events.values()]
+    stop = np.minimum.reduce([np.where(end == EventStore.NULL, inf, end), *event_days, *(days(d) for d in censoring)])
+    status = np.zeros(len(origin), dtype="int64")
+    for cause, day in reversed(list(enumerate(event_days, start=1))):
+        status[day == stop] = cause
+    return stop - origin, status
+
+
+PRIMARY_CAUSES = ("covid_hosp_death", "noncovid_death")
+PRIMARY_COLUMNS = ("baseline_date", "qa_date_of_death", "out_bin_death_cause_covid", "out_date_covid_hosp", "out_date_dereg")
+
+
+def primary_follow_up(data: pd.DataFrame, window_days=28) -> tuple:
+    """
+    follow_up() of the primary outcome of define_status_and_fu_primary.R:
+    from baseline_date for `window_days`, ended by COVID-19 hospitalisation or
+    death (status 1), non-COVID death (status 2) or deregistration. Unlike
+    there, out_date_covid_hosp ends follow-up: min_date_primary of the R
+    function leaves it out, so a hospitalisation only counts there when it
+    falls on the day follow-up ends for another reason. Here the first of
+    hospitalisation and death is the event of the composite outcome
+    """
+    window = data["baseline_date"] + pd.Timedelta(days=window_days)
+
+    def within_window(dates):
+        return dates.where(dates < window)
+
+    covid_death = data["qa_date_of_death"].where(data["out_bin_death_cause_covid"] == True)  # noqa: E712
+    noncovid_death = data["qa_date_of_death"].where(data["out_bin_death_cause_covid"] == False)  # noqa: E712
+    return follow_up(
+        data["baseline_date"],
+        window,
+        {
+            "covid_hosp_death": within_window(pd.concat([data["out_date_covid_hosp"], covid_death], axis=1).min(axis=1)),
+            "noncovid_death": within_window(noncovid_death),
+        },
+        censoring=[within_window(data["out_date_dereg"])],
+    )
+
+
+def stratum_ids(strata: pd.DataFrame, n: int):
+    """
+    (stratum id per row, one row per stratum with its values); missing values
+    form their own stratum
+    """
+    if strata is None or strata.shape[1] == 0:
+        return np.zeros(n, dtype="int64"), pd.DataFrame(index=[0])
+    # mixed-radix code of the factorised columns, compacted to the strata that
+    # occur without sorting the rows
+    combined, size = np.zeros(n, dtype="int64"), 1
+    for column in strata.columns:
+        codes, levels = pd.factorize(strata[column], sort=True, use_na_sentinel=False)
+        combined, size = combined * len(levels) + codes, size * len(levels)
+    present = np.bincount(combined, minlength=size) > 0
+    ids = (np.cumsum(present) - 1)[combined]
+    first_rows = np.full(present.sum(), n, dtype="int64")
+    np.minimum.at(first_rows, ids, np.arange(n))
+    return ids, strata.iloc[first_rows].reset_index(drop=True)
+
+
+def estimates(at_risk, events: dict) -> dict:
+    """
+    the curves of survival_curves() (surv, surv_se, surv_ll, surv_ul and per
+    cause cuminc_<cause> and surv_<cause>) from (strata x days) matrices of
+    the number at risk and of the events of every cause
+    """
+    events_any = sum(events.values())
+    with np.errstate(divide="ignore", invalid="ignore"):
+        hazard = np.where(at_risk > 0, events_any / at_risk, 0.0)
+        surv = np.cumprod(1 - hazard, axis=1)
+        greenwood = np.cumsum(np.where(at_risk > events_any, events_any / (at_risk * (at_risk - events_any)), 0.0), axis=1)
+        surv_before = np.hstack([np.ones((surv.shape[0], 1)), surv[:, :-1]])
+        curves = {
+            "surv": surv,
+            "surv_se": surv * np.sqrt(greenwood),
+        }
+        llsurv, llsurv_se = np.log(-np.log(surv)), np.sqrt(greenwood) / np.abs(np.log(surv))
+        curves["surv_ll"] = np.where(surv < 1, np.exp(-np.exp(llsurv + Z * llsurv_se)), 1.0)
+        curves["surv_ul"] = np.where(surv < 1, np.exp(-np.exp(llsurv - Z * llsurv_se)), 1.0)
+        for cause, counted in events.items():
+            cause_hazard = np.where(at_risk > 0, counted / at_risk, 0.0)
+            curves[f"cuminc_{cause}"] = np.cumsum(surv_before * cause_hazard, axis=1)
+            curves[f"surv_{cause}"] = np.cumprod(1 - cause_hazard, axis=1)
+    return curves
+
+
+def survival_curves(time, status, strata: pd.DataFrame = None, weights=None, times=None, causes=("event",)) -> pd.DataFrame:
+    """
+    per stratum and grid day: number at risk, events (per cause) and censored
+    since the previous grid day, the all-cause Kaplan-Meier survival with
+    Greenwood standard error and log(-log) confidence limits, and per cause the
+    Aalen-Johansen cumulative incidence (competing causes as competing risks)
+    and the Kaplan-Meier survival treating the competing causes as censored.
+    `weights` are case weights; follow-up times are rounded up to whole days
+    """
+    time = np.ceil(np.asarray(time, dtype="float64"))
+    status = np.asarray(status, dtype="int64")
+    weights = np.ones(len(time)) if weights is None else np.asarray(weights, dtype="float64")
+    keep = ~np.isnan(time) & (time >= 0)
+    ids, keys = stratum_ids(strata[keep] if strata is not None else None, int(keep.sum()))
+    time, status, weights = time[keep].astype("int64"), status[keep], weights[keep]
+    times = np.arange(time.max() + 1 if len(time) else 1) if times is None else np.asarray(times, dtype="int64")
+    # follow-up beyond the grid is an exit after its last day
+    n_days = int(times.max()) + 2
+    day = np.minimum(time, n_days - 1)
+    n_strata = len(keys)
+    key = ids * n_days + day
+
+    def counts(select):
+        return np.bincount(key[select], weights[select], minlength=n_strata * n_days).reshape(n_strata, n_days)
+
+    exits = counts(np.ones(len(key), dtype=bool))
+    events = {cause: counts(status == i) for i, cause in enumerate(causes, start=1)}
+    events_any = sum(events.values())
+    at_risk = exits.sum(axis=1, keepdims=True) - (np.cumsum(exits, axis=1) - exits)
+
+    curves = estimates(at_risk, events)
+
+    # counts between grid days, curves at the grid days
+    grid = np.asarray(times)
+    previous = np.concatenate([[-1], grid[:-1]])
+
+    def between(matrix):
+        total = np.cumsum(matrix, axis=1)
+        return total[:, grid] - np.where(previous >= 0, total[:, np.maximum(previous, 0)], 0.0)
+
+    out = {
+        "time": np.tile(grid, n_strata),
+        "n_risk": at_risk[:, grid].ravel(),
+        "n_event": between(events_any).ravel(),
+        "n_censor": between(exits - events_any).ravel(),
+    }
+    for cause, counted in events.items():
+        out[f"n_event_{cause}"] = between(counted).ravel()
+    out.update({name: matrix[:, grid].ravel() for name, matrix in curves.items()})
+    strata_columns = keys.loc[np.repeat(np.arange(n_strata), len(grid))].reset_index(drop=True)
+    return pd.concat([strata_columns, pd.DataFrame(out)], axis=1)
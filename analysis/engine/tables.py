@@ -0,0 +1,280 @@
+#######################################################################################
+# Source tables of the TPP backend, as used by analysis/dataset_definition.py
+#######################################################################################
+from pathlib import Path
+
+import pandas as pd
+
+from engine.sampling import active_sample
+
+## Column types per table (subset of ehrql.tables.beta.tpp used in this study)
+# "date_column" is the column events are sorted by within a patient (None for patient-level tables)
+TABLES = {
+    "patients": {
+        "date_column": None,
+        "columns": {
+            "date_of_birth": "date",
+            "sex": "str",
+            "date_of_death": "date",
+        },
+    },
+    "addresses": {
+        "date_column": "start_date",
+        "columns": {
+            "address_id": "int",
+            "start_date": "date",
+            "end_date": "date",
+            "rural_urban_classification": "int",
+            "imd_rounded": "int",
+            "msoa_code": "str",
+            "care_home_is_potential_match": "bool",
+        },
+    },
+    "practice_registrations": {
+        "date_column": "start_date",
+        "columns": {
+            "start_date": "date",
+            "end_date": "date",
+            "practice_pseudo_id": "int",
+            "practice_stp": "str",
+            "practice_nuts1_region_name": "str",
+        },
+    },
+    "clinical_events": {
+        "date_column": "date",
+        "columns": {
+            "date": "date",
+            "snomedct_code": "str",
+            "ctv3_code": "str",
+            "numeric_value": "float",
+        },
+    },
+    "medications": {
+        "date_column": "date",
+        "columns": {
+            "date": "date",
+            "dmd_code": "str",
+        },
+    },
+    "hospital_admissions": {
+        "date_column": "admission_date",
+        "columns": {
+            "admission_date": "date",
+            "discharge_date": "date",
+            "admission_method": "str",
+            "all_diagnoses": "str",
+            "patient_classification": "str",
+            "days_in_critical_care": "int",
+            "primary_diagnoses": "str",
+        },
+    },
+    "sgss_covid_all_tests": {
+        "date_column": "lab_report_date",
+        "columns": {
+            "specimen_taken_date": "date",
+            "is_positive": "bool",
+            "lab_report_date": "date",
+        },
+    },
+    "ons_deaths": {
+        "date_column": "date",
+        "columns": {
+            "date": "date",
+            "place": "str",
+            "underlying_cause_of_death": "str",
+            **{f"cause_of_death_{i:02d}": "str" for i in range(1, 16)},
+        },
+    },
+    "appointments": {
+        "date_column": "seen_date",
+        "columns": {
+            "booked_date": "date",
+            "start_date": "date",
+            "seen_date": "date",
+            "status": "str",
+        },
+    },
+    "vaccinations": {
+        "date_column": "date",
+        "columns": {
+            "vaccination_id": "int",
+            "date": "date",
+            "target_disease": "str",
+            "product_name": "str",
+        },
+    },
+    "emergency_care_attendances": {
+        "date_column": "arrival_date",
+        "columns": {
+            "id": "int",
+            "arrival_date": "date",
+            "discharge_destination": "str",
+            **{f"diagnosis_{i:02d}": "str" for i in range(1, 25)},
+        },
+    },
+    "occupation_on_covid_vaccine_record": {
+        "date_column": None,
+        "columns": {
+            "is_healthcare_worker": "bool",
+        },
+    },
+    "ethnicity_from_sus": {
+        "date_column": None,
+        "columns": {
+            "code": "str",
+        },
+    },
+}
+
+PANDAS_DTYPES = {
+    "int": "Int64",
+    "str": "string",
+    "float": "float64",
+    "bool": "boolean",
+}
+
+
+def table_path(name: str, path) -> Path:
+    """
+    locate the file of a source table in a directory of ehrQL dummy tables,
+    accepting .csv, .csv.gz, .arrow, .feather and .parquet files
+    """
+    for suffix in (".arrow", ".feather", ".parquet", ".csv", ".csv.gz"):
+        candidate = Path(path) / f"{name}{suffix}"
+        if candidate.exists():
+            return candidate
+    return None
+
+
+def empty_table(name: str, columns=None) -> pd.DataFrame:
+    """
+    zero-row frame with the schema of a source table (tables missing from a
+    dummy tables directory are treated as empty, as ehrQL does)
+    """
+    schema = TABLES[name]["columns"]
+    columns = list(schema) if columns is None else [c for c in columns if c in schema]
+    frame = pd.DataFrame({"patient_id": pd.Series([], dtype="int64")})
+    for column in columns:
+        kind = schema[column]
+        frame[column] = pd.Series([], dtype="datetime64[ns]" if kind == "date" else PANDAS_DTYPES[kind])
+    return frame
+
+
+def read_table(name: str, path="example-data", columns=None) -> pd.DataFrame:
+    """
+    read one source table into pandas with the types of TABLES; `columns`
+    restricts the read to a subset of columns (patient_id is always read).
+    Only the patients of the active sample are kept (engine/sampling.py)
+    """
+    schema = TABLES[name]["columns"]
+    file = table_path(name, path)
+    if file is None:
+        return empty_table(name, columns)
+    wanted = list(schema) if columns is None else [c for c in columns if c in schema]
+
+    if file.suffix in (".arrow", ".feather"):
+        frame = pd.read_feather(file)
+    elif file.suffix == ".parquet":
+        frame = pd.read_parquet(file)
+    else:
+        header = pd.read_csv(file, nrows=0).columns
+        frame = pd.read_csv(
+            file,
+            usecols=["patient_id"] + [c for c in wanted if c in header],
+            dtype={c: "string" for c in wanted if schema[c] == "str"},
+        )
+    frame = frame[["patient_id"] + [c for c in wanted if c in frame.columns]]
+    return coerce_types(name, sampled(frame), wanted)
+
+
+def iter_table(name: str, path="example-data", columns=None, chunk_rows=1_000_000):
+    """
+    read one source table in chunks of about `chunk_rows` rows, each with the
+    types of TABLES (record batches for .arrow/.parquet, chunks for .csv) and
+    only the patients of the active sample
+    """
+    schema = TABLES[name]["columns"]
+    file = table_path(name, path)
+    if file is None:
+        return
+    wanted = list(schema) if columns is None else [c for c in columns if c in schema]
+
+    if file.suffix in (".arrow", ".feather"):
+        import pyarrow as pa
+
+        with pa.memory_map(str(file)) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                for start in range(0, batch.num_rows, chunk_rows):
+                    frame = batch.slice(start, chunk_rows).to_pandas()
+                    yield coerce_types(name, sampled(frame[["patient_id"] + [c for c in wanted if c in frame.columns]]), wanted)
+    elif file.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        header = pq.ParquetFile(file).schema_arrow.names
+        batches = pq.ParquetFile(file).iter_batches(chunk_rows, columns=["patient_id"] + [c for c in wanted if c in header])
+        for batch in batches:
+            yield coerce_types(name, sampled(batch.to_pandas()), wanted)
+    else:
+        header = pd.read_csv(file, nrows=0).columns
+        chunks = pd.read_csv(
+            file,
+            usecols=["patient_id"] + [c for c in wanted if c in header],
+            dtype={c: "string" for c in wanted if schema[c] == "str"},
+            chunksize=chunk_rows,
+        )
+        for frame in chunks:
+            yield coerce_types(name, sampled(frame), wanted)
+
+
+def sampled(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    the rows of the patients in the active sample (all rows without one)
+    """
+    sample = active_sample()
+    return frame if sample is None else sample.filter(frame)
+
+
+def coerce_types(name: str, frame: pd.DataFrame, columns=None) -> pd.DataFrame:
+    """
+    cast the columns of a source table frame to the types of TABLES, adding
+    the `columns` (default: all of TABLES) missing from the frame as all-null
+    """
+    schema = TABLES[name]["columns"]
+    frame = frame.copy()
+    frame["patient_id"] = frame["patient_id"].astype("int64")
+    for column in list(schema) if columns is None else columns:
+        if column not in frame.columns:
+            frame[column] = None
+    for column in [c for c in frame.columns if c in schema]:
+        kind = schema[column]
+        if kind == "date":
+            frame[column] = pd.to_datetime(frame[column], errors="coerce")
+        else:
+            frame[column] = frame[column].astype(PANDAS_DTYPES[kind])
+    return frame
+
+
+def read_tables(names, path="example-data", columns=None) -> dict:
+    """
+    read several source tables; `columns` maps table name to the columns to read
+    """
+    columns = columns or {}
+    return {name: read_table(name, path, columns.get(name)) for name in names}
+
+
+def explode_diagnoses(admissions: pd.DataFrame) -> pd.DataFrame:
+    """
+    one row per diagnosis code in hospital_admissions.all_diagnoses, keeping
+    the row number of the admission in `admission_row`. `diagnosis_3` holds the
+    3-character ICD-10 category, so that 3- and 4-character codelist entries
+    both match (ehrQL's all_diagnoses.is_in() is a "contains any" match)
+    """
+    frame = admissions.reset_index(drop=True).copy()
+    frame["admission_row"] = frame.index
+    codes = frame["all_diagnoses"].astype("string").str.upper().str.findall(r"[A-Z][0-9][0-9A-Z]*")
+    frame = frame.assign(diagnosis=codes).explode("diagnosis").dropna(subset=["diagnosis"])
+    frame["diagnosis"] = frame["diagnosis"].astype("string")
+    frame["diagnosis_3"] = frame["diagnosis"].str.slice(0, 3)
+    return frame.reset_index(drop=True)
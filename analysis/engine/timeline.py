@@ -0,0 +1,179 @@
+#######################################################################################
+# Random-access per-patient timelines across the source tables
+#######################################################################################
+# Each source table is written once as an uncompressed Arrow file sorted by
+# (patient_id, date), next to an offsets array over the population: the rows of the
+# i-th patient are offsets[i]:offsets[i + 1]. Reading memory-maps the files, so one
+# patient's timeline is a handful of zero-copy slices, merged by date and annotated
+# with the codelists each event matches and the dataset variables it feeds (from the
+# static dependency graph of the definition).
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+
+from engine.code_frequencies import CodeIndex
+from engine.tables import TABLES, read_table
+
+TIMELINE_TABLES = [
+    "patients",
+    "addresses",
+    "practice_registrations",
+    "clinical_events",
+    "medications",
+    "hospital_admissions",
+    "sgss_covid_all_tests",
+    "ons_deaths",
+]
+
+# columns holding codes (matched against the codelists), per table
+CODE_COLUMNS = {
+    "clinical_events": ["snomedct_code", "ctv3_code"],
+    "medications": ["dmd_code"],
+    "hospital_admissions": ["all_diagnoses"],
+    "ons_deaths": ["underlying_cause_of_death", *[f"cause_of_death_{i:02d}" for i in range(1, 16)]],
+}
+
+TIMELINE_COLUMNS = ["patient_id", "date", "table", "code", "value", "details", "codelists", "variables"]
+
+
+def event_date_column(table: str) -> str:
+    # patients have no event date, their timeline row is dated by birth
+    return TABLES[table]["date_column"] or ("date_of_birth" if table == "patients" else None)
+
+
+def format_value(value) -> str:
+    return str(value.date()) if isinstance(value, pd.Timestamp) else str(value)
+
+
+def build_timelines(path="example-data", directory="output/timeline", tables=TIMELINE_TABLES):
+    """
+    write every source table sorted by (patient_id, date) with its per-patient offsets
+    """
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    frames = {table: read_table(table, path) for table in tables}
+    population = np.unique(np.concatenate([frame["patient_id"].to_numpy(dtype="int64") for frame in frames.values()]))
+    np.save(directory / "population.npy", population)
+    for table, frame in frames.items():
+        date_column = event_date_column(table)
+        sort_columns = ["patient_id"] + ([date_column] if date_column in frame.columns else [])
+        frame = frame.sort_values(sort_columns, kind="stable", ignore_index=True)
+        positions = np.searchsorted(population, frame["patient_id"].to_numpy(dtype="int64"))
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(positions, minlength=len(population)))])
+        np.save(directory / f"{table}.offsets.npy", offsets)
+        feather.write_feather(pa.Table.from_pandas(frame, preserve_index=False), directory / f"{table}.arrow", compression="uncompressed")
+    return population
+
+
+class TimelineStore:
+    """
+    memory-mapped timelines; timeline(patient_id) returns one patient's events
+    of all tables in date order
+    """
+
+    def __init__(self, directory="output/timeline", codelists=None, graph=None):
+        self.directory = Path(directory)
+        self.population = np.load(self.directory / "population.npy", mmap_mode="r")
+        self.offsets, self.tables = {}, {}
+        for file in sorted(self.directory.glob("*.offsets.npy")):
+            table = file.name[: -len(".offsets.npy")]
+            self.offsets[table] = np.load(file, mmap_mode="r")
+            self.tables[table] = pa.ipc.open_file(pa.memory_map(str(self.directory / f"{table}.arrow"))).read_all()
+        self.index = CodeIndex(codelists) if codelists else None
+        self.variables_of = self._variables_of(graph) if graph is not None else {}
+
+    @staticmethod
+    def _variables_of(graph) -> dict:
+        """
+        (table, codelist) and (table, None) -> dataset variables (and boundary
+        nodes such as baseline_date) reading them directly
+        """
+        feeds = {}
+        nodes = {**graph.nodes, **graph.variables}
+        for variable, deps in nodes.items():
+            if variable == "population":
+                continue
+            for table in deps.tables:
+                feeds.setdefault((table, None), set()).add(variable)
+                for codelist in deps.codelists:
+                    feeds.setdefault((table, codelist), set()).add(variable)
+        return feeds
+
+    def position(self, patient_id) -> int:
+        position = int(np.searchsorted(self.population, patient_id))
+        if position == len(self.population) or self.population[position] != patient_id:
+            raise KeyError(f"patient {patient_id} is not in the timeline store")
+        return position
+
+    def rows(self, table: str, patient_id) -> pd.DataFrame:
+        """
+        the rows of one table for one patient (a zero-copy slice of the mapped file)
+        """
+        i = self.position(patient_id)
+        offsets = self.offsets[table]
+        return self.tables[table].slice(int(offsets[i]), int(offsets[i + 1] - offsets[i])).to_pandas()
+
+    def codelists_of(self, table: str, row: pd.Series) -> list:
+        if self.index is None:
+            return []
+        codes = []
+        for column in CODE_COLUMNS.get(table, []):
+            value = row.get(column)
+            if value is None or pd.isna(value):
+                continue
+            if column == "all_diagnoses":
+                found = pd.Series([str(value).upper()]).str.findall(r"[A-Z][0-9][0-9A-Z]*")[0]
+                codes += found + [code[:3] for code in found]
+            else:
+                code = str(value).strip()
+                if table == "ons_deaths":
+                    # ICD-10 causes of death, matched on the code and its 3-character category
+                    code = code.replace(".", "").upper()
+                    codes += [code, code[:3]]
+                else:
+                    codes.append(code)
+        positions = self.index.lookup(pd.Index(codes)) if codes else np.array([], dtype="int64")
+        positions = positions[positions >= 0]
+        if not len(positions):
+            return []
+        _, ids = self.index.codelists_of(positions)
+        return sorted({self.index.names[i] for i in ids})
+
+    def timeline(self, patient_id) -> pd.DataFrame:
+        """
+        all events of one patient in date order, each with its codelists and the
+        dataset variables it feeds (events of coded tables feed the variables
+        through their codelists, other tables feed every variable reading them)
+        """
+        events = []
+        for table in self.tables:
+            rows = self.rows(table, patient_id)
+            date_column = event_date_column(table)
+            code_columns = CODE_COLUMNS.get(table, [])
+            for _, row in rows.iterrows():
+                codelists = self.codelists_of(table, row)
+                if table in CODE_COLUMNS:
+                    variables = set().union(*(self.variables_of.get((table, name), set()) for name in codelists))
+                else:
+                    variables = self.variables_of.get((table, None), set())
+                code = next((row[c] for c in code_columns if c in row and pd.notna(row[c])), None)
+                value = row.get("numeric_value")
+                shown = [c for c in rows.columns if c not in ("patient_id", date_column, "numeric_value", *code_columns[:1])]
+                events.append(
+                    {
+                        "patient_id": patient_id,
+                        "date": row.get(date_column) if date_column else None,
+                        "table": table,
+                        "code": code,
+                        "value": value,
+                        "details": "; ".join(f"{c}={format_value(row[c])}" for c in shown if pd.notna(row[c])),
+                        "codelists": ";".join(codelists),
+                        "variables": ";".join(sorted(variables)),
+                    }
+                )
+        timeline = pd.DataFrame(events, columns=TIMELINE_COLUMNS)
+        timeline["date"] = pd.to_datetime(timeline["date"])
+        return timeline.sort_values(["date", "table"], kind="stable", na_position="first", ignore_index=True)
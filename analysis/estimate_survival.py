@@ -0,0 +1,80 @@
+################################################################################
+#
+# Crude survival and cumulative incidence by treatment arm and strata
+#
+# Follow-up as in data_import/functions/define_status_and_fu_primary.R: from
+# baseline_date for 28 days, ended by COVID-19 hospitalisation or death (the
+# outcome), non-COVID death (competing risk) or deregistration (censoring).
+# Kaplan-Meier and Aalen-Johansen curves of every stratum are estimated at
+# once on a daily grid (see analysis/engine/survival.py), for the eligible
+# patients (QA and eligibility criteria of analysis/engine/bitmaps.py).
+#
+# The output of this script is:
+# - ./output/survival/survival_<strata>.csv (one row per arm, stratum and day)
+#
+# usage: python analysis/estimate_survival.py [--input output/dataset_diabetes.arrow]
+#        [--by cov_cat_region cov_cat_deprivation_5] [--weights column]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.bitmaps import ELIGIBILITY_CRITERIA, QA_CRITERIA, Flowchart
+from engine.dataset_io import read_dataset
+from engine.survival import PRIMARY_CAUSES, primary_follow_up, survival_curves
+
+STUDY_WINDOW_DAYS = 28
+TREAT_WINDOW_DAYS = 6  # grace period 7 days (baseline_date + 6)
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", default="output/dataset_diabetes.arrow")
+parser.add_argument("--by", nargs="*", default=["cov_cat_region", "cov_cat_deprivation_5"],
+                    help="covariates to stratify by, one at a time (always within arm)")
+parser.add_argument("--weights", default=None, help="column of case weights")
+parser.add_argument("--output", default="output/survival")
+args = parser.parse_args()
+
+output_dir = Path(args.output)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Follow-up
+################################################################################
+data = read_dataset(args.input)
+flowchart = Flowchart.from_frame(data, QA_CRITERIA + ELIGIBILITY_CRITERIA, skip_missing=True)
+data = data[flowchart.meeting(flowchart.names).to_bool()].reset_index(drop=True)
+
+fu_time, status = primary_follow_up(data, STUDY_WINDOW_DAYS)
+first_metfin = data["exp_date_first_metfin"]
+data["arm"] = np.where(
+    (first_metfin >= data["baseline_date"]) & (first_metfin <= data["baseline_date"] + pd.Timedelta(days=TREAT_WINDOW_DAYS)),
+    "Treated",
+    "Untreated",
+)
+
+################################################################################
+# 2 Curves
+################################################################################
+weights = data[args.weights].to_numpy(dtype="float64") if args.weights else None
+for by in [[], *([column] for column in args.by)]:
+    start = time.perf_counter()
+    curves = survival_curves(
+        fu_time,
+        status,
+        data[["arm", *by]],
+        weights,
+        times=np.arange(STUDY_WINDOW_DAYS + 1),
+        causes=PRIMARY_CAUSES,
+    )
+    name = "_".join(by) or "arm"
+    curves.to_csv(output_dir / f"survival_{name}.csv", index=False)
+    print(f"{name}: {curves[['arm', *by]].drop_duplicates().shape[0]} strata in {time.perf_counter() - start:.3f}s")
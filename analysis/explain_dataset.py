@@ -0,0 +1,70 @@
+################################################################################
+#
+# Explain the dataset definition
+#
+# This script can be run via an action in project.yaml
+#
+# Static analysis of analysis/dataset_definition.py: which source tables,
+# columns and codelists every dataset column depends on, with the estimated
+# number of source rows scanned per column.
+#
+# The output of this script is:
+# - ./output/explain/dataset_explain.csv
+# - ./output/explain/columns_needed.json (tables/columns to read for the selection)
+#
+# usage: python analysis/explain_dataset.py [--tables example-data]
+#        [--row-counts counts.json] [--variables cov_cat_region cov_bin_vte ...]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import json
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.codelist_registry import load_codelists, parse_codelists
+from engine.dependencies import DependencyGraph, count_rows, explain
+from engine.sampling import add_sample_arguments, sample_from_args
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--definition", default="analysis/dataset_definition.py")
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables, for row counts")
+parser.add_argument("--row-counts", default=None, help="JSON of table -> row count, overrides --tables")
+parser.add_argument("--variables", nargs="*", default=None, help="dataset columns to explain (default: all)")
+parser.add_argument("--output", default="output/explain")
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+output_dir = Path(args.output)
+output_dir.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Build the dependency graph
+################################################################################
+registry = parse_codelists()
+codelist_sizes = {name: len(codes) for name, codes in load_codelists(registry).items()}
+graph = DependencyGraph(args.definition, codelist_names=registry)
+
+if args.row_counts is not None:
+    row_counts = json.loads(Path(args.row_counts).read_text())
+else:
+    row_counts = count_rows(args.tables)
+
+################################################################################
+# 2 Explain report and columns to read
+################################################################################
+report = explain(graph, row_counts, codelist_sizes, args.variables)
+report.to_csv(output_dir / "dataset_explain.csv", index=False)
+
+columns_needed = graph.columns_needed(args.variables)
+(output_dir / "columns_needed.json").write_text(json.dumps(columns_needed, indent=2))
+
+unused = sorted(set(graph.tables) - set(columns_needed))
+print(f"{len(report)} dataset columns explained, {len(columns_needed)} tables read")
+if unused:
+    print("tables never read for this selection: " + ", ".join(unused))
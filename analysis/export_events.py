@@ -0,0 +1,75 @@
+################################################################################
+#
+# Long-format export of all post-baseline outcome and exposure events
+#
+# Every event on or after baseline_date that matches the codelists of an
+# out_date_ / exp_date_ column of the dataset definition, as rows (patient_id,
+# variable, date, code, value), for recurrent-event and time-varying exposure
+# models. The events are read from the feature store (brought up to date
+# first), so the export shares the codelist scans of the wide dataset (see
+# analysis/engine/event_export.py). Columns built from tables outside the
+# store (emergency care, SGSS tests, deregistration) or whose matches differ
+# from the store's (exact all_diagnoses matches of hospital admissions) are
+# listed as skipped.
+#
+# The output of this script is:
+# - ./output/events/part-NNNN.arrow (sorted by patient_id, date, variable)
+# - ./output/events/manifest.json
+#
+# usage: python analysis/export_events.py [--dataset output/dataset.arrow]
+#        [--variables out_date_long_covid_first ...] [--chunk-patients 200000]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.codelist_registry import parse_codelists
+from engine.dataset_io import read_dataset
+from engine.dependencies import DependencyGraph
+from engine.event_export import export_events, export_variables
+from engine.feature_store import FeatureStore
+from engine.sampling import add_sample_arguments, sample_from_args
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset", default="output/dataset.arrow", help="extracted dataset (patient_id, baseline_date)")
+parser.add_argument("--definition", default="analysis/dataset_definition.py")
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables")
+parser.add_argument("--store", default="output/feature_store")
+parser.add_argument("--variables", nargs="+", help="dataset columns to export (default: all out_date_ / exp_date_)")
+parser.add_argument("--chunk-patients", type=int, default=200_000, help="patients per partition")
+parser.add_argument("--output", default="output/events")
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+################################################################################
+# 1 Variables and their codelists
+################################################################################
+registry = parse_codelists()
+graph = DependencyGraph(args.definition, registry)
+variables, skipped = export_variables(graph, args.variables)
+for column, reason in skipped.items():
+    print(f"skipped {column}: {reason}")
+
+features = FeatureStore(args.store)
+changes = features.update(registry, args.tables, graph)
+print(f"feature store: {len(changes['built'])} codelists built")
+
+################################################################################
+# 2 Export
+################################################################################
+start = time.perf_counter()
+baseline = read_dataset(args.dataset, columns=["patient_id", "baseline_date"])
+manifest = export_events(features, baseline, variables, args.output, args.chunk_patients)
+n_events = sum(part["n_events"] for part in manifest["parts"])
+print(
+    f"{n_events} events of {len(variables)} variables in {len(manifest['parts'])} partitions "
+    f"({time.perf_counter() - start:.2f}s)"
+)
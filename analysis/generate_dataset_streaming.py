@@ -0,0 +1,72 @@
+################################################################################
+#
+# Generate the dataset in patient-aligned chunks
+#
+# Bounded-memory alternative to `ehrql generate-dataset` for local source tables
+# (see analysis/engine/streaming.py): the tables are split into chunks of
+# --chunk-patients patients and staged under --workdir (all in one pass over the
+# source tables, or --chunks-per-pass chunks at a time to bound the staged disk),
+# the dataset definition is evaluated chunk by chunk and every chunk is appended
+# to the output and removed before the next one is evaluated. Only
+# the source tables and columns the definition reads are staged (see
+# analysis/engine/dependencies.py).
+#
+# The output of this script is:
+# - ./output/dataset.arrow
+#
+# usage: python analysis/generate_dataset_streaming.py --tables <dir>
+#        [--chunk-patients 100000] [--chunk-rows 1000000] [--chunks-per-pass N]
+#        [--ehrql "opensafely exec ehrql:v0"] [-- <definition args>]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.codelist_registry import parse_codelists
+from engine.dependencies import DependencyGraph
+from engine.sampling import add_sample_arguments, sample_from_args
+from engine.streaming import generate_dataset_streaming
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--definition", default="analysis/dataset_definition.py")
+parser.add_argument("--tables", default="example-data", help="directory of source tables (.csv, .arrow, .parquet)")
+parser.add_argument("--output", default="output/dataset.arrow")
+parser.add_argument("--chunk-patients", type=int, default=100_000, help="patients evaluated at a time")
+parser.add_argument("--chunk-rows", type=int, default=1_000_000, help="source rows read at a time")
+parser.add_argument("--ehrql", default="opensafely exec ehrql:v0", help="command running ehrQL")
+parser.add_argument(
+    "--chunks-per-pass", type=int, default=None,
+    help="chunks staged per pass over the source tables (default: all, every table is read once)",
+)
+parser.add_argument("--workdir", default="output/.chunks", help="where chunk tables are staged, inside the directory ehrQL runs in")
+add_sample_arguments(parser)
+args, user_args = parser.parse_known_args()
+sample_from_args(args)
+# arguments after `--` are passed on to the dataset definition
+user_args = [arg for arg in user_args if arg != "--"]
+
+################################################################################
+# 1 Generate dataset
+################################################################################
+start = time.perf_counter()
+columns = DependencyGraph(args.definition, parse_codelists()).columns_needed()
+n_patients = generate_dataset_streaming(
+    args.definition,
+    args.tables,
+    args.output,
+    chunk_patients=args.chunk_patients,
+    chunk_rows=args.chunk_rows,
+    ehrql=args.ehrql,
+    user_args=user_args,
+    workdir=args.workdir,
+    columns=columns,
+    chunks_per_pass=args.chunks_per_pass,
+)
+print(f"{n_patients} patients written to {args.output} in {time.perf_counter() - start:.1f}s")
@@ -0,0 +1,62 @@
+################################################################################
+#
+# Per-patient timelines for debugging derived values
+#
+# Builds the memory-mapped timeline store of the source tables (--build) and
+# prints the merged chronological timeline of single patients, each event with
+# the codelists it matches and the dataset variables it feeds (see
+# analysis/engine/timeline.py).
+#
+# The output of this script is:
+# - ./output/timeline/ (store, with --build)
+# - ./output/timeline/patient_<patient_id>.csv (with --patient-id)
+#
+# usage: python analysis/patient_timeline.py --build [--tables example-data]
+#        python analysis/patient_timeline.py --patient-id 3 [7 ...]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.codelist_registry import load_codelists, parse_codelists
+from engine.dependencies import DependencyGraph
+from engine.sampling import add_sample_arguments, sample_from_args
+from engine.timeline import TimelineStore, build_timelines
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--build", action="store_true", help="(re)build the store from the source tables")
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables")
+parser.add_argument("--store", default="output/timeline")
+parser.add_argument("--patient-id", type=int, nargs="*", default=[])
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+################################################################################
+# 1 Build store
+################################################################################
+if args.build:
+    start = time.perf_counter()
+    population = build_timelines(args.tables, args.store)
+    print(f"timelines of {len(population)} patients built in {time.perf_counter() - start:.2f}s")
+
+################################################################################
+# 2 Patient timelines
+################################################################################
+if args.patient_id:
+    registry = parse_codelists()
+    graph = DependencyGraph(codelist_names=registry)
+    store = TimelineStore(args.store, load_codelists(registry), graph)
+    for patient_id in args.patient_id:
+        start = time.perf_counter()
+        timeline = store.timeline(patient_id)
+        print(f"patient {patient_id}: {len(timeline)} events in {1000 * (time.perf_counter() - start):.1f}ms")
+        print(timeline.drop(columns="patient_id").to_string(index=False, max_colwidth=60))
+        timeline.to_csv(Path(args.store) / f"patient_{patient_id}.csv", index=False)
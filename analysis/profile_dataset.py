@@ -0,0 +1,68 @@
+################################################################################
+#
+# One-pass profile of the extracted dataset (Python counterpart of data_skim.R)
+#
+# Streams the record batches of one or more dataset files (e.g. shards of the
+# population) once, filling mergeable sketches per column (see
+# analysis/engine/sketches.py): completeness, min/max, approximate quantiles of
+# _num_ columns, approximate distinct counts, category frequencies, true rates
+# and monthly date histograms. The sketch of every file is kept, and reused as
+# long as the file is unchanged, so re-profiling after adding a shard only
+# reads the new shard. Like skimr output, the profile is UNREDACTED.
+#
+# The output of this script is:
+# - ./output/profile/sketches/<file>.json (one sketch per input file)
+# - ./output/profile/dataset_profile.csv (one row per column)
+# - ./output/profile/dataset_frequencies.csv (column, kind, value, n)
+#
+# usage: python analysis/profile_dataset.py [--input output/dataset.arrow ...]
+#        [--chunk-rows 500000]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.dataset_io import iter_frames
+from engine.sketches import DatasetSketch
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", nargs="+", default=["output/dataset.arrow"], help="dataset file(s), e.g. shards")
+parser.add_argument("--chunk-rows", type=int, default=500_000)
+parser.add_argument("--output", default="output/profile")
+args = parser.parse_args()
+
+output_dir = Path(args.output)
+sketch_dir = output_dir / "sketches"
+sketch_dir.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Sketch every file (or reuse its sketch)
+################################################################################
+profile = DatasetSketch()
+for file in map(Path, args.input):
+    start = time.perf_counter()
+    stat = file.stat()
+    source = {"path": str(file), "size": stat.st_size, "mtime": stat.st_mtime}
+    cached = sketch_dir / f"{file.stem}.json"
+    sketch = DatasetSketch.load(cached) if cached.exists() else None
+    if sketch is None or sketch.source != source:
+        sketch = DatasetSketch(source=source)
+        for frame in iter_frames(file, args.chunk_rows):
+            sketch.update(frame)
+        sketch.save(cached)
+        print(f"{file}: sketched in {time.perf_counter() - start:.2f}s")
+    else:
+        print(f"{file}: unchanged, sketch reused")
+    profile = profile.merge(sketch)
+
+################################################################################
+# 2 Save output
+################################################################################
+profile.summary().to_csv(output_dir / "dataset_profile.csv", index=False)
+profile.frequencies().to_csv(output_dir / "dataset_frequencies.csv", index=False)
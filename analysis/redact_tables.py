@@ -0,0 +1,63 @@
+################################################################################
+#
+# Disclosure control of all count tables of a release in one batch
+#
+# The columns of every table are declared by its table type (TABLE_TYPES of
+# analysis/engine/disclosure.py): counts, keys, the keys whose levels make up a
+# margin and derived columns. The count columns of all count tables are stacked
+# into one long frame, small-number suppression (with the secondary suppression
+# of redactor()) and midpoint rounding with the thresholds of
+# lib/design/redaction.R are applied at once, and every table is written back
+# with its counts redacted. Survival tables get the cumulative rounding of the
+# R Kaplan-Meier outputs and their estimates are computed again from the
+# rounded counts. Tables without a declared type, or with float columns that
+# are neither counts nor recomputable, are not written (listed as refused).
+#
+# The output of this script is:
+# - <table>_red.csv next to every input table
+# - ./output/redaction_log.csv (one row per table and count column)
+#
+# usage: python analysis/redact_tables.py
+#        [--tables output/survival/*.csv output/clones/clones_summary.csv ...]
+################################################################################
+import argparse
+import glob
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.disclosure import read_thresholds, redact_release
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--tables", nargs="*", default=["output/survival/*.csv", "output/clones/clones_summary.csv"],
+                    help="CSV files or glob patterns")
+parser.add_argument("--log", default="output/redaction_log.csv")
+args = parser.parse_args()
+
+files = sorted({Path(file) for pattern in args.tables for file in glob.glob(pattern) if not file.endswith("_red.csv")})
+thresholds = read_thresholds()
+
+################################################################################
+# 1 Redact all tables at once
+################################################################################
+start = time.perf_counter()
+redacted, log, refused = redact_release({str(file): pd.read_csv(file) for file in files}, **thresholds)
+
+################################################################################
+# 2 Save output
+################################################################################
+for file, table in redacted.items():
+    table.to_csv(Path(file).with_name(f"{Path(file).stem}_red.csv"), index=False)
+for file, reason in refused.items():
+    print(f"refused {file}: {reason}")
+print(f"{len(redacted)} of {len(files)} tables redacted in {time.perf_counter() - start:.2f}s")
+if len(log):
+    Path(args.log).parent.mkdir(parents=True, exist_ok=True)
+    log.to_csv(args.log, index=False)
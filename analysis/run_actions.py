@@ -0,0 +1,55 @@
+################################################################################
+#
+# Run project.yaml actions locally, skipping those whose inputs are unchanged
+#
+# Reads project.yaml and project.local.yaml (the R pipeline and the local
+# Python actions, with their `needs` and `inputs`) and runs the actions needed
+# for the targets on a pool of workers, in dependency order. An action is a
+# cache hit, and not run, when its run command, code, inputs and the outputs
+# of the actions it needs hash the same as at its last successful run (see
+# analysis/engine/scheduler.py).
+#
+# The output of this script is:
+# - ./output/.actions/state.json (keys and output hashes of the actions run)
+# - ./output/.actions/logs/<action>.log
+# - ./output/.actions/run_summary.csv (status and timing per action)
+#
+# usage: python analysis/run_actions.py [targets ...] [--workers 4]
+#        [--force action ...] [--dry-run]
+################################################################################
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.scheduler import STATE_DIR, Scheduler, load_actions
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("targets", nargs="*", help="actions to bring up to date (default: all)")
+parser.add_argument("--project", action="append", default=None,
+                    help="project.yaml-style file, repeatable (default: project.yaml and project.local.yaml)")
+parser.add_argument("--workers", type=int, default=4)
+parser.add_argument("--force", nargs="*", default=[], help="actions to run even if cached")
+parser.add_argument("--dry-run", action="store_true", help="only report which actions would run")
+args = parser.parse_args()
+
+################################################################################
+# 1 Run
+################################################################################
+scheduler = Scheduler(load_actions(args.project or ["project.yaml", "project.local.yaml"]), workers=args.workers)
+summary = scheduler.run(args.targets or None, force=set(args.force), dry_run=args.dry_run)
+
+################################################################################
+# 2 Save output
+################################################################################
+print(summary.to_string(index=False))
+counts = summary["status"].value_counts()
+print(", ".join(f"{n} {status}" for status, n in counts.items()),
+      f"- {summary['seconds'].sum():.1f}s run, {summary['seconds_saved'].sum():.1f}s saved by the cache")
+summary.to_csv(Path(STATE_DIR) / "run_summary.csv", index=False)
+if (summary["status"] == "failed").any():
+    sys.exit(1)
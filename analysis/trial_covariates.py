@@ -0,0 +1,88 @@
+################################################################################
+#
+# Covariates at the start of every sequential trial
+#
+# The sequential trials (analysis/seq_trials/prepare_data.R) start a patient's
+# trial k on baseline_date + k days, k = 0, ..., treat_window - 1. The
+# covariates that can change between trial starts (registration, region,
+# deprivation, recent metformin, type 2 diabetes history) are evaluated at each
+# of these index dates by IndexDateQueries (analysis/engine/index_dates.py),
+# from one set of CSR stores for all trials.
+#
+# The output of this script is:
+# - ./output/data/data_trial_covariates.arrow (one row per patient and trial)
+#
+# usage: python analysis/trial_covariates.py [--input output/dataset_diabetes.arrow]
+#        [--tables example-data] [--trials 7]
+#        [--sample 0.1 [--sample-by output/dataset.arrow cov_bin_pos_covid --sample-fraction True 1]]
+################################################################################
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from engine.codelist_registry import load_codes, parse_codelists
+from engine.dataset_io import read_dataset, write_dataset
+from engine.index_dates import PERIOD_TABLES, IndexDateQueries, build_period_stores, trial_index_dates
+from engine.queries import EVENT_TABLES, build_stores
+from engine.sampling import add_sample_arguments, sample_from_args
+from engine.tables import read_tables
+
+# column: (helper of IndexDateQueries, *arguments); codelists by name of analysis/codelists.py
+TRIAL_COVARIATES = {
+    "cov_bin_registered": ("registered_spanning",),
+    "cov_cat_region": ("registration_on", "practice_nuts1_region_name"),
+    "cov_num_imd_rounded": ("address_on", "imd_rounded"),
+    "cov_bin_metfin_before_baseline": ("has_prior_prescription_6m", "metformin_codes"),
+    "cov_date_t2dm_ctv3": ("prior_event_date_ctv3", "diabetes_type2_ctv3_clinical"),
+}
+
+################################################################################
+# 0.1 Import command-line arguments
+################################################################################
+parser = argparse.ArgumentParser()
+parser.add_argument("--input", default="output/dataset_diabetes.arrow", help="dataset with patient_id, baseline_date")
+parser.add_argument("--tables", default="example-data", help="directory of source (dummy) tables")
+parser.add_argument("--trials", type=int, default=7, help="trials per patient (treat_window of prepare_data.R)")
+parser.add_argument("--output", default="output/data/data_trial_covariates.arrow")
+add_sample_arguments(parser)
+args = parser.parse_args()
+sample_from_args(args)
+
+Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+
+################################################################################
+# 1 Index dates and stores
+################################################################################
+index_dates = trial_index_dates(read_dataset(args.input, columns=["patient_id", "baseline_date"]), args.trials)
+tables = read_tables([name for name in EVENT_TABLES + PERIOD_TABLES if name != "hospital_admissions"], args.tables)
+population = np.unique(index_dates["patient_id"].to_numpy())
+stores = {**build_stores(tables, population), **build_period_stores(tables, population)}
+
+################################################################################
+# 2 Covariates at every index date
+################################################################################
+registry = parse_codelists()
+helpers = {
+    name: (helper, *[load_codes(registry[arg]) if arg in registry else arg for arg in arguments])
+    for name, (helper, *arguments) in TRIAL_COVARIATES.items()
+}
+start = time.perf_counter()
+queries = IndexDateQueries(stores, index_dates)
+covariates = queries.evaluate(helpers)
+covariates.insert(1, "trial", index_dates["trial"].to_numpy())
+print(f"{len(helpers)} covariates at {len(covariates)} trial starts in {time.perf_counter() - start:.3f}s")
+# structurally identical query nodes evaluated once (engine/memo.py)
+print(queries.memo.summary())
+report = queries.memo.report()
+if len(report):
+    print(report.to_string(index=False))
+
+################################################################################
+# 3 Save output
+################################################################################
+write_dataset(covariates, args.output)
@@ -0,0 +1,27 @@
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+# the analysis scripts import the engine as a top-level package
+sys.path.insert(0, str(Path(__file__).parents[1] / "analysis"))
+
+from engine.tables import read_tables  # noqa: E402
+
+EXAMPLE_DATA = Path(__file__).parents[1] / "example-data"
+
+
+@pytest.fixture(scope="session")
+def example_data():
+    return EXAMPLE_DATA
+
+
+@pytest.fixture(scope="session")
+def tables():
+    return read_tables(["patients", "clinical_events", "medications"], EXAMPLE_DATA)
+
+
+@pytest.fixture(scope="session")
+def population(tables):
+    return np.unique(tables["patients"]["patient_id"].to_numpy(dtype="int64"))
@@ -0,0 +1,140 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.bitmaps import ELIGIBILITY_CRITERIA, QA_CRITERIA, Flowchart, is_true
+
+TODAY = pd.Timestamp(date.today())
+ELIGIBILITY_FLAGS = ["qa_bin_is_female_or_male", "qa_bin_known_imd", "qa_bin_was_registered", "qa_bin_was_adult", "cov_bin_t2dm"]
+EXCLUSION_FLAGS = [
+    "cov_bin_hosp_baseline", "cov_bin_metfin_before_baseline", "cov_bin_metfin_allergy", "cov_bin_ckd_45",
+    "cov_bin_liver_cirrhosis", "cov_bin_metfin_interaction", "cov_bin_long_covid",
+]
+QA_FLAGS = ["qa_bin_pregnancy", "qa_bin_hrt", "qa_bin_cocp", "qa_bin_prostate_cancer"]
+
+
+@pytest.fixture(scope="module")
+def dummy():
+    """
+    dummy dataset with the columns data_process.R filters on, missing values
+    in all of them, deaths on either side of baseline_date and cov_cat_sex
+    as recoded by process_data.R (Female, Male or NA)
+    """
+    rng = np.random.default_rng(8)
+    n = 3000
+
+    def dates(start, days, p_missing):
+        values = pd.Series(pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, n), unit="D"))
+        return values.mask(rng.random(n) < p_missing)
+
+    def flags(p_true, p_missing=0.05):
+        return pd.array(np.where(rng.random(n) < p_missing, None, rng.random(n) < p_true), dtype="boolean")
+
+    frame = pd.DataFrame({
+        "baseline_date": dates("2020-06-01", 900, 0.05),
+        "qa_date_of_death": dates("1890-01-01", 52000, 0.7),
+        "qa_num_birth_year": pd.array(np.where(rng.random(n) < 0.03, None, rng.integers(1780, 2030, n)), dtype="Int64"),
+        "cov_cat_sex": pd.Series(rng.choice(["Female", "Male"], n)).mask(rng.random(n) < 0.03),
+        "cov_cat_region": pd.Series(rng.choice(["East", "London"], n)).mask(rng.random(n) < 0.05),
+        "qa_bin_was_alive": flags(0.95),
+    })
+    for column in ELIGIBILITY_FLAGS:
+        frame[column] = flags(0.9)
+    for column in EXCLUSION_FLAGS + QA_FLAGS:
+        frame[column] = flags(0.05)
+    return frame
+
+
+def r(values, *operands) -> pd.Series:
+    """
+    an R comparison: NA where any of its operands is missing
+    """
+    out = pd.Series(np.asarray(values, dtype=bool), dtype="boolean")
+    for operand in operands:
+        out[np.asarray(pd.isna(operand))] = pd.NA
+    return out
+
+
+def r_filter(frame, condition):
+    # dplyr::filter() keeps the rows where the condition is TRUE (not NA)
+    return frame[condition.fillna(False).to_numpy(dtype=bool)].reset_index(drop=True)
+
+
+def qa_filters(frame):
+    """
+    section 3 of data_process.R, filter by filter
+    """
+    yob = frame["qa_num_birth_year"]
+    dod, sex = frame["qa_date_of_death"], frame["cov_cat_sex"]
+    female, male = r(sex == "Female", sex), r(sex == "Male", sex)
+
+    def false(column):
+        return r(frame[column].eq(False).fillna(False), frame[column])
+
+    return [
+        r(yob.notna()),
+        r(dod.isna()) | r(yob.to_numpy(dtype="float64", na_value=np.nan) <= dod.dt.year, yob, dod),
+        r((yob >= 1793).fillna(False) & (yob <= TODAY.year).fillna(False), yob),
+        r(dod > "1900-01-01", dod) | r(dod < TODAY, dod) | r(dod.isna()),
+        (female | r(sex.isna())) | (male & false("qa_bin_pregnancy")),
+        (female | r(sex.isna())) | (male & false("qa_bin_hrt")) | (male & false("qa_bin_cocp")),
+        (male | r(sex.isna())) | (female & false("qa_bin_prostate_cancer")),
+    ]
+
+
+def eligibility_filters(frame, strict_alive=True):
+    """
+    section 4 of data_process.R (strict_alive) or the n_after_exclusion_processing
+    filters of calc_n_excluded.R, which keep qa_bin_was_alive == TRUE only
+    """
+    dod, baseline = frame["qa_date_of_death"], frame["baseline_date"]
+    alive = r(frame["qa_bin_was_alive"].eq(True).fillna(False), frame["qa_bin_was_alive"])
+    if strict_alive:
+        alive = alive & (r(dod > baseline, dod, baseline) | r(dod.isna()))
+    return [
+        alive,
+        *(r(frame[c].eq(True).fillna(False), frame[c]) for c in ELIGIBILITY_FLAGS[:2]),
+        r(frame["cov_cat_region"].notna()),
+        *(r(frame[c].eq(True).fillna(False), frame[c]) for c in ELIGIBILITY_FLAGS[2:]),
+        r(baseline.notna()),
+        *(r(frame[c].eq(False).fillna(False), frame[c]) for c in EXCLUSION_FLAGS),
+    ]
+
+
+def apply(frame, filters):
+    counts = []
+    for i in range(len(filters(frame))):
+        frame = r_filter(frame, filters(frame)[i])
+        counts.append(len(frame))
+    return frame, counts
+
+
+def test_sequential_counts_match_data_process(dummy):
+    after_qa, qa_counts = apply(dummy, qa_filters)
+    _, counts = apply(after_qa, eligibility_filters)
+    flowchart = Flowchart.from_frame(dummy, QA_CRITERIA + ELIGIBILITY_CRITERIA)
+    remaining = flowchart.sequential()["n_remaining"].tolist()
+    # rule 4 (date of death on or before 1900 or after today) excludes nobody in the final filter
+    assert qa_counts[3] == qa_counts[2]
+    assert remaining == qa_counts[:3] + qa_counts[4:] + counts
+    assert len(QA_CRITERIA) == 6 and counts[-1] > 0
+
+
+def test_marginal_counts_match_calc_n_excluded(dummy):
+    flowchart = Flowchart.from_frame(dummy)
+    n_met = flowchart.marginal().set_index("criterion")["n_met"]
+    # n_is_alive, n_is_female_or_male, ..., n_has_covid_infection: the strict form of qa_bin_was_alive
+    expected = [r_filter(dummy, condition).shape[0] for condition in eligibility_filters(dummy)[:8]]
+    assert n_met.iloc[:8].tolist() == expected
+
+
+def test_plain_was_alive_gives_n_after_exclusion_processing(dummy):
+    # calc_n_excluded.R counts its final population with qa_bin_was_alive == TRUE only,
+    # which also keeps deaths on or before baseline_date
+    _, counts = apply(dummy, lambda frame: eligibility_filters(frame, strict_alive=False))
+    plain = [is_true("qa_bin_was_alive")] + ELIGIBILITY_CRITERIA[1:]
+    assert Flowchart.from_frame(dummy, plain).sequential()["n_remaining"].tolist() == counts
+    strict = Flowchart.from_frame(dummy).sequential()["n_remaining"].iloc[-1]
+    assert strict < counts[-1]
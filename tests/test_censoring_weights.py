@@ -0,0 +1,78 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import pytest
+
+REPO = Path(__file__).parents[1]
+
+
+@pytest.fixture(scope="module")
+def trials():
+    """
+    7 trials of 10 one-day intervals per patient; control clones start
+    treatment on a random day (or never)
+    """
+    rng = np.random.default_rng(4)
+    rows = []
+    for patient_id in range(1, 301):
+        for trial in range(7):
+            arm = int(rng.integers(0, 2))
+            switch = rng.integers(1, 14) if arm == 0 else 0
+            for tstart in range(10):
+                rows.append((patient_id, trial, arm, tstart, tstart + 1, int(tstart >= switch), 1))
+    columns = ["patient_id", "trial", "arm", "tstart", "tend", "treatment_seq", "period"]
+    return pd.DataFrame(rows, columns=columns)
+
+
+@pytest.fixture(scope="module")
+def weighted(trials, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("ipcw")
+    (directory / "lib").symlink_to(REPO / "lib")
+    feather.write_feather(trials, directory / "trials.arrow")
+    subprocess.run(
+        [sys.executable, REPO / "analysis" / "add_censoring_weights.py", "--input", "trials.arrow", "--output", "out.arrow"],
+        cwd=directory, check=True, capture_output=True,
+    )
+    return pd.read_feather(directory / "out.arrow")
+
+
+def expected_weights(trials, treatment_window=5):
+    """
+    add_ipacw.R with the saturated model factor(tend) per trial, whose fitted
+    probabilities are the proportions uncensored per trial and interval, and
+    the intercept-only numerator of the stabilised weights
+    """
+    out = []
+    for trial, rows in trials[trials["trial"] < treatment_window - 1].groupby("trial"):
+        tend_max = treatment_window - trial - 1
+        rows = rows.copy()
+        rows["lead"] = rows.groupby("patient_id")["treatment_seq"].shift(-1)
+        at_risk = (rows["arm"] == 0) & (rows["treatment_seq"] != 1) & (rows["tend"] <= tend_max) & rows["lead"].notna()
+        uncensored = (rows["lead"] == rows["arm"]).astype(float)
+        denominator = uncensored[at_risk].groupby(rows.loc[at_risk, "tend"]).mean()
+        ratio = np.where(at_risk, uncensored[at_risk].mean() / rows["tend"].map(denominator), 1.0)
+        rows["w"] = pd.Series(ratio, index=rows.index).groupby(rows["patient_id"]).transform(
+            lambda r: np.r_[1.0, np.cumprod(r.to_numpy())[:-1]]
+        )
+        out.append(rows[~((rows["arm"] == 0) & (rows["treatment_seq"] == 1))])
+    return pd.concat(out)
+
+
+def test_trials_after_the_treatment_window_are_dropped(trials, weighted):
+    assert sorted(weighted["trial"].unique()) == [0, 1, 2, 3, 4]
+    # the last trial keeps all its rows, with w = 1
+    last = weighted[weighted["trial"] == 4]
+    assert len(last) == (trials["trial"] == 4).sum()
+    assert (last["w"] == 1).all()
+
+
+def test_weights_match_add_ipacw(trials, weighted):
+    expected = expected_weights(trials).sort_values(["patient_id", "trial", "tstart"])
+    actual = weighted[weighted["trial"] < 4].sort_values(["patient_id", "trial", "tstart"])
+    assert len(actual) == len(expected)
+    assert (actual["w"] != 1).any()
+    np.testing.assert_allclose(actual["w"].to_numpy(), expected["w"].to_numpy(), rtol=1e-6)
@@ -0,0 +1,85 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from engine.clones import Clones
+
+GRACE_DAYS = 6
+
+
+@pytest.fixture(scope="module")
+def trial():
+    """
+    trial patients starting metformin before, within and after the grace
+    period (or never, or with a missing baseline), with follow-up ending
+    before, on and after its last day
+    """
+    rng = np.random.default_rng(49)
+    n = 300
+    baseline = pd.Series(pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 100, n), unit="D"))
+    first = (baseline + pd.to_timedelta(rng.integers(-3, 20, n), unit="D")).mask(rng.random(n) < 0.3)
+    data = pd.DataFrame({
+        "patient_id": rng.choice(np.arange(1000, 5000), n, replace=False),
+        "baseline_date": baseline.mask(rng.random(n) < 0.02),
+        "exp_date_first_metfin": first,
+        "cov_num_age": rng.integers(18, 90, n),
+        "cov_cat_sex": rng.choice(["Female", "Male"], n),
+    })
+    fu_time = rng.integers(0, 29, n)
+    status = np.where(rng.random(n) < 0.3, rng.integers(1, 3, n), 0)
+    return data, fu_time, status
+
+
+def person_days(data, fu_time, status, rows, grace_days=GRACE_DAYS) -> pd.DataFrame:
+    """
+    the person-day rows of each clone, written out clone by clone
+    """
+    out = []
+    for row in rows:
+        patient = data.iloc[row]
+        treat_day = (patient["exp_date_first_metfin"] - patient["baseline_date"]).days
+        treated = pd.notna(treat_day) and 0 <= treat_day <= grace_days
+        for arm in (0, 1):
+            if arm == 0:
+                deviation = treat_day if treated else None
+            else:
+                deviation = None if treated else grace_days
+            deviated = deviation is not None and deviation < fu_time[row]
+            time = deviation if deviated else fu_time[row]
+            for day in range(time + 1):
+                last = day == time
+                out.append({
+                    "patient_id": patient["patient_id"],
+                    "arm": arm,
+                    "day": day,
+                    "status": 0 if not last or deviated else status[row],
+                    "deviated": last and deviated,
+                    "at_risk_untreated": arm == 0 and day <= grace_days,
+                    "at_risk_treated": arm == 1 and day == grace_days,
+                    "uncensored": int(not (last and deviated)),
+                    "cov_num_age": patient["cov_num_age"],
+                    "cov_cat_sex": patient["cov_cat_sex"],
+                })
+    return pd.DataFrame(out)
+
+
+def test_person_days_match_cloning_patient_by_patient(trial):
+    data, fu_time, status = trial
+    # the trial is every other row of the table
+    rows = np.arange(0, len(data), 2)
+    clones = Clones.from_frame(pa.Table.from_pandas(data), data.iloc[rows], fu_time[rows], status[rows], GRACE_DAYS, rows)
+    expected = person_days(data, fu_time, status, rows)
+    actual = pd.concat(clones.chunks(["cov_num_age", "cov_cat_sex"], chunk_patients=37), ignore_index=True)
+    assert expected["deviated"].any() and (expected["status"] > 0).any()
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
+
+    # clones, deviations and events per arm
+    last = expected.groupby(["patient_id", "arm"], sort=False).tail(1)
+    summary = clones.summary().set_index("arm")
+    for arm, name in enumerate(["untreated", "treated"]):
+        clone_rows = last[last["arm"] == arm]
+        assert summary.loc[name, "n_clones"] == len(rows)
+        assert summary.loc[name, "n_deviated"] == clone_rows["deviated"].sum()
+        for value, n in clone_rows["status"].value_counts().items():
+            assert summary.loc[name, f"n_status_{value}"] == n
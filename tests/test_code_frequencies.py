@@ -0,0 +1,65 @@
+import pandas as pd
+
+from engine.code_frequencies import CodeFrequencies
+from engine.disclosure import redact_release
+
+CODELISTS = {
+    "diabetes_icd10": ["E11", "E119"],
+    "diabetes_snomed": ["44054006"],
+    "diabetes_ctv3": ["C10F."],
+}
+COLUMNS = {"diabetes_icd10": ["diagnosis"], "diabetes_snomed": ["snomedct_code"], "diabetes_ctv3": ["ctv3_code"]}
+
+
+def frequencies():
+    counts = CodeFrequencies(CODELISTS, columns=COLUMNS)
+    admissions = pd.DataFrame(
+        {
+            "patient_id": [1, 1, 2, 3],
+            # 4- and 3-character codes of one codelist, twice in one admission
+            "all_diagnoses": ["E119", "E119;E118", "E110", "I10"],
+        }
+    )
+    counts.update_admissions(admissions)
+    events = pd.DataFrame(
+        {
+            "patient_id": [1, 2, 4],
+            "snomedct_code": ["44054006", "44054006", "C10F."],
+            "ctv3_code": ["C10F.", "44054006", None],
+        }
+    )
+    for column in ["snomedct_code", "ctv3_code"]:
+        counts.update(column, events[column], events["patient_id"])
+    return counts
+
+
+def test_an_admission_counts_once_per_codelist():
+    coverage = frequencies().coverage().set_index("codelist")
+    # brute force: admissions with any diagnosis in the codelist, E11 matching its category
+    assert coverage.loc["diabetes_icd10", "n_events"] == 3
+    assert coverage.loc["diabetes_icd10", "n_patients"] == 2
+    codes = frequencies().code_counts().set_index(["codelist", "code"])
+    assert codes.loc[("diabetes_icd10", "E11"), "n_events"] == 3
+    assert codes.loc[("diabetes_icd10", "E119"), "n_events"] == 2
+
+
+def test_codelists_only_count_in_their_own_coding_system():
+    coverage = frequencies().coverage().set_index("codelist")
+    assert coverage.loc["diabetes_snomed", "n_events"] == 2 and coverage.loc["diabetes_snomed", "columns"] == "snomedct_code"
+    assert coverage.loc["diabetes_ctv3", "n_events"] == 1 and coverage.loc["diabetes_ctv3", "n_patients"] == 1
+    codes = frequencies().code_counts()
+    assert set(codes.loc[codes["codelist"] == "diabetes_ctv3", "column"]) == {"ctv3_code"}
+
+
+def test_published_counts_are_redacted():
+    counts = frequencies()
+    tables = {
+        "codelist_coverage.csv": counts.coverage(),
+        "code_counts.csv": counts.code_counts(),
+        "top_other_codes.csv": counts.top_other_codes(),
+    }
+    redacted, log, refused = redact_release(tables, redaction_threshold=7, rounding_threshold=6)
+    assert not refused and set(log["table"]) == set(tables)
+    for file, table in redacted.items():
+        for column in [c for c in table.columns if c in ("n_events", "n_patients", "n_events_min")]:
+            assert set(table[column]) <= {"0", "[REDACTED]"}, (file, column)
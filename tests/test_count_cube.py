@@ -0,0 +1,78 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.count_cube import COVID_VACCINE_TARGETS, SEEN_STATUSES, CubeStore, cube_covariates
+
+STUDYSTART = pd.Timestamp("2021-06-01")
+
+
+@pytest.fixture(scope="module")
+def events():
+    """
+    random appointments and vaccinations over two years, with several events
+    on the same day, undated events and statuses or targets that are not counted
+    """
+    rng = np.random.default_rng(43)
+
+    def dates(n):
+        values = pd.Series(pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 730, n), unit="D"))
+        return values.mask(rng.random(n) < 0.03)
+
+    n = 6000
+    appointments = pd.DataFrame({
+        "patient_id": rng.integers(1, 301, n),
+        "seen_date": dates(n),
+        "status": rng.choice(SEEN_STATUSES + ["Booked", "Did Not Attend"], n),
+    })
+    vaccinations = pd.DataFrame({
+        "patient_id": rng.integers(100, 401, n // 3),
+        "date": dates(n // 3),
+        "target_disease": rng.choice(COVID_VACCINE_TARGETS + ["INFLUENZA"], n // 3),
+    })
+    return {"appointments": appointments, "vaccinations": vaccinations}
+
+
+def write(events, directory, before=None):
+    directory.mkdir(exist_ok=True)
+    for table, frame in events.items():
+        date = frame["seen_date" if table == "appointments" else "date"]
+        if before is not None:
+            # whole months only, the undated rows arrive with the first batch
+            frame = frame[~(date >= before)]
+        frame.to_csv(directory / f"{table}.csv", index=False, date_format="%Y-%m-%d")
+
+
+def expected_covariates(events, patient_ids, baseline_dates) -> pd.DataFrame:
+    appointments, vaccinations = events["appointments"], events["vaccinations"]
+    seen = appointments[
+        appointments["status"].isin(SEEN_STATUSES)
+        & (appointments["seen_date"] >= STUDYSTART - pd.Timedelta(days=366))
+        & (appointments["seen_date"] <= STUDYSTART)
+    ]
+    covid = vaccinations[vaccinations["target_disease"].isin(COVID_VACCINE_TARGETS)]
+    rows = []
+    for patient_id, baseline in zip(patient_ids, baseline_dates):
+        vaccines = covid[(covid["patient_id"] == patient_id) & (covid["date"] <= baseline)]["date"]
+        rows.append((patient_id, (seen["patient_id"] == patient_id).sum(), len(vaccines), vaccines.max()))
+    columns = ["patient_id", "cov_num_consultation_rate", "cov_count_covid_vaccines", "cov_date_recent_covid_vaccines"]
+    return pd.DataFrame(rows, columns=columns).astype({"cov_date_recent_covid_vaccines": "datetime64[s]"})
+
+
+def test_incremental_store_matches_a_scan_of_the_events(events, tmp_path):
+    store = CubeStore(tmp_path / "store")
+    write(events, tmp_path / "tables", before=pd.Timestamp("2021-03-01"))
+    assert store.update(tmp_path / "tables")["appointments"][-1] == "2021-02"
+    write(events, tmp_path / "tables")
+    assert store.update(tmp_path / "tables")["vaccinations"][0] == "2021-03"
+    assert store.update(tmp_path / "tables") == {}
+
+    rng = np.random.default_rng(0)
+    # patients with no events at all, and missing baseline dates
+    patient_ids = rng.integers(1, 450, 500)
+    baseline = pd.Series(pd.Timestamp("2020-06-01") + pd.to_timedelta(rng.integers(0, 600, 500), unit="D"))
+    baseline = baseline.mask(rng.random(500) < 0.05)
+    actual = cube_covariates(CubeStore(tmp_path / "store"), patient_ids, baseline, STUDYSTART)
+    expected = expected_covariates(events, patient_ids, baseline)
+    assert (expected["cov_count_covid_vaccines"] > 1).any()
+    pd.testing.assert_frame_equal(actual, expected, check_dtype=False)
@@ -0,0 +1,31 @@
+import pyarrow as pa
+import pyarrow.ipc
+
+from engine.dataset_diff import array_hash, diff_datasets
+
+
+def dictionary(indices, labels):
+    return pa.DictionaryArray.from_arrays(pa.array(indices, type=pa.int8()), pa.array(labels))
+
+
+def test_hash_of_equal_arrays_is_equal():
+    assert array_hash(pa.array([1, None, 3])) == array_hash(pa.array([1, None, 3]))
+    assert array_hash(dictionary([0, 1, 0], ["F", "M"])) == array_hash(dictionary([0, 1, 0], ["F", "M"]))
+
+
+def test_hash_of_relabelled_dictionary_differs():
+    # the same indices over another dictionary are other values
+    assert array_hash(dictionary([0, 1, 0], ["F", "M"])) != array_hash(dictionary([0, 1, 0], ["M", "F"]))
+
+
+def write(path, table):
+    with pa.OSFile(str(path), "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+
+
+def test_diff_finds_relabelled_categories(tmp_path):
+    ids = pa.array([1, 2, 3], type=pa.int64())
+    write(tmp_path / "old.arrow", pa.table({"patient_id": ids, "cov_cat_sex": dictionary([0, 1, 0], ["F", "M"])}))
+    write(tmp_path / "new.arrow", pa.table({"patient_id": ids, "cov_cat_sex": dictionary([0, 1, 0], ["M", "F"])}))
+    summary = diff_datasets(tmp_path / "old.arrow", tmp_path / "new.arrow").summary().set_index("column")
+    assert summary.loc["cov_cat_sex", "n_changed"] == 3
@@ -0,0 +1,73 @@
+import io
+import tokenize
+from pathlib import Path
+
+from engine.codelist_registry import parse_codelists
+from engine.dependencies import DependencyGraph
+
+REPO = Path(__file__).parents[1]
+
+DEFINITION = '''
+from ehrql import create_dataset, days
+from ehrql.tables.beta.tpp import clinical_events, ons_deaths, patients, practice_registrations
+
+baseline_date = clinical_events.where(clinical_events.snomedct_code.is_in(covid_codes)).date.minimum_for_patient()
+
+def prior_event(codelist, where=True):
+    events = clinical_events.where(where)
+    return events.where(events.ctv3_code.is_in(codelist)).where(events.date.is_before(baseline_date)).exists_for_patient()
+
+def cause_of_death_matches(codelist):
+    conditions = [getattr(ons_deaths, column_name).is_in(codelist) for column_name in [f"cause_of_death_{i:02d}" for i in range(1, 3)]]
+    return conditions[0]
+
+registered = practice_registrations.for_patient_on(baseline_date)
+unused = patients.sex.is_in(asthma_codes)
+
+dataset = create_dataset()
+dataset.define_population(patients.exists_for_patient())
+dataset.cov_bin_diabetes = prior_event(diabetes_codes)
+dataset.cov_cat_region = registered.practice_nuts1_region_name
+dataset.out_bin_death_covid = cause_of_death_matches(covid_codes)
+dataset.cov_num_age = patients.age_on(baseline_date)
+'''
+
+
+def test_closures_of_a_small_definition(tmp_path):
+    (tmp_path / "definition.py").write_text(DEFINITION)
+    graph = DependencyGraph(tmp_path / "definition.py", ["covid_codes", "diabetes_codes", "asthma_codes"])
+    baseline = graph.nodes["baseline_date"]
+    assert baseline.columns == {("clinical_events", "snomedct_code"), ("clinical_events", "date")}
+
+    diabetes = graph.variables["cov_bin_diabetes"]
+    assert diabetes.upstream == {"baseline_date"} and diabetes.codelists == {"diabetes_codes"}
+    assert diabetes.columns == {("clinical_events", "ctv3_code"), ("clinical_events", "date")}
+    # columns read by for_patient_on() and age_on() without being named
+    assert graph.variables["cov_cat_region"].columns == {
+        ("practice_registrations", column) for column in ("start_date", "end_date", "practice_nuts1_region_name")
+    }
+    assert graph.variables["cov_num_age"].columns == {("patients", "date_of_birth")}
+    assert graph.closure("out_bin_death_covid").codelists == {"covid_codes"}
+    assert graph.variables["out_bin_death_covid"].columns == {("ons_deaths", "cause_of_death_01"), ("ons_deaths", "cause_of_death_02")}
+
+    assert graph.matched == {
+        "covid_codes": {("clinical_events", "snomedct_code"), ("ons_deaths", "cause_of_death_01"), ("ons_deaths", "cause_of_death_02")},
+        "diabetes_codes": {("clinical_events", "ctv3_code")},
+    }
+    # a name no dataset column uses is never traced
+    assert graph.columns_needed() == {
+        "clinical_events": ["ctv3_code", "date", "snomedct_code"],
+        "ons_deaths": ["cause_of_death_01", "cause_of_death_02"],
+        "patients": ["date_of_birth"],
+        "practice_registrations": ["end_date", "practice_nuts1_region_name", "start_date"],
+    }
+
+
+def test_codelists_match_the_names_in_the_definition(monkeypatch):
+    # every codelist named in the code (not in comments or strings) is read by some dataset column
+    monkeypatch.chdir(REPO)
+    registry = parse_codelists()
+    graph = DependencyGraph("analysis/dataset_definition.py", registry)
+    source = Path("analysis/dataset_definition.py").read_text()
+    names = {token.string for token in tokenize.generate_tokens(io.StringIO(source).readline) if token.type == tokenize.NAME}
+    assert set().union(*(graph.closure(variable).codelists for variable in graph.variables)) == names & set(registry)
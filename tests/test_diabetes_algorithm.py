@@ -0,0 +1,201 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.diabetes_algorithm import apply_diabetes_algorithm, drop_tmp_columns
+
+# step variables of diabetes_algo(), in order
+STEPS = ["step_1", "step_1a", "step_2", "step_3", "step_4", "step_5", "step_6", "step_6a", "step_6b", "step_6c", "step_6d", "step_6e", "step_7"]
+ETHNICITY = {"1": "White", "4": "Black", "3": "South Asian", "2": "Mixed", "5": "Other", "0": "Unknown"}
+
+
+@pytest.fixture(scope="module")
+def dummy():
+    """
+    dummy extract with missing values in every input, dates drawn from a few
+    years so that T1DM and T2DM dates (and counts) tie
+    """
+    rng = np.random.default_rng(30)
+    n = 4000
+
+    def dates(p_missing, start="2015-01-01", days=5 * 365):
+        values = pd.Series(pd.Timestamp(start) + pd.to_timedelta(rng.integers(0, days, n), unit="D"))
+        return values.mask(rng.random(n) < p_missing)
+
+    def counts(high, p_missing=0.05):
+        return pd.Series(rng.integers(0, high, n).astype("float64")).mask(rng.random(n) < p_missing)
+
+    return pd.DataFrame({
+        "qa_num_birth_year": dates(0.05, "1960-01-01", 60 * 365),
+        "cov_cat_ethnicity": pd.Series(rng.choice(["0", "1", "2", "3", "4", "5", "6"], n)).mask(rng.random(n) < 0.1),
+        "cov_date_t1dm": dates(0.5, days=200),
+        "cov_date_t2dm": dates(0.5, days=200),
+        "cov_date_otherdm": dates(0.8),
+        "cov_date_gestationaldm": dates(0.85),
+        "tmp_cov_date_t1dm_ctv3": dates(0.5),
+        "tmp_cov_date_t2dm_ctv3": dates(0.5),
+        "tmp_cov_count_t1dm": counts(4),
+        "tmp_cov_count_t2dm": counts(4),
+        "tmp_cov_date_poccdm": dates(0.4),
+        "tmp_cov_count_poccdm_ctv3": counts(8),
+        "tmp_cov_num_max_hba1c_mmol_mol": pd.Series(rng.uniform(30, 60, n)).mask(rng.random(n) < 0.3),
+        "tmp_cov_date_max_hba1c": dates(0.3),
+        "tmp_cov_date_nonmetform_drugs_snomed": dates(0.8),
+        "tmp_cov_date_diabetes_medication": dates(0.6),
+        "tmp_cov_date_latest_diabetes_diag": dates(0.2, "1950-01-01", 70 * 365),
+        "tmp_cov_count_t1dm_ctv3": counts(4),
+        "cov_num_age": rng.integers(18, 100, n),
+    })
+
+
+# R's logical vectors for one row: True, False or None (NA)
+def na(value):
+    return value is None or pd.isna(value)
+
+
+def r_and(*values):
+    if any(v is False for v in values):
+        return False
+    return None if any(v is None for v in values) else True
+
+
+def r_or(*values):
+    if any(v is True for v in values):
+        return True
+    return None if any(v is None for v in values) else False
+
+
+def r_cmp(left, op, right):
+    return None if na(left) or na(right) else bool(op(left, right))
+
+
+def r_eq(value, level):
+    return None if value is None else value == level
+
+
+def r_ifelse(test, yes, no):
+    return None if test is None else (yes if test else no)
+
+
+def diabetes_algo(row) -> dict:
+    """
+    the helper variables of process_data.R and diabetes_algo() of
+    analysis/data_import/functions/diabetes_algorithm.R for one row
+    """
+    def known(column):
+        return not na(row[column])
+
+    ethnicity = ETHNICITY.get(row["cov_cat_ethnicity"]) if known("cov_cat_ethnicity") else None
+    latest, birth = row["tmp_cov_date_latest_diabetes_diag"], row["qa_num_birth_year"]
+    age = None if na(latest) or na(birth) else latest.year - birth.year
+    age = None if age is not None and age < 0 else age
+    wmo = None if ethnicity is None else ethnicity in ("White", "Mixed", "Other")
+    under = r_ifelse(
+        r_or(r_and(age is not None, r_and(r_cmp(age, np.less, 35), wmo)), r_cmp(age, np.less, 30)), "Yes", "No"
+    )
+
+    t1, t2 = known("cov_date_t1dm"), known("cov_date_t2dm")
+    t1_ctv3, t2_ctv3 = known("tmp_cov_date_t1dm_ctv3"), known("tmp_cov_date_t2dm_ctv3")
+    c1, c2 = row["tmp_cov_count_t1dm"], row["tmp_cov_count_t2dm"]
+    s = {}
+    s["step_1"] = "Yes" if known("cov_date_gestationaldm") else "No"
+    s["step_1a"] = r_ifelse(
+        r_and(s["step_1"] == "Yes", t1 or t2), "Yes", r_ifelse(r_and(s["step_1"] == "Yes", not t1, not t2), "No", None)
+    )
+    denominator = r_or(r_eq(s["step_1"], "No"), r_eq(s["step_1a"], "Yes"))
+    nonmetform = known("tmp_cov_date_nonmetform_drugs_snomed")
+    s["step_2"] = r_ifelse(r_and(denominator, nonmetform), "Yes", r_ifelse(r_and(denominator, not nonmetform), "No", None))
+    s["step_3"] = r_ifelse(r_and(r_eq(s["step_2"], "No"), t1, not t2), "Yes", r_ifelse(r_eq(s["step_2"], "No"), "No", None))
+    s["step_4"] = r_ifelse(r_and(r_eq(s["step_3"], "No"), not t1, t2), "Yes", r_ifelse(r_eq(s["step_3"], "No"), "No", None))
+    step_5 = r_ifelse(
+        r_and(r_eq(s["step_4"], "No"), r_eq(under, "Yes")), "Yes",
+        r_ifelse(r_and(r_eq(s["step_4"], "No"), r_eq(under, "No")), "No", None),
+    )
+    s["step_5"] = r_ifelse(r_or(r_eq(step_5, "No"), r_and(step_5 is None, r_eq(s["step_4"], "No"))), "No", "Yes")
+    s["step_6"] = r_ifelse(
+        r_and(r_eq(s["step_5"], "No"), t1, t2), "Yes", r_ifelse(r_and(r_eq(s["step_5"], "No"), not t1 or not t2), "No", None)
+    )
+    s["step_6a"] = r_ifelse(r_and(r_eq(s["step_6"], "Yes"), t1_ctv3, not t2_ctv3), "Yes", r_ifelse(r_eq(s["step_6"], "Yes"), "No", None))
+    s["step_6b"] = r_ifelse(r_and(r_eq(s["step_6a"], "No"), not t1_ctv3, t2_ctv3), "Yes", r_ifelse(r_eq(s["step_6a"], "No"), "No", None))
+    s["step_6c"] = r_ifelse(
+        r_and(r_eq(s["step_6b"], "No"), r_cmp(c1, np.greater, c2)), "Yes",
+        r_ifelse(r_and(r_eq(s["step_6b"], "No"), r_cmp(c1, np.less_equal, c2)), "No", None),
+    )
+    s["step_6d"] = r_ifelse(
+        r_and(r_eq(s["step_6c"], "No"), r_cmp(c2, np.greater, c1)), "Yes",
+        r_ifelse(r_and(r_eq(s["step_6c"], "No"), r_cmp(c2, np.less_equal, c1)), "No", None),
+    )
+    d1, d2 = row["cov_date_t1dm"], row["cov_date_t2dm"]
+    s["step_6e"] = r_ifelse(
+        r_and(r_eq(s["step_6d"], "No"), r_cmp(d2, np.greater, d1)), "Yes",
+        r_ifelse(r_and(r_eq(s["step_6d"], "No"), r_cmp(d2, np.less, d1)), "No", None),
+    )
+    evidence = r_or(
+        known("tmp_cov_date_diabetes_medication"),
+        r_cmp(row["tmp_cov_num_max_hba1c_mmol_mol"], np.greater_equal, 47.5),
+        r_cmp(row["tmp_cov_count_poccdm_ctv3"], np.greater_equal, 5),
+    )
+    s["step_7"] = r_ifelse(r_and(r_eq(s["step_6"], "No"), evidence), "Yes", r_ifelse(r_eq(s["step_6"], "No"), "No", None))
+
+    def all_of(**steps):
+        return r_and(*(r_eq(s[name], value) for name, value in steps.items()))
+
+    def entered(**steps):
+        # each pathway of cov_cat_diabetes, after step 1 == "No" or step 1 == step 1a == "Yes"
+        return r_or(all_of(step_1="No", **steps), all_of(step_1="Yes", step_1a="Yes", **steps))
+
+    no_to_5 = dict(step_2="No", step_3="No", step_4="No", step_5="No")
+    category = r_ifelse(
+        entered(**no_to_5, step_6="No", step_7="No"), "DM unlikely", r_ifelse(
+            entered(**no_to_5, step_6="No", step_7="Yes"), "DM_other", r_ifelse(
+                r_or(
+                    entered(step_2="Yes"),
+                    entered(step_2="No", step_3="No", step_4="Yes"),
+                    entered(**no_to_5, step_6="Yes", step_6a="No", step_6b="Yes"),
+                    entered(**no_to_5, step_6="Yes", step_6a="No", step_6b="No", step_6c="No", step_6d="Yes"),
+                    entered(**no_to_5, step_6="Yes", step_6a="No", step_6b="No", step_6c="No", step_6d="No", step_6e="Yes"),
+                ), "T2DM", r_ifelse(
+                    r_or(
+                        entered(step_2="No", step_3="Yes"),
+                        entered(step_2="No", step_3="No", step_4="No", step_5="Yes"),
+                        entered(**no_to_5, step_6="Yes", step_6a="Yes"),
+                        entered(**no_to_5, step_6="Yes", step_6a="No", step_6b="No", step_6c="Yes"),
+                        entered(**no_to_5, step_6="Yes", step_6a="No", step_6b="No", step_6c="No", step_6d="No", step_6e="No"),
+                    ), "T1DM", r_ifelse(all_of(step_1="Yes", step_1a="No"), "GDM", None),
+                ),
+            ),
+        ),
+    )
+    s["cov_cat_diabetes"] = "None" if category is None else category
+
+    # incident dates from the category and the date of the latest diabetes code
+    step7_dates = [
+        row["tmp_cov_date_max_hba1c"] if r_cmp(row["tmp_cov_num_max_hba1c_mmol_mol"], np.greater_equal, 47.5) else pd.NaT,
+        row["tmp_cov_date_poccdm"] if r_cmp(row["tmp_cov_count_poccdm_ctv3"], np.greater_equal, 5) else pd.NaT,
+    ]
+    for label, column in [("GDM", "cov_date_gestationaldm"), ("T2DM", "cov_date_t2dm"), ("T1DM", "cov_date_t1dm")]:
+        s[column] = latest if s["cov_cat_diabetes"] == label else pd.NaT
+    s["cov_date_otherdm"] = min((d for d in step7_dates if not na(d)), default=pd.NaT) if category == "DM_other" else pd.NaT
+    return s
+
+
+def test_matches_a_row_wise_port_of_diabetes_algo(dummy):
+    expected = pd.DataFrame([diabetes_algo(row) for _, row in dummy.iterrows()])
+    actual = apply_diabetes_algorithm(dummy, keep_steps=True)
+    # every category and NA in every step, so each branch of the cascade is exercised
+    assert set(expected["cov_cat_diabetes"]) == {"DM unlikely", "DM_other", "T2DM", "T1DM", "GDM", "None"}
+    for step in STEPS:
+        assert actual[step].fillna("NA").tolist() == expected[step].fillna("NA").tolist(), step
+    assert actual["cov_cat_diabetes"].tolist() == expected["cov_cat_diabetes"].tolist()
+    assert actual["cov_bin_t2dm"].tolist() == (expected["cov_cat_diabetes"] == "T2DM").tolist()
+    for column in ["cov_date_gestationaldm", "cov_date_t2dm", "cov_date_t1dm", "cov_date_otherdm"]:
+        pd.testing.assert_series_equal(
+            pd.to_datetime(actual[column]).reset_index(drop=True), pd.to_datetime(expected[column]),
+            check_names=False, check_dtype=False,
+        )
+
+
+def test_drop_tmp_columns_keeps_the_rest(dummy):
+    out = drop_tmp_columns(apply_diabetes_algorithm(dummy))
+    assert not [c for c in out.columns if c.startswith("tmp_")]
+    assert {"cov_num_age", "cov_cat_diabetes", "qa_num_birth_year"} <= set(out.columns)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.disclosure import TableType, redact, redact_survival, roundmid_any, suppress, table_type
+from engine.survival import survival_curves
+
+
+def redactor(n, threshold):
+    """
+    redactor() of analysis/functions/redaction.R, one group at a time
+    """
+    n = np.asarray(n, dtype="int64")
+    leq_threshold = (n >= 1) & (n <= threshold)
+    redacted = leq_threshold.copy()
+    if (n * leq_threshold).sum() <= threshold and leq_threshold.any():
+        redacted[np.argmin(np.where(leq_threshold, n.sum() + 1, n))] = True
+    return redacted
+
+
+def test_suppression_matches_redactor():
+    rng = np.random.default_rng(7)
+    groups = np.sort(rng.integers(0, 300, 3000))
+    n = rng.choice([0, 1, 2, 3, 5, 8, 9, 40], len(groups))
+    primary, secondary = suppress(n, groups, 7)
+    expected = np.concatenate([redactor(n[groups == g], 7) for g in np.unique(groups)])
+    assert np.array_equal(primary | secondary, expected)
+
+
+def test_redact_rounds_published_cells():
+    cells = pd.DataFrame({"table": "t", "arm": ["a", "a", "b", "b"], "group": [1, 1, 2, 2], "n": [3, 40, 0, 52]})
+    out, audit = redact(cells, ["group"], redaction_threshold=7, rounding_threshold=6)
+    assert out["redacted"].tolist() == ["primary", "secondary", "", ""]
+    assert out["n_redacted"].tolist()[2:] == [0, 51]
+    assert roundmid_any([1, 6, 7, 12], 6).tolist() == [3, 3, 9, 9]
+    assert audit.loc[0, "n_primary"] == 1 and audit.loc[0, "total_published"] == 51
+
+
+def test_undeclared_float_columns_are_refused():
+    kind = table_type("output/survival/survival_region.csv")
+    table = pd.DataFrame({"time": [0, 1], "n_risk": [10, 9], "ratio": [0.5, 0.25]})
+    with pytest.raises(ValueError, match="ratio"):
+        kind.columns(table)
+    assert table_type("output/other.csv") is None
+    # estimates of a count table cannot follow its redacted cells
+    with pytest.raises(ValueError, match="surv"):
+        TableType("*.csv", counts=r"^n_", derived=r"^surv$").columns(table.rename(columns={"ratio": "surv"}))
+
+
+def test_survival_estimates_come_from_the_rounded_counts():
+    rng = np.random.default_rng(3)
+    time = rng.integers(0, 20, 400)
+    status = rng.choice([0, 1, 2], 400, p=[0.8, 0.15, 0.05])
+    strata = pd.DataFrame({"region": np.r_[rng.choice(["A", "B"], 397), ["C"] * 3]})
+    table = survival_curves(time, status, strata, times=np.arange(20), causes=("covid", "other"))
+    keys, counts, derived = table_type("survival_region.csv").columns(table)
+    out, audit = redact_survival(table, keys, derived, redaction_threshold=7, rounding_threshold=6)
+
+    published = out[out["region"] != "C"]
+    # no estimate is left from the unrounded counts
+    for _, curve in published.groupby("region"):
+        surv = np.cumprod(1 - curve["n_event"] / curve["n_risk"])
+        assert np.allclose(curve["surv"], surv)
+        for cause in ("covid", "other"):
+            assert np.isin(curve[f"n_event_{cause}"].cumsum() % 6, [0, 3]).all()
+    assert out.loc[out["region"] == "C", counts + derived].isna().all().all()
+    assert set(audit["column"]) == set(counts)
@@ -0,0 +1,133 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from engine.codelist_registry import CodelistSpec
+from engine.event_export import EventDataset, export_events, export_variables
+from engine.feature_store import FeatureStore
+
+CODELISTS = {
+    "long_covid": ("Y2b9d", "Y2b9e"),
+    "long_covid_extra": ("Y2b9e", "Y2b9f"),
+    "diabetes": ("C10..", "C10E."),
+    "metformin": ("0601022B0", "0601022B0AAABAB"),
+}
+
+
+def deps(columns, codelists):
+    return SimpleNamespace(columns=set(columns), tables={table for table, _ in columns}, codelists=set(codelists))
+
+
+# direct dependencies of a few date columns, as in engine/dependencies.py
+GRAPH = SimpleNamespace(variables={
+    "out_date_long_covid_first": deps([("clinical_events", "ctv3_code"), ("clinical_events", "date")], ["long_covid", "long_covid_extra"]),
+    "out_date_t2dm": deps([("clinical_events", "ctv3_code"), ("clinical_events", "date")], ["diabetes"]),
+    "exp_date_first_metfin": deps([("medications", "dmd_code"), ("medications", "date")], ["metformin"]),
+    "out_date_dereg": deps([("practice_registrations", "end_date")], []),
+    "out_date_covid_hosp": deps([("hospital_admissions", "all_diagnoses"), ("hospital_admissions", "admission_date")], ["long_covid"]),
+    "out_date_ae": deps([("emergency_care_attendances", "arrival_date")], ["diabetes"]),
+    "out_date_mixed": deps([("clinical_events", "ctv3_code"), ("clinical_events", "snomedct_code")], ["diabetes", "long_covid"]),
+    "cov_date_t1dm": deps([("clinical_events", "ctv3_code")], ["diabetes"]),
+})
+
+
+@pytest.fixture(scope="module")
+def source(tmp_path_factory):
+    """
+    random clinical events and prescriptions, with codes of several codelists,
+    codes in none, undated events and patients without a baseline
+    """
+    rng = np.random.default_rng(48)
+    directory = tmp_path_factory.mktemp("tables")
+    n = 3000
+
+    def dates(n):
+        values = pd.Series(pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 500, n), unit="D"))
+        return values.mask(rng.random(n) < 0.03).dt.strftime("%Y-%m-%d")
+
+    pd.DataFrame({"patient_id": np.arange(1, 121), "date_of_birth": "1960-01-01"}).to_csv(directory / "patients.csv", index=False)
+    pd.DataFrame({
+        "patient_id": rng.integers(1, 126, n),
+        "date": dates(n),
+        "snomedct_code": rng.choice(["1325161000000102", "22298006"], n),
+        "ctv3_code": rng.choice(["Y2b9d", "Y2b9e", "Y2b9f", "C10..", "C10E.", "H33.."], n),
+        "numeric_value": pd.Series(rng.uniform(0, 100, n).round(1)).mask(rng.random(n) < 0.5),
+    }).to_csv(directory / "clinical_events.csv", index=False)
+    pd.DataFrame({
+        "patient_id": rng.integers(1, 121, n // 2),
+        "date": dates(n // 2),
+        "dmd_code": rng.choice(["0601022B0", "0601022B0AAABAB", "0212000AA"], n // 2),
+    }).to_csv(directory / "medications.csv", index=False)
+    return directory
+
+
+@pytest.fixture(scope="module")
+def baseline():
+    rng = np.random.default_rng(0)
+    dates = pd.Series(pd.Timestamp("2020-03-01") + pd.to_timedelta(rng.integers(0, 300, 110), unit="D"))
+    # patients 111-115 are not in the patients table
+    return pd.DataFrame({"patient_id": np.r_[1:106, 111:116], "baseline_date": dates.mask(rng.random(110) < 0.05)})
+
+
+def expected_events(source, baseline, variables) -> pd.DataFrame:
+    """
+    the matching rows on or after baseline_date, scanned table by table
+    """
+    tables = {
+        "ctv3": pd.read_csv(source / "clinical_events.csv").rename(columns={"ctv3_code": "code"}),
+        "dmd": pd.read_csv(source / "medications.csv", dtype={"dmd_code": str}).rename(columns={"dmd_code": "code"}),
+    }
+    registered = set(pd.read_csv(source / "patients.csv")["patient_id"])
+    frames = []
+    for variable, (_, system, codelists) in variables.items():
+        codes = set().union(*(CODELISTS[name] for name in codelists))
+        rows = tables[system].merge(baseline, on="patient_id")
+        rows["date"] = pd.to_datetime(rows["date"])
+        rows = rows[rows["code"].isin(codes) & (rows["date"] >= rows["baseline_date"]) & rows["patient_id"].isin(registered)]
+        frames.append(rows.assign(variable=variable, value=rows.get("numeric_value", np.nan)))
+    columns = ["patient_id", "variable", "date", "code", "value"]
+    return pd.concat(frames)[columns].sort_values(columns, ignore_index=True)
+
+
+def test_export_variables_of_the_graph():
+    variables, skipped = export_variables(GRAPH)
+    assert variables == {
+        "out_long_covid": ("out_date_long_covid_first", "ctv3", ["long_covid", "long_covid_extra"]),
+        "out_t2dm": ("out_date_t2dm", "ctv3", ["diabetes"]),
+        "exp_metfin": ("exp_date_first_metfin", "dmd", ["metformin"]),
+    }
+    assert skipped["out_date_dereg"] == "no codelist"
+    assert skipped["out_date_covid_hosp"].startswith("all_diagnoses.is_in()")
+    assert skipped["out_date_ae"] == "events of emergency_care_attendances are not in the feature store"
+    assert skipped["out_date_mixed"] == "codelists of several coding systems"
+    assert "cov_date_t1dm" not in skipped
+
+
+def test_exported_events_match_a_scan_of_the_tables(source, baseline, tmp_path):
+    features = FeatureStore(tmp_path / "features")
+    features.update({name: CodelistSpec(name=name, inline_codes=codes) for name, codes in CODELISTS.items()}, source)
+    variables, _ = export_variables(GRAPH)
+    manifest = export_events(features, baseline, variables, tmp_path / "events", chunk_patients=25)
+    assert len(manifest["parts"]) == 5
+
+    events = EventDataset(tmp_path / "events")
+    parts = pa.concat_tables([events.part(i) for i in range(len(manifest["parts"]))]).to_pandas()
+    # sorted by (patient_id, date, variable) within the partitions and across them
+    keys = parts[["patient_id", "date"]].assign(variable=parts["variable"].cat.codes)
+    assert keys.equals(keys.sort_values(["patient_id", "date", "variable"], kind="stable"))
+
+    actual = parts.assign(variable=parts["variable"].astype(str), date=pd.to_datetime(parts["date"]))
+    columns = ["patient_id", "variable", "date", "code", "value"]
+    expected = expected_events(source, baseline, variables)
+    # an event matching two codelists of one variable is exported once
+    assert (expected["variable"] == "out_long_covid").any()
+    pd.testing.assert_frame_equal(actual.sort_values(columns, ignore_index=True), expected, check_dtype=False)
+    assert sum(part["n_events"] for part in manifest["parts"]) == len(expected)
+
+    for patient_id in [1, 60, 113, 500]:
+        rows = events.patient(patient_id).to_pandas()
+        assert len(rows) == (expected["patient_id"] == patient_id).sum()
+        assert (rows["patient_id"] == patient_id).all()
@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+
+from engine.event_store import EventStore
+from engine.exposure_episodes import EPISODE_COLUMNS, build_episodes, on_treatment
+
+
+def store(rows, population):
+    frame = pd.DataFrame(rows, columns=["patient_id", "date"])
+    frame["date"] = pd.to_datetime(frame["date"])
+    return EventStore.from_frame(frame, population)
+
+
+POPULATION = np.array([1, 2, 3])
+METFORMIN = store(
+    [
+        (1, "2021-01-01"), (1, "2021-01-29"),  # stops, then switches
+        (2, "2021-01-01"), (2, "2021-01-29"),  # add-on throughout, then stops
+        (3, "2021-01-01"),  # stops, nothing else
+    ],
+    POPULATION,
+)
+OTHER = store(
+    [
+        (1, "2021-03-10"),
+        (2, "2021-01-10"), (2, "2021-01-29"),
+    ],
+    POPULATION,
+)
+
+
+def test_episodes_end_after_the_last_supply():
+    episodes = build_episodes(METFORMIN, followup_end="2022-01-01")
+    assert episodes["n_prescriptions"].tolist() == [2, 2, 1]
+    assert episodes["end_date"].tolist() == list(pd.to_datetime(["2021-02-26", "2021-02-26", "2021-01-29"]))
+    assert episodes["discontinued"].all()
+
+
+def test_switch_after_the_last_supply():
+    episodes = build_episodes(METFORMIN, OTHER, followup_end="2022-01-01").set_index("patient_id")
+    assert episodes.loc[1, "switched"]
+    assert episodes.loc[1, "switch_date"] == pd.Timestamp("2021-03-10")
+
+
+def test_add_on_is_not_a_switch():
+    # prescribed alongside metformin, up to and on the day of its last supply
+    episodes = build_episodes(METFORMIN, OTHER, followup_end="2022-01-01").set_index("patient_id")
+    assert not episodes.loc[2, "switched"]
+    assert pd.isna(episodes.loc[2, "switch_date"])
+    assert not episodes.loc[3, "switched"]
+
+
+def brute_force_episodes(treatment, other, followup_end, supply_days=28, grace_days=30) -> pd.DataFrame:
+    """
+    episodes patient by patient, walking the prescriptions in date order
+    """
+    rows = []
+    for patient_id, dates in treatment.dropna().groupby("patient_id")["date"]:
+        switches = sorted(other.loc[other["patient_id"] == patient_id, "date"].dropna())
+        episodes = []
+        for date in sorted(dates):
+            if episodes and date <= episodes[-1][-1] + pd.Timedelta(days=supply_days + grace_days):
+                episodes[-1].append(date)
+            else:
+                episodes.append([date])
+        for i, prescriptions in enumerate(episodes):
+            end = prescriptions[-1] + pd.Timedelta(days=supply_days)
+            grace_end = end + pd.Timedelta(days=grace_days)
+            discontinued = i < len(episodes) - 1 or grace_end < pd.Timestamp(followup_end)
+            switch = [d for d in switches if prescriptions[-1] < d <= grace_end] if discontinued else []
+            rows.append((
+                patient_id, i + 1, prescriptions[0], end, len(prescriptions), discontinued,
+                end if discontinued else pd.NaT, bool(switch), switch[0] if switch else pd.NaT,
+            ))
+    dates = ["start_date", "end_date", "discontinuation_date", "switch_date"]
+    return pd.DataFrame(rows, columns=EPISODE_COLUMNS).astype({column: "datetime64[s]" for column in dates})
+
+
+def test_random_prescriptions_match_a_brute_force():
+    rng = np.random.default_rng(39)
+    population = np.arange(1, 201)
+
+    def prescriptions(n):
+        frame = pd.DataFrame({
+            "patient_id": rng.integers(1, 201, n),
+            "date": pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 400, n), unit="D"),
+        })
+        frame["date"] = frame["date"].mask(rng.random(n) < 0.03)
+        return frame
+
+    treatment, other = prescriptions(1500), prescriptions(300)
+    followup_end = "2021-12-31"
+    actual = build_episodes(
+        EventStore.from_frame(treatment, population), EventStore.from_frame(other, population), followup_end=followup_end
+    )
+    expected = brute_force_episodes(treatment, other, followup_end)
+    assert actual["switched"].any() and actual["episode"].max() > 1 and not actual["discontinued"].all()
+    pd.testing.assert_frame_equal(actual.reset_index(drop=True), expected, check_dtype=False)
+
+    # daily treatment status, including patients without prescriptions and missing dates
+    patient_ids = rng.integers(1, 205, 3000)
+    dates = pd.Series(pd.Timestamp("2021-01-01") + pd.to_timedelta(rng.integers(0, 500, 3000), unit="D")).mask(rng.random(3000) < 0.02)
+    covered = [
+        pd.notna(date) and ((expected["patient_id"] == patient_id) & (expected["start_date"] <= date) & (date <= expected["end_date"])).any()
+        for patient_id, date in zip(patient_ids, dates)
+    ]
+    assert on_treatment(actual, patient_ids, dates).tolist() == covered
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from engine.codelist_registry import CodelistSpec
+from engine.feature_store import FeatureQueries, FeatureStore
+from engine.queries import BaselineQueries, build_stores
+
+BASELINE = "2019-01-01"
+CODELISTS = {
+    "asthma": ("H33..",),
+    "diabetes": ("C10..",),
+    "bmi": ("X76C1", "X76C4", "X76C7", "X76C8"),
+    "metformin": ("39113611000001102",),
+    "antidiabetic": ("3484711000001105", "22777311000001105"),
+}
+
+
+def registry(codelists=CODELISTS):
+    return {name: CodelistSpec(name=name, inline_codes=codes) for name, codes in codelists.items()}
+
+
+@pytest.fixture(scope="module")
+def features(tmp_path_factory, example_data):
+    store = FeatureStore(tmp_path_factory.mktemp("feature_store"))
+    store.update(registry(), example_data)
+    return store
+
+
+def test_feature_store_answers_like_the_event_tables(tables, population, features):
+    queries = BaselineQueries(build_stores(tables, population), BASELINE)
+    answers = FeatureQueries(features, BASELINE)
+    assert answers.n_patients == queries.n_patients
+    for helper in ["has_prior_event_ctv3", "prior_event_date_ctv3", "prior_events_count_ctv3", "first_event_date_ctv3"]:
+        for name in ["asthma", "diabetes", "bmi"]:
+            codes = list(CODELISTS[name])
+            np.testing.assert_array_equal(getattr(answers, helper)(codes), getattr(queries, helper)(codes), (helper, name))
+    for helper in ["has_prior_prescription", "has_prior_prescription_date", "first_prescription_date"]:
+        # the union of two stored codelists, as `a + b` in the definition
+        codes = list(CODELISTS["metformin"] + CODELISTS["antidiabetic"])
+        np.testing.assert_array_equal(getattr(answers, helper)(codes), getattr(queries, helper)(codes), helper)
+    values = answers.recent_value_2y_ctv3(list(CODELISTS["bmi"]))
+    np.testing.assert_array_equal(values, queries.recent_value_2y_ctv3(list(CODELISTS["bmi"])))
+
+
+def test_update_only_rebuilds_changed_codelists(tmp_path, example_data):
+    features = FeatureStore(tmp_path)
+    assert sorted(features.update(registry(), example_data)["built"]) == sorted(CODELISTS)
+    assert features.update(registry(), example_data) == {"built": [], "removed": []}
+    changed = dict(CODELISTS, asthma=("H33..", "X76C0"))
+    changed.pop("bmi")
+    assert features.update(registry(changed), example_data) == {"built": ["asthma"], "removed": ["bmi"]}
+    assert features.store("asthma", "ctv3").count().sum() == 6
@@ -0,0 +1,94 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.index_dates import IndexDateQueries, build_period_stores, trial_index_dates
+from engine.queries import BaselineQueries, build_stores
+from engine.tables import read_tables
+
+CODES = {"asthma": ["H33.."], "diabetes": ["C10.."], "metformin": ["39113611000001102"]}
+HELPERS = {
+    "prior_asthma": ("prior_event_date_ctv3", CODES["asthma"]),
+    "n_diabetes": ("prior_events_count_ctv3", CODES["diabetes"]),
+    "first_diabetes": ("first_event_date_ctv3", CODES["diabetes"]),
+    "metformin_6m": ("has_prior_prescription_6m", CODES["metformin"]),
+}
+
+
+@pytest.fixture(scope="module")
+def periods(example_data):
+    return read_tables(["practice_registrations", "addresses"], example_data)
+
+
+@pytest.fixture(scope="module")
+def index_dates(population):
+    # several trials per patient, a patient without a baseline and one outside the population
+    rng = np.random.default_rng(5)
+    ids = np.r_[population, 99]
+    baseline = pd.Series(pd.to_datetime("2012-01-01") + pd.to_timedelta(rng.integers(0, 4000, len(ids)), unit="D"))
+    baseline[2] = pd.NaT
+    return trial_index_dates(pd.DataFrame({"patient_id": ids, "baseline_date": baseline}), 7)
+
+
+@pytest.fixture(scope="module")
+def queries(tables, periods, population, index_dates):
+    stores = {**build_stores(tables, population), **build_period_stores(periods, population)}
+    return IndexDateQueries(stores, index_dates)
+
+
+def brute_force(tables, population, index_dates, helper, codes):
+    """
+    the helper of BaselineQueries with every index date as the baseline of all patients
+    """
+    values = pd.Series(index=index_dates.index, dtype="object")
+    for date, pairs in index_dates.groupby("index_date"):
+        result = getattr(BaselineQueries(build_stores(tables, population), date), helper)(codes)
+        positions = np.searchsorted(population, pairs["patient_id"])
+        found = population[np.minimum(positions, len(population) - 1)] == pairs["patient_id"].to_numpy()
+        values[pairs.index[found]] = list(np.asarray(result)[positions[found]])
+    return values
+
+
+def period_on(frame, patient_id, date, preferred=None, tiebreak=None):
+    """
+    the period of `frame` a patient is in on `date`, by the rules of PERIOD_RULES
+    """
+    rows = frame[(frame["patient_id"] == patient_id) & (frame["start_date"] <= date)]
+    rows = rows[rows["end_date"].isna() | (rows["end_date"] >= date)].assign(
+        end=lambda f: f["end_date"].fillna(pd.Timestamp.max),
+        level=lambda f: f[preferred].notna() if preferred else True,
+    )
+    return rows.sort_values(["level", "start_date", "end", tiebreak]).iloc[-1] if len(rows) else None
+
+
+def test_trial_index_dates():
+    dataset = pd.DataFrame({"patient_id": [3, 4], "baseline_date": pd.to_datetime(["2021-01-30", None])})
+    out = trial_index_dates(dataset, 3)
+    assert out["patient_id"].tolist() == [3, 3, 3] and out["trial"].tolist() == [0, 1, 2]
+    assert out["index_date"].astype(str).tolist() == ["2021-01-30", "2021-01-31", "2021-02-01"]
+
+
+def test_event_helpers_match_each_index_date_as_baseline(tables, population, index_dates, queries):
+    out = queries.evaluate(HELPERS)
+    outside = ~index_dates["patient_id"].isin(population).to_numpy()
+    assert outside.sum() == 7  # the seven trials of patient 99
+    for name, (helper, codes) in HELPERS.items():
+        expected = brute_force(tables, population, index_dates, helper, codes)
+        np.testing.assert_array_equal(np.asarray(out[name])[~outside], np.asarray(list(expected[~outside])))
+    # pairs outside the population have empty windows
+    assert (out.loc[outside, "n_diabetes"] == 0).all() and out.loc[outside, "prior_asthma"].isna().all()
+
+
+def test_period_helpers_match_the_periods_on_each_index_date(periods, index_dates, queries):
+    registrations, addresses = periods["practice_registrations"], periods["addresses"]
+    region = queries.registration_on("practice_nuts1_region_name")
+    imd = queries.address_on("imd_rounded")
+    registered = queries.registered_spanning()
+    for i, pair in enumerate(index_dates.itertuples()):
+        registration = period_on(registrations, pair.patient_id, pair.index_date, tiebreak="practice_pseudo_id")
+        address = period_on(addresses, pair.patient_id, pair.index_date, "msoa_code", "address_id")
+        assert pd.isna(region[i]) if registration is None else region[i] == registration.practice_nuts1_region_name
+        assert pd.isna(imd[i]) if address is None else imd[i] == address.imd_rounded
+        start = pair.index_date - pd.Timedelta(days=366)
+        spanning = registrations[(registrations["patient_id"] == pair.patient_id) & (registrations["start_date"] <= start)]
+        assert registered[i] == (spanning["end_date"].isna() | (spanning["end_date"] > pair.index_date)).any()
@@ -0,0 +1,86 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.intervals import PERIOD_RULES, IntervalIndex
+
+POPULATION = np.arange(1, 81)
+
+
+def random_periods(rng, n, tiebreak):
+    """
+    overlapping periods starting on a few days, some ongoing (no end_date),
+    some without a start_date, some of patients outside the population
+    """
+    start = pd.Series(pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 40, n), unit="D"))
+    end = start + pd.to_timedelta(rng.integers(0, 30, n), unit="D")
+    return pd.DataFrame({
+        "patient_id": rng.integers(1, 86, n),
+        "start_date": start.mask(rng.random(n) < 0.03),
+        "end_date": end.mask(rng.random(n) < 0.2),
+        tiebreak: rng.integers(1, 6, n),
+        "msoa_code": pd.Series(rng.choice(["E02000001", "E02000002"], n)).mask(rng.random(n) < 0.3),
+    })
+
+
+def period_on(frame, patient_id, at, preferred, tiebreak):
+    """
+    for_patient_on(at) by sorting one patient's periods: among those started on
+    or before `at` and not ended before it, the last by (preferred known,
+    start_date, end_date with ongoing last, tiebreak)
+    """
+    if pd.isna(at):
+        return None
+    rows = frame[(frame["patient_id"] == patient_id) & (frame["start_date"] <= at) & ~(frame["end_date"] < at)]
+    if not len(rows):
+        return None
+    key = pd.DataFrame({
+        "known": rows[preferred].notna() if preferred else True,
+        "start": rows["start_date"],
+        "end": rows["end_date"].fillna(pd.Timestamp.max),
+        "tiebreak": rows[tiebreak],
+    })
+    return rows.loc[key.sort_values(list(key.columns), kind="stable").index[-1]]
+
+
+@pytest.mark.parametrize("table", ["practice_registrations", "addresses"])
+def test_period_on_matches_sorting_the_periods(table):
+    rng = np.random.default_rng(44)
+    rules = PERIOD_RULES[table]
+    frame = random_periods(rng, 600, rules["tiebreak"])
+    index = IntervalIndex.from_table(table, frame, POPULATION)
+
+    patient_ids = rng.integers(1, 81, 800)
+    at = pd.Series(pd.Timestamp("2019-12-25") + pd.to_timedelta(rng.integers(0, 80, 800), unit="D")).mask(rng.random(800) < 0.02)
+    columns = ["start_date", "end_date", rules["tiebreak"], "msoa_code"]
+    actual = index.on(at, columns, patients=np.searchsorted(POPULATION, patient_ids))
+    expected = [period_on(frame, p, d, rules["preferred"], rules["tiebreak"]) for p, d in zip(patient_ids, at)]
+
+    assert actual["exists"].tolist() == [row is not None for row in expected]
+    assert 0 < actual["exists"].mean() < 1
+    found = actual[actual["exists"]]
+    chosen = pd.DataFrame([row for row in expected if row is not None])
+    # the compared columns are all part of the sort key, so tied periods agree on them
+    compared = columns if rules["preferred"] else columns[:3]
+    for column in compared:
+        if column.endswith("_date"):
+            assert pd.to_datetime(found[column]).tolist() == pd.to_datetime(chosen[column]).tolist(), column
+        else:
+            assert found[column].fillna("").tolist() == chosen[column].fillna("").tolist(), column
+
+
+def test_spanning_matches_a_scan_of_the_periods():
+    rng = np.random.default_rng(45)
+    frame = random_periods(rng, 600, "practice_pseudo_id")
+    index = IntervalIndex.from_table("practice_registrations", frame, POPULATION)
+
+    patient_ids = rng.integers(1, 81, 800)
+    start = pd.Series(pd.Timestamp("2019-12-25") + pd.to_timedelta(rng.integers(0, 60, 800), unit="D"))
+    end = (start + pd.to_timedelta(rng.integers(0, 30, 800), unit="D")).mask(rng.random(800) < 0.02)
+    expected = [
+        bool(((frame["patient_id"] == p) & (frame["start_date"] <= s) & ((frame["end_date"] > e) | frame["end_date"].isna())).any())
+        and pd.notna(e)
+        for p, s, e in zip(patient_ids, start, end)
+    ]
+    assert index.spanning(start, end, np.searchsorted(POPULATION, patient_ids)).tolist() == expected
+    assert any(expected) and not all(expected)
@@ -0,0 +1,60 @@
+import numpy as np
+
+from engine.memo import Memo, memoised
+from engine.queries import BaselineQueries, build_stores
+
+
+class Helpers:
+    def __init__(self, baseline, memo=None):
+        self.memo = Memo() if memo is None else memo
+        self.baseline = np.asarray(baseline, dtype="int64")
+        self.patients = None
+        self.calls = 0
+
+    @memoised
+    def values(self, codelist, lab=None):
+        self.calls += 1
+        return (sorted(codelist), lab, self.baseline.tolist())
+
+
+def test_positional_and_keyword_arguments_are_one_node():
+    helpers = Helpers([1, 2])
+    first = helpers.values(["b", "a"])
+    assert helpers.values(["a", "b"], None) == first
+    assert helpers.values(codelist=["a", "b"], lab=None) == first
+    assert helpers.values(lab=None, codelist=("b", "a")) == first
+    assert helpers.calls == 1
+    assert helpers.memo.n_requested == 4 and helpers.memo.n_saved == 3
+
+
+def test_keyword_arguments_are_part_of_the_key():
+    helpers = Helpers([1, 2])
+    assert helpers.values(["a"], lab="cholesterol")[1] == "cholesterol"
+    assert helpers.values(["a"])[1] is None
+    assert helpers.values(["a"], "cholesterol")[1] == "cholesterol"
+    assert helpers.calls == 2
+
+
+def test_shared_memo_never_serves_other_baseline_dates():
+    memo = Memo()
+    early, late = Helpers([1, 2], memo), Helpers([5, 6], memo)
+    assert early.values(["a"])[2] == [1, 2]
+    assert late.values(["a"])[2] == [5, 6]
+    # replacing the dates of an instance changes its scope
+    early.baseline = np.array([5, 6])
+    assert early.values(["a"])[2] == [5, 6]
+    assert memo.n_evaluated == 2 and memo.n_saved == 1
+
+
+def test_shared_memo_never_serves_other_stores(tables, population):
+    memo = Memo()
+    fewer = dict(tables, clinical_events=tables["clinical_events"].iloc[::2])
+    all_events = BaselineQueries(build_stores(tables, population), "2019-01-01", memo)
+    half_events = BaselineQueries(build_stores(fewer, population), "2019-01-01", memo)
+    codes = ["H33..", "C10.."]
+    assert all_events.prior_events_count_ctv3(codes).sum() > half_events.prior_events_count_ctv3(codes).sum()
+    assert memo.n_saved == 0
+    # the same stores share their nodes again
+    assert BaselineQueries(all_events.stores, "2019-01-01", memo).prior_events_count_ctv3(codes[::-1]).sum() > 0
+    assert memo.n_saved == 1
+    assert memo.report()["node"].tolist() == ["prior_events_count_ctv3"]
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.event_store import EventStore, to_days
+from engine.queries import BaselineQueries, build_stores
+
+BASELINE = "2019-01-01"
+CODELISTS = {
+    "asthma": ("H33..",),
+    "diabetes": ("C10..",),
+    "bmi": ("X76C1", "X76C4", "X76C7", "X76C8"),
+    "metformin": ("39113611000001102",),
+    "antidiabetic": ("3484711000001105", "22777311000001105"),
+}
+
+
+@pytest.fixture(scope="module")
+def queries(tables, population):
+    return BaselineQueries(build_stores(tables, population), BASELINE)
+
+
+def expected(events, population, column, codes, reduce, start=None, end=None, default=None):
+    """
+    the definition's semantics by brute force: `reduce` of the event dates of
+    every patient within [start, end] whose `column` is in `codes`
+    """
+    events = events[events[column].isin(codes)]
+    days = pd.Series(to_days(events["date"]), index=events.index)
+    if start is not None:
+        days = days[days >= to_days([start])[0]]
+    if end is not None:
+        days = days[days <= to_days([end])[0]]
+    values = days.groupby(events.loc[days.index, "patient_id"].to_numpy()).agg(reduce)
+    return values.reindex(population).fillna(default).to_numpy(dtype="int64")
+
+
+def days(dates) -> np.ndarray:
+    # NaT is the int64 minimum, as EventStore.NULL
+    return np.asarray(dates).astype("datetime64[D]").astype("int64")
+
+
+def test_prior_event_helpers_match_the_definition(tables, population, queries):
+    events = tables["clinical_events"]
+    for codes in CODELISTS["asthma"], CODELISTS["diabetes"], CODELISTS["bmi"]:
+        assert np.array_equal(
+            days(queries.prior_event_date_ctv3(list(codes))),
+            expected(events, population, "ctv3_code", codes, "max", end=BASELINE, default=EventStore.NULL),
+        )
+        assert np.array_equal(
+            queries.prior_events_count_ctv3(list(codes)),
+            expected(events, population, "ctv3_code", codes, "count", end=BASELINE, default=0),
+        )
+        assert np.array_equal(
+            days(queries.first_event_date_ctv3(list(codes))),
+            expected(events, population, "ctv3_code", codes, "min", start=BASELINE, default=EventStore.NULL),
+        )
+
+
+def test_prescription_helpers_match_the_definition(tables, population, queries):
+    medications = tables["medications"]
+    codes = CODELISTS["metformin"] + CODELISTS["antidiabetic"]
+    assert np.array_equal(
+        queries.has_prior_prescription(list(codes)),
+        expected(medications, population, "dmd_code", codes, "count", end=BASELINE, default=0) > 0,
+    )
+    six_months = pd.Timestamp(BASELINE) - pd.Timedelta(days=183)
+    assert np.array_equal(
+        days(queries.has_prior_prescription_6m_date(list(codes))),
+        expected(medications, population, "dmd_code", codes, "max", six_months, BASELINE, EventStore.NULL),
+    )
+    assert np.array_equal(
+        days(queries.first_prescription_date(list(codes))),
+        expected(medications, population, "dmd_code", codes, "min", start=BASELINE, default=EventStore.NULL),
+    )
+
+
+def test_most_recent_bmi_matches_the_definition():
+    rng = np.random.default_rng(11)
+    n_events, population = 400, np.arange(1, 41)
+    events = pd.DataFrame({
+        "patient_id": rng.choice(population, n_events),
+        "date": pd.to_datetime("2016-01-01") + pd.to_timedelta(rng.integers(0, 2000, n_events), unit="D"),
+        "ctv3_code": rng.choice(["22K..", "X76C1"], n_events),
+        "snomedct_code": None,
+        "numeric_value": rng.choice([np.nan, 9.0, 24.5, 31.0, 75.0], n_events),
+    })
+    birth = pd.Series(pd.to_datetime("2001-06-01") + pd.to_timedelta(rng.integers(0, 2000, 40), unit="D"))
+    birth[0] = pd.NaT
+    queries = BaselineQueries(build_stores({"clinical_events": events}, population), BASELINE)
+    bmi = queries.most_recent_bmi(birth.to_numpy())
+
+    # last_for_patient() of 22K.. events after baseline - 2*366 days and from age 16, then process_data.R
+    for i, patient_id in enumerate(population):
+        rows = events[(events["patient_id"] == patient_id) & (events["ctv3_code"] == "22K..")]
+        rows = rows[rows["date"] > pd.Timestamp(BASELINE) - pd.Timedelta(days=2 * 366)]
+        rows = rows[rows["date"] >= birth[i] + pd.Timedelta(days=int(365.25 * 16))].sort_values("date", kind="stable")
+        if rows.empty:
+            assert np.isnan(bmi["value"][i]) and np.isnat(bmi["date"][i])
+            continue
+        value = rows["numeric_value"].iloc[-1]
+        assert bmi["date"][i] == rows["date"].iloc[-1]
+        assert np.isnan(bmi["value"][i]) if np.isnan(value) or not 12 <= value <= 70 else bmi["value"][i] == value
+    assert np.isnat(bmi["date"][0])
@@ -0,0 +1,78 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.dataset_io import write_dataset
+from engine.sampling import PatientSample, add_sample_arguments, patient_hash, sample_from_args, use_sample
+from engine.tables import read_table
+
+PATIENT_IDS = np.random.default_rng(50).choice(10**9, 20_000, replace=False) + 1
+
+
+@pytest.fixture(autouse=True)
+def no_active_sample():
+    yield
+    use_sample(None)
+
+
+def kept(patient_id, fraction, key="patient-sample", strata=None, fractions=None) -> bool:
+    """
+    the sampling rule for one patient: its own hash, below the fraction of its stratum
+    """
+    if strata is not None and patient_id in strata.index and str(strata[patient_id]) in (fractions or {}):
+        fraction = fractions[str(strata[patient_id])]
+    return patient_hash([patient_id], key)[0] < fraction
+
+
+def test_samples_match_the_rule_patient_by_patient():
+    hashes = patient_hash(PATIENT_IDS)
+    # one patient at a time gives the same hashes as the whole array
+    assert [patient_hash([p])[0] for p in PATIENT_IDS[:200]] == hashes[:200].tolist()
+    # uniform on [0, 1): the counts of ten equal bins are within 5 standard errors
+    counts = np.bincount((hashes * 10).astype(int), minlength=10)
+    assert np.all(np.abs(counts - 2000) < 5 * np.sqrt(2000 * 0.9))
+
+    small, large = PatientSample(0.1).keep(PATIENT_IDS), PatientSample(0.3).keep(PATIENT_IDS)
+    assert small.tolist() == [kept(p, 0.1) for p in PATIENT_IDS]
+    # a smaller fraction draws a subset; another key draws other patients
+    assert not (small & ~large).any()
+    other = PatientSample(0.1, key="other").keep(PATIENT_IDS)
+    assert other.tolist() == [kept(p, 0.1, key="other") for p in PATIENT_IDS]
+    assert (small != other).sum() > 1000
+
+
+def test_stratified_sample_matches_the_rule(tmp_path):
+    rng = np.random.default_rng(1)
+    dataset = pd.DataFrame({
+        "patient_id": PATIENT_IDS[:15_000],
+        "cov_bin_pos_covid": pd.array(np.where(rng.random(15_000) < 0.05, None, rng.random(15_000) < 0.02), dtype="boolean"),
+    })
+    write_dataset(dataset, tmp_path / "dataset.arrow")
+    parser = argparse.ArgumentParser()
+    add_sample_arguments(parser)
+    args = parser.parse_args([
+        "--sample", "0.05", "--sample-by", str(tmp_path / "dataset.arrow"), "cov_bin_pos_covid", "--sample-fraction", "True", "1",
+    ])
+    sample = sample_from_args(args)
+    strata = dataset.set_index("patient_id")["cov_bin_pos_covid"]
+    # the last 5000 patients are not in the strata file and get the default fraction
+    expected = [kept(p, 0.05, strata=strata, fractions={"True": 1.0}) for p in PATIENT_IDS]
+    assert sample.keep(PATIENT_IDS).tolist() == expected
+    positive = dataset.loc[dataset["cov_bin_pos_covid"].fillna(False).to_numpy(dtype=bool), "patient_id"]
+    assert sample.keep(positive).all()
+
+
+def test_every_table_keeps_the_same_patients(tmp_path):
+    # enough patients for the sample to be neither empty nor everything
+    patients = pd.DataFrame({"patient_id": PATIENT_IDS[:2000], "date_of_birth": "1960-01-01", "sex": "female"})
+    events = pd.DataFrame({"patient_id": np.repeat(PATIENT_IDS[:2000], 3), "date": "2020-01-01", "ctv3_code": "C10.."})
+    patients.to_csv(tmp_path / "patients.csv", index=False)
+    events.to_csv(tmp_path / "clinical_events.csv", index=False)
+    use_sample(PatientSample(0.2))
+    expected = {p for p in PATIENT_IDS[:2000] if kept(p, 0.2)}
+    assert set(read_table("patients", tmp_path)["patient_id"]) == expected
+    sampled_events = read_table("clinical_events", tmp_path)
+    assert set(sampled_events["patient_id"]) == expected and len(sampled_events) == 3 * len(expected)
+    assert 300 < len(expected) < 500
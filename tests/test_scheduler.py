@@ -0,0 +1,79 @@
+from pathlib import Path
+
+import pytest
+import yaml
+
+from engine.scheduler import Scheduler, load_actions
+
+STEP = """
+import sys
+from pathlib import Path
+inputs = [Path(name).read_text() for name in sys.argv[2:]]
+Path(sys.argv[1]).write_text("".join(inputs) or "seed")
+"""
+
+
+def action(output, *inputs, needs=()):
+    return {
+        "run": f"python:latest python step.py {output} {' '.join(inputs)}".strip(),
+        "needs": list(needs),
+        "outputs": {"highly_sensitive": {"data": output}},
+    }
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "step.py").write_text(STEP)
+    actions = {
+        "report": action("report.txt", "clean.txt", "summary.txt", needs=["clean", "summary"]),
+        "summary": action("summary.txt", "raw.txt", needs=["extract"]),
+        "clean": action("clean.txt", "raw.txt", needs=["extract"]),
+        "extract": action("raw.txt"),
+    }
+    (tmp_path / "project.yaml").write_text(yaml.safe_dump({"version": "3.0", "actions": actions}))
+    return tmp_path
+
+
+def test_required_actions_come_after_their_needs(project):
+    scheduler = Scheduler(load_actions(["project.yaml"]), state_dir=project / "state")
+    order = scheduler.required(["report"])
+    assert sorted(order) == ["clean", "extract", "report", "summary"]
+    for name in order:
+        assert all(order.index(need) < order.index(name) for need in scheduler.actions[name].needs)
+    assert scheduler.required(["summary"]) == ["extract", "summary"]
+
+
+def test_cycles_and_unknown_needs_are_errors(project):
+    specs = yaml.safe_load((project / "project.yaml").read_text())
+    specs["actions"]["extract"]["needs"] = ["report"]
+    (project / "cyclic.yaml").write_text(yaml.safe_dump(specs))
+    with pytest.raises(ValueError, match="cycle"):
+        Scheduler(load_actions(["cyclic.yaml"]), state_dir=project / "state").required()
+    specs["actions"]["extract"]["needs"] = ["missing"]
+    (project / "unknown.yaml").write_text(yaml.safe_dump(specs))
+    with pytest.raises(ValueError, match="unknown"):
+        load_actions(["unknown.yaml"])
+
+
+def test_unchanged_actions_are_cached(project):
+    def run(**kwargs):
+        scheduler = Scheduler(load_actions(["project.yaml"]), state_dir=project / "state", workers=2)
+        return dict(scheduler.run(**kwargs)[["action", "status"]].values)
+
+    assert set(run().values()) == {"ran"}
+    assert (project / "report.txt").read_text() == "seedseed"
+    assert set(run().values()) == {"cached"}
+    # a re-run that writes the same output leaves everything downstream cached
+    assert run(force={"extract"}) == {"extract": "ran", "clean": "cached", "summary": "cached", "report": "cached"}
+    (project / "clean.txt").write_text("edited")
+    assert run() == {"extract": "cached", "clean": "ran", "summary": "cached", "report": "cached"}
+
+
+def test_local_pipeline_processes_the_diabetes_dataset():
+    root = Path(__file__).parents[1]
+    actions = load_actions([root / "project.yaml", root / "project.local.yaml"])
+    order = Scheduler(actions, state_dir=root / "output" / ".actions").required(["data_process"])
+    assert order.index("apply_diabetes_algorithm") < order.index("data_process")
+    produced = Path(actions["apply_diabetes_algorithm"].outputs[0]).name
+    assert produced in actions["data_process"].command()
@@ -0,0 +1,92 @@
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.dataset_io import write_dataset
+
+REPO = Path(__file__).parents[1]
+
+
+@pytest.fixture(scope="module")
+def dataset():
+    """
+    dataset with a column of every kind, missing values in each, heavy tails
+    and enough distinct values to leave the exact range of the sketches
+    """
+    rng = np.random.default_rng(46)
+    n = 60_000
+    return pd.DataFrame({
+        "patient_id": np.arange(n),
+        "cov_num_age": pd.Series(rng.integers(18, 110, n)).astype("float64").mask(rng.random(n) < 0.02),
+        "cov_num_bmi": pd.Series(rng.lognormal(3.3, 0.25, n)).mask(rng.random(n) < 0.3),
+        "cov_cat_region": pd.Series(rng.choice(["East", "London", "North West", "South West"], n, p=[0.4, 0.3, 0.2, 0.1])).mask(rng.random(n) < 0.05),
+        "cov_bin_t2dm": pd.array(np.where(rng.random(n) < 0.1, None, rng.random(n) < 0.2), dtype="boolean"),
+        "baseline_date": pd.Series(pd.Timestamp("2020-01-01") + pd.to_timedelta(rng.integers(0, 700, n), unit="D")).mask(rng.random(n) < 0.01),
+        "out_date_covid_hosp": pd.Series(pd.Timestamp("2020-03-01") + pd.to_timedelta(rng.integers(0, 900, n), unit="D")).mask(rng.random(n) < 0.9),
+    })
+
+
+@pytest.fixture(scope="module")
+def profiled(dataset, tmp_path_factory):
+    """
+    profile_dataset.py over three shards, run twice: the second run reuses
+    the sketches of the unchanged shards
+    """
+    directory = tmp_path_factory.mktemp("profile")
+    shards = []
+    for i, rows in enumerate(np.array_split(np.arange(len(dataset)), 3)):
+        shards.append(str(directory / f"shard_{i}.arrow"))
+        write_dataset(dataset.iloc[rows], shards[-1])
+    command = [sys.executable, REPO / "analysis" / "profile_dataset.py", "--input", *shards, "--chunk-rows", "7000", "--output", "out"]
+    first = subprocess.run(command, cwd=directory, check=True, capture_output=True, text=True).stdout
+    second = subprocess.run(command, cwd=directory, check=True, capture_output=True, text=True).stdout
+    assert "sketched" in first and second.count("unchanged, sketch reused") == 3
+    profile = pd.read_csv(directory / "out" / "dataset_profile.csv").set_index("column")
+    frequencies = pd.read_csv(directory / "out" / "dataset_frequencies.csv", dtype={"value": str})
+    return profile, frequencies
+
+
+def test_exact_statistics_match_pandas(dataset, profiled):
+    profile, _ = profiled
+    columns = [column for column in dataset.columns if column != "patient_id"]
+    assert profile.index.tolist() == columns
+    assert profile["kind"].tolist() == ["num", "num", "cat", "bin", "date", "date"]
+    for column in columns:
+        values = dataset[column]
+        assert profile.loc[column, "n"] == len(values)
+        assert profile.loc[column, "n_missing"] == values.isna().sum()
+    for column in ["cov_num_age", "cov_num_bmi"]:
+        assert float(profile.loc[column, "min"]) == dataset[column].min()
+        assert float(profile.loc[column, "max"]) == dataset[column].max()
+    for column in ["baseline_date", "out_date_covid_hosp"]:
+        assert profile.loc[column, "min"] == str(dataset[column].min().date())
+        assert profile.loc[column, "max"] == str(dataset[column].max().date())
+    assert profile.loc["cov_bin_t2dm", "true_rate"] == pytest.approx(dataset["cov_bin_t2dm"].mean())
+
+
+def test_frequencies_match_value_counts(dataset, profiled):
+    _, frequencies = profiled
+    counts = frequencies.groupby("column").apply(lambda rows: dict(zip(rows["value"], rows["n"])), include_groups=False)
+    assert counts["cov_cat_region"] == dataset["cov_cat_region"].value_counts().to_dict()
+    assert counts["cov_bin_t2dm"] == {str(k): v for k, v in dataset["cov_bin_t2dm"].value_counts().to_dict().items()}
+    months = dataset["baseline_date"].dropna().dt.strftime("%Y-%m").value_counts().to_dict()
+    assert counts["baseline_date"] == months
+
+
+def test_approximate_statistics_are_within_their_error(dataset, profiled):
+    profile, _ = profiled
+    for column in dataset.columns.drop("patient_id"):
+        exact = dataset[column].nunique()
+        # standard error of a HyperLogLog with 2 ** 14 registers is 0.8%
+        assert profile.loc[column, "n_distinct"] == pytest.approx(exact, rel=0.03), column
+    for column in ["cov_num_age", "cov_num_bmi"]:
+        values = np.sort(dataset[column].dropna().to_numpy())
+        for q in (0.25, 0.5, 0.75):
+            estimate = profile.loc[column, f"p{round(q * 100)}"]
+            # the rank of the estimate is within 1% of the quantile's rank
+            low, high = np.searchsorted(values, estimate, side="left"), np.searchsorted(values, estimate, side="right")
+            assert low / len(values) - 0.01 <= q <= high / len(values) + 0.01, (column, q)
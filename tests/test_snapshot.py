@@ -0,0 +1,77 @@
+import os
+import pickle
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+REPO = Path(__file__).parents[1]
+
+# stand-in for dataset_definition.py: a picklable dataset built from the study
+# dates, a codelist CSV and the user arguments, counting its own executions
+DEFINITION = '''
+import json
+import sys
+from pathlib import Path
+
+builds = Path("builds.txt")
+builds.write_text(builds.read_text() + "x" if builds.exists() else "x")
+dataset = {
+    "dates": json.loads(Path("analysis/design/study-dates.json").read_text()),
+    "codes": Path("codelists/opensafely-diabetes.csv").read_text().split(),
+    "args": [arg for arg in sys.argv[1:] if arg != "--rebuild-snapshot"],
+}
+'''
+
+
+@pytest.fixture
+def study(tmp_path):
+    (tmp_path / "analysis" / "design").mkdir(parents=True)
+    (tmp_path / "codelists").mkdir()
+    (tmp_path / "analysis" / "dataset_definition.py").write_text(DEFINITION)
+    (tmp_path / "analysis" / "design" / "study-dates.json").write_text('{"index_date": "2020-01-01"}')
+    (tmp_path / "codelists" / "opensafely-diabetes.csv").write_text("code\nC10..\n")
+    return tmp_path
+
+
+def run(study, *args) -> dict:
+    """
+    run the snapshot definition as ehrQL would (cwd at the repository root,
+    the definition's directory on sys.path) and return its dataset
+    """
+    script = 'import runpy, pickle, sys; sys.argv = sys.argv[1:]; sys.stdout.buffer.write(pickle.dumps(runpy.run_path(sys.argv[0])["dataset"]))'
+    result = subprocess.run(
+        [sys.executable, "-c", script, str(REPO / "analysis" / "dataset_definition_snapshot.py"), *args],
+        cwd=study, check=True, capture_output=True, env={**os.environ, "PYTHONPATH": str(study / "analysis")},
+    )
+    return pickle.loads(result.stdout)
+
+
+def builds(study) -> int:
+    return len((study / "builds.txt").read_text())
+
+
+def test_loaded_snapshot_equals_the_built_definition(study):
+    built = run(study)
+    assert builds(study) == 1 and len(list((study / "output" / "snapshot").glob("*.pickle"))) == 1
+    assert run(study) == built
+    assert builds(study) == 1
+    assert run(study, "--rebuild-snapshot") == built
+    assert builds(study) == 2
+
+
+def test_changed_inputs_invalidate_the_snapshot(study):
+    run(study)
+    # a codelist CSV read by codelist_from_csv()
+    (study / "codelists" / "opensafely-diabetes.csv").write_text("code\nC10..\nC10E.\n")
+    assert run(study)["codes"] == ["code", "C10..", "C10E."]
+    # the study dates
+    (study / "analysis" / "design" / "study-dates.json").write_text('{"index_date": "2021-01-01"}')
+    assert run(study)["dates"] == {"index_date": "2021-01-01"}
+    # the user arguments
+    assert run(study, "--cohort", "all")["args"] == ["--cohort", "all"]
+    assert builds(study) == 4
+    # every variant is served from its own snapshot afterwards
+    assert run(study, "--cohort", "all")["args"] == ["--cohort", "all"]
+    assert builds(study) == 4
@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+import engine.streaming as streaming
+from engine.streaming import chunk_bounds, staged_chunks
+from engine.tables import read_table
+
+COLUMNS = {"patients": ["sex"], "clinical_events": ["date", "ctv3_code"], "medications": ["date", "dmd_code"]}
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # source tables read, one entry per pass over a table
+    names = []
+
+    def counted(name, *args, **kwargs):
+        names.append(name)
+        return iter_table(name, *args, **kwargs)
+
+    iter_table = streaming.iter_table
+    monkeypatch.setattr(streaming, "iter_table", counted)
+    return names
+
+
+@pytest.mark.parametrize("chunks_per_pass, passes", [(None, 1), (2, 2), (1, 4)])
+def test_tables_are_read_once_per_pass(example_data, tmp_path, reads, chunks_per_pass, passes):
+    bounds = chunk_bounds(example_data, chunk_patients=3)
+    assert len(bounds) == 4
+    reads.clear()
+    staged = {}
+    for directory in staged_chunks(example_data, bounds, tmp_path, columns=COLUMNS, chunks_per_pass=chunks_per_pass):
+        staged[directory.name] = {name: pd.read_csv(directory / f"{name}.csv") for name in COLUMNS}
+    assert sorted(reads) == sorted(list(COLUMNS) * passes)
+
+    # every row is staged once, in the chunk of its patient
+    for name in COLUMNS:
+        rows = pd.concat([tables[name].assign(chunk=chunk) for chunk, tables in staged.items()], ignore_index=True)
+        source = read_table(name, example_data)
+        assert len(rows) == len(source)
+        assert sorted(rows["patient_id"]) == sorted(source["patient_id"])
+        chunk = rows["chunk"].str[-4:].astype(int)
+        lower = pd.Series([0, *bounds[:-1]])[chunk].to_numpy()
+        assert ((rows["patient_id"] >= lower) & (rows["patient_id"] < bounds[chunk])).all()
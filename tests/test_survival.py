@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from engine.survival import follow_up, survival_curves
+
+
+def brute_force(time, status, day, causes=("event",)):
+    """
+    Kaplan-Meier, Greenwood and Aalen-Johansen at `day`, one day at a time
+    """
+    surv, greenwood, cuminc = 1.0, 0.0, dict.fromkeys(causes, 0.0)
+    for t in range(day + 1):
+        n = (time >= t).sum()
+        if n == 0:
+            continue
+        d = ((time == t) & (status > 0)).sum()
+        for i, cause in enumerate(causes, start=1):
+            cuminc[cause] += surv * ((time == t) & (status == i)).sum() / n
+        if n > d:
+            greenwood += d / (n * (n - d))
+        surv *= 1 - d / n
+    return surv, surv * np.sqrt(greenwood), cuminc
+
+
+def test_curves_match_brute_force():
+    rng = np.random.default_rng(42)
+    time = rng.integers(0, 30, 500)
+    status = rng.choice([0, 1, 2], 500, p=[0.6, 0.3, 0.1])
+    group = pd.DataFrame({"group": rng.choice(["a", "b"], 500)})
+    curves = survival_curves(time, status, group, causes=("covid", "other"))
+    for row in curves.sample(40, random_state=1).itertuples():
+        rows = (group["group"] == row.group).to_numpy()
+        surv, se, cuminc = brute_force(time[rows], status[rows], row.time, ("covid", "other"))
+        assert np.isclose(row.surv, surv)
+        assert np.isclose(row.surv_se, se)
+        assert np.isclose(row.cuminc_covid, cuminc["covid"])
+        assert np.isclose(row.cuminc_other, cuminc["other"])
+        assert row.n_risk == (time[rows] >= row.time).sum()
+        assert row.n_event_covid == ((time[rows] == row.time) & (status[rows] == 1)).sum()
+
+
+def test_follow_up_ends_at_the_earliest_date():
+    origin = pd.to_datetime(["2021-01-01"] * 3)
+    end = pd.to_datetime(["2021-01-29"] * 3)
+    death = pd.Series(pd.to_datetime(["2021-01-05", None, "2021-01-10"]))
+    hosp = pd.Series(pd.to_datetime(["2021-01-05", None, None]))
+    dereg = pd.Series(pd.to_datetime([None, None, "2021-01-03"]))
+    time, status = follow_up(origin, end, {"hosp": hosp, "death": death}, censoring=[dereg])
+    # earlier causes win ties, missing dates never end follow-up
+    assert time.tolist() == [4, 28, 2]
+    assert status.tolist() == [1, 0, 0]
@@ -0,0 +1,17 @@
+import pandas as pd
+
+from engine.tables import iter_table, read_table
+
+
+def test_columns_missing_from_a_table_file_are_all_null(tmp_path):
+    pd.DataFrame({"patient_id": [1, 2], "date": ["2020-01-01", None], "ctv3_code": ["H33..", "C10.."]}).to_csv(
+        tmp_path / "clinical_events.csv", index=False
+    )
+    frame = read_table("clinical_events", tmp_path, ["date", "snomedct_code", "numeric_value"])
+    assert list(frame.columns) == ["patient_id", "date", "snomedct_code", "numeric_value"]
+    assert frame["snomedct_code"].isna().all() and frame["snomedct_code"].dtype == "string"
+    assert frame["numeric_value"].isna().all() and frame["numeric_value"].dtype == "float64"
+    assert frame["date"].tolist()[0] == pd.Timestamp("2020-01-01") and pd.isna(frame["date"][1])
+    chunks = list(iter_table("clinical_events", tmp_path, ["ctv3_code", "numeric_value"], chunk_rows=1))
+    assert [len(chunk) for chunk in chunks] == [1, 1]
+    assert all(list(chunk.columns) == ["patient_id", "ctv3_code", "numeric_value"] for chunk in chunks)
@@ -0,0 +1,137 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from engine.tables import read_table
+from engine.timeline import TimelineStore, build_timelines
+
+TABLES = ["patients", "clinical_events", "medications", "ons_deaths"]
+CODELISTS = {
+    "diabetes": ["C10..", "C10E.", "44054006"],
+    "hba1c": ["X772q", "1049301000000100"],
+    "metformin": ["0601022B0"],
+    "covid": ["U07", "U071"],
+}
+# direct dependencies of a few dataset variables, as in engine/dependencies.py
+GRAPH = SimpleNamespace(
+    nodes={"baseline_date": SimpleNamespace(tables={"clinical_events"}, codelists={"covid"})},
+    variables={
+        "population": SimpleNamespace(tables={"patients"}, codelists=set()),
+        "cov_bin_diabetes": SimpleNamespace(tables={"clinical_events"}, codelists={"diabetes"}),
+        "cov_num_hba1c": SimpleNamespace(tables={"clinical_events"}, codelists={"hba1c", "diabetes"}),
+        "exp_date_metformin": SimpleNamespace(tables={"medications"}, codelists={"metformin"}),
+        "out_bin_death_covid": SimpleNamespace(tables={"ons_deaths"}, codelists={"covid"}),
+        "cov_num_age": SimpleNamespace(tables={"patients"}, codelists=set()),
+    },
+)
+
+
+@pytest.fixture(scope="module")
+def source(tmp_path_factory):
+    """
+    random source tables: events on the same day, patients without events,
+    event patients missing from the patients table, codes in no codelist
+    """
+    rng = np.random.default_rng(37)
+    directory = tmp_path_factory.mktemp("source")
+
+    def dates(n, p_missing=0.0):
+        values = pd.Series(pd.Timestamp("2019-01-01") + pd.to_timedelta(rng.integers(0, 60, n), unit="D"))
+        return values.mask(rng.random(n) < p_missing)
+
+    n = 400
+    pd.DataFrame({
+        "patient_id": np.arange(1, 41),
+        "date_of_birth": dates(40, 0.1).dt.strftime("%Y-%m-%d"),
+        "sex": rng.choice(["female", "male"], 40),
+    }).to_csv(directory / "patients.csv", index=False)
+    pd.DataFrame({
+        "patient_id": rng.integers(1, 46, n),
+        "date": dates(n, 0.05).dt.strftime("%Y-%m-%d"),
+        "snomedct_code": rng.choice(["44054006", "1049301000000100", "22298006"], n),
+        "ctv3_code": rng.choice(["C10..", "C10E.", "X772q", "XaIz2"], n),
+        "numeric_value": pd.Series(rng.uniform(20, 80, n).round(1)).mask(rng.random(n) < 0.5),
+    }).to_csv(directory / "clinical_events.csv", index=False)
+    pd.DataFrame({
+        "patient_id": rng.integers(1, 41, n // 2),
+        "date": dates(n // 2).dt.strftime("%Y-%m-%d"),
+        "dmd_code": rng.choice(["0601022B0", "0212000AA"], n // 2),
+    }).to_csv(directory / "medications.csv", index=False)
+    pd.DataFrame({
+        "patient_id": rng.choice(np.arange(1, 41), 12, replace=False),
+        "date": dates(12).dt.strftime("%Y-%m-%d"),
+        "underlying_cause_of_death": rng.choice(["U07.1", "I21.0", "c91.1"], 12),
+        "cause_of_death_01": pd.Series(rng.choice(["U07.2", "J18.9"], 12)).mask(rng.random(12) < 0.5),
+    }).to_csv(directory / "ons_deaths.csv", index=False)
+    return directory
+
+
+@pytest.fixture(scope="module")
+def store(source, tmp_path_factory):
+    directory = tmp_path_factory.mktemp("timeline")
+    build_timelines(source, directory, TABLES)
+    return TimelineStore(directory, CODELISTS, GRAPH)
+
+
+def codelists_of(table, row) -> set:
+    """
+    the codelists matching one source row, code by code
+    """
+    if table == "clinical_events":
+        codes = [row["snomedct_code"], row["ctv3_code"]]
+    elif table == "medications":
+        codes = [row["dmd_code"]]
+    elif table == "ons_deaths":
+        causes = [row[c] for c in ("underlying_cause_of_death", "cause_of_death_01") if pd.notna(row[c])]
+        codes = [cause.replace(".", "").upper()[:length] for cause in causes for length in (3, None)]
+    else:
+        return set()
+    return {name for name, codelist in CODELISTS.items() if set(codes) & set(codelist)}
+
+
+def expected_timeline(source, patient_id) -> list:
+    events = []
+    for table in sorted(TABLES):
+        rows = read_table(table, source)
+        rows = rows[rows["patient_id"] == patient_id]
+        date = "date_of_birth" if table == "patients" else "date"
+        for _, row in rows.sort_values(date, kind="stable").iterrows():
+            codelists = codelists_of(table, row)
+            variables = {
+                name for name, deps in {**GRAPH.nodes, **GRAPH.variables}.items()
+                if name != "population" and table in deps.tables
+                and (deps.codelists & codelists if table != "patients" else True)
+            }
+            events.append((row[date], table, ";".join(sorted(codelists)), ";".join(sorted(variables))))
+    # date order, undated rows first, ties by table
+    return sorted(events, key=lambda event: (pd.notna(event[0]), event[0] if pd.notna(event[0]) else 0, event[1]))
+
+
+def test_timelines_match_the_source_tables(source, store):
+    population = sorted(set().union(*(read_table(table, source)["patient_id"] for table in TABLES)))
+    assert store.population.tolist() == population
+    annotated = 0
+    for patient_id in population:
+        timeline = store.timeline(patient_id)
+        actual = [
+            (row.date, row.table, row.codelists, row.variables) for row in timeline.itertuples()
+        ]
+        expected = expected_timeline(source, patient_id)
+        assert [event[1:] for event in actual] == [event[1:] for event in expected], patient_id
+        assert [pd.Timestamp(event[0]) if pd.notna(event[0]) else None for event in actual] == [
+            pd.Timestamp(event[0]) if pd.notna(event[0]) else None for event in expected
+        ]
+        annotated += sum(bool(event[2]) for event in actual)
+    assert annotated > 0
+
+
+def test_rows_are_the_patients_rows(source, store):
+    events = read_table("clinical_events", source)
+    for patient_id in [1, 17, 43]:
+        expected = events[events["patient_id"] == patient_id].sort_values("date", kind="stable")
+        actual = store.rows("clinical_events", patient_id)
+        assert actual["ctv3_code"].tolist() == expected["ctv3_code"].tolist()
+    with pytest.raises(KeyError):
+        store.timeline(1000)